@@ -0,0 +1,124 @@
+import threading, logging
+from collections import deque
+from metrics import metrics
+from clock import system_clock
+
+logger = logging.getLogger('flmx-logger')
+
+class TokenBucket(object):
+    """Allows [rate] requests a second on average, with bursts of up to [burst] at once"""
+    def __init__(self, rate, burst=1):
+        super(TokenBucket, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    def wait(self, now):
+        """Seconds until there will be a token, 0 if there is one, without taking it"""
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Take a token if there is one, returning 0, otherwise the seconds until there will be"""
+        retry = self.wait(now)
+        if not retry:
+            self.tokens -= 1
+        return retry
+
+class AdmissionController(object):
+    """Holds back new validations so the validator isn't flooded with them, and rate limits polling it.
+
+    At most [max_in_flight] validations run at once and they are started at no more than [start_rate] a second.
+    Polls are limited to [poll_rate] a second. Feeds that can't start yet wait their turn in the order they
+    became due, only the one at the front of the queue is ever let through. None means no limit.
+
+    These limits are for all the validators together, see Dispatcher.reserve for each validator's own.
+    """
+    def __init__(self, max_in_flight=None, start_rate=None, start_burst=1, poll_rate=None, poll_burst=1, clock=None):
+        super(AdmissionController, self).__init__()
+        self.clock = clock if clock is not None else system_clock
+        self.max_in_flight = max_in_flight
+        self.starts = TokenBucket(start_rate, start_burst) if start_rate else None
+        self.polls = TokenBucket(poll_rate, poll_burst) if poll_rate else None
+
+        self.waiting = deque() # Endpoints of the feeds waiting to start, in the order they became due.
+        self.queued_at = {}
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+        metrics.gauge('flmx_admission_queue_depth', 'Feeds waiting for their validation to be let through to the validator', lambda: len(self.waiting))
+
+    def admit(self, feed, now=None, reserve=None):
+        """Try to let [feed]'s validation start, returning whether it can and if not how many seconds until it
+        should try again, None meaning it will be woken up when it is at the front of the queue with a free slot.
+
+        [reserve], if given, is asked last for a validator to take the validation, see Dispatcher.reserve.
+        """
+        now = self.clock.time() if now is None else now
+        with self.lock:
+            if feed.endpoint not in self.queued_at:
+                self.waiting.append(feed.endpoint)
+                self.queued_at[feed.endpoint] = now
+
+            if self.waiting[0] != feed.endpoint:
+                return False, None
+            if self.max_in_flight is not None and len(self.in_flight) >= self.max_in_flight:
+                return False, None
+            if self.starts is not None:
+                retry = self.starts.wait(now)
+                if retry:
+                    return False, retry
+            if reserve is not None:
+                retry = reserve(feed, now)
+                if retry is None or retry:
+                    return False, retry
+            if self.starts is not None:
+                self.starts.take(now)
+
+            self.waiting.popleft()
+            waited = now - self.queued_at.pop(feed.endpoint)
+            self.in_flight.add(feed.endpoint)
+
+        metrics.histogram('flmx_admission_wait_seconds', 'Seconds feeds waited for their validation to be let through').observe(waited)
+        if waited:
+            logger.debug("Validation of {0} [{1}] let through after waiting {2:.1f} seconds".format(feed.name, feed.endpoint, waited))
+        return True, None
+
+    def occupy(self, feed):
+        """Count a validation that was already running, such as one picked back up after a restart"""
+        with self.lock:
+            self.in_flight.add(feed.endpoint)
+
+    def release(self, feed):
+        """[feed]'s validation is over one way or another, freeing up its slot"""
+        with self.lock:
+            self.in_flight.discard(feed.endpoint)
+
+    def forget(self, endpoint):
+        """Stop counting or queueing the feed at [endpoint]"""
+        with self.lock:
+            self.in_flight.discard(endpoint)
+            if self.queued_at.pop(endpoint, None) is not None:
+                self.waiting.remove(endpoint)
+
+    def next_waiting(self):
+        """Endpoint of the feed at the front of the queue, if there is one and it could be let through"""
+        with self.lock:
+            if not self.waiting:
+                return None
+            if self.max_in_flight is not None and len(self.in_flight) >= self.max_in_flight:
+                return None
+            return self.waiting[0]
+
+    def poll(self, now=None):
+        """Take a poll token, returning 0 if one was free, otherwise the seconds to wait before polling"""
+        if self.polls is None:
+            return 0
+        with self.lock:
+            return self.polls.take(self.clock.time() if now is None else now)
@@ -1,17 +1,128 @@
 VERSION = "1.1"
 
-import os, sys, time, traceback, json, re, logging, logging.handlers
+import os, sys, time, traceback, json, re, codecs, weakref, threading, logging
+from optparse import OptionParser
 from datetime import timedelta, datetime
-import requests, jsonschema
-from notify import Emailer
+import requests, requests.adapters, jsonschema
+from notify import Emailer, parse_recipients
+from scheduler import Scheduler
+from receiver import ResultsReceiver
+from store import StateStore
+from dispatch import Dispatcher
+from admission import AdmissionController
+from breaker import CircuitBreaker, CircuitBreakers, CircuitOpenError
+from metrics import metrics, MetricsServer
+from logs import LogPipeline
+from results import ResultsReader, StreamedResults, Spool, IssueSorter, IssueFile
+from clock import system_clock
+from shard import LeaseStore, ShardCoordinator
+from batch import run_once
+
+class SchemaRegistry(object):
+    """Loads, checks and compiles each json schema in [schema_dir] once, reusing the compiled validator after that"""
+    def __init__(self, schema_dir):
+        super(SchemaRegistry, self).__init__()
+        self.schema_dir = schema_dir
+        self.validators = {}
+        self.lock = threading.Lock()
+
+    def load(self, name):
+        with open(os.path.join(self.schema_dir, '{0}.json'.format(name)), "r") as schema_file:
+            return json.load(schema_file)
+
+    def structural(self, schema):
+        """Copy of [schema] that still checks the shape of a document but not every item in its arrays"""
+        schema = dict(schema)
+        schema.pop('items', None)
+        if 'properties' in schema:
+            schema['properties'] = dict((key, self.structural(value)) for key, value in schema['properties'].items())
+        return schema
+
+    def validator(self, name, structural_only=False):
+        key = (name, structural_only)
+        if key not in self.validators:
+            with self.lock:
+                if key not in self.validators:
+                    schema = self.load(name)
+                    if structural_only:
+                        schema = self.structural(schema)
+                    jsonschema.Draft4Validator.check_schema(schema)
+                    self.validators[key] = jsonschema.Draft4Validator(schema)
+        return self.validators[key]
+
+    def validate(self, name, instance, structural_only=False):
+        self.validator(name, structural_only).validate(instance)
+
+schemas = SchemaRegistry("{0}/schemas".format(os.path.dirname(os.path.realpath(__file__))))
+
+# Only a timeout reading the response means the validator got a request. Before requests 2.4 (the pinned 1.2 for one)
+# every timeout is a plain Timeout, so there's no telling a connect timeout apart and any timeout has to do.
+ReadTimeout = getattr(requests.exceptions, 'ReadTimeout', requests.exceptions.Timeout)
 
 class Validator(object):
     """Represents a Validator as stored in the json settings file"""
-    def __init__(self, endpoint, username, password):
+    def __init__(self, endpoint, username, password, pool_size=10, retries=2, backoff=0.5, start_timeout=1, poll_timeout=10, structural_threshold=None, weight=1, max_in_flight=None, start_rate=None, start_burst=1, breaker=None, spool_dir=None, sample_size=20, clock=None):
         super(Validator, self).__init__()
+        self.clock = clock if clock is not None else system_clock
         self.endpoint = endpoint
         self.username = username
         self.password = password
+        self.weight = weight
+        # Limits on this validator alone when there are several, applied by the Dispatcher.
+        self.max_in_flight = max_in_flight
+        self.start_rate = start_rate
+        self.start_burst = start_burst
+        self.retries = retries
+        self.backoff = backoff
+        self.start_timeout = start_timeout
+        self.poll_timeout = poll_timeout
+        self.structural_threshold = structural_threshold
+
+        # Results are read a bit at a time and kept in [spool_dir] rather than in memory, if there is one.
+        self.spool_dir = spool_dir
+        self.sample_size = sample_size
+        if spool_dir is not None and not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+
+        # Stop sending the validator requests for a while when it can't be reached.
+        self.breaker = breaker if breaker is not None else CircuitBreaker('validator', endpoint)
+
+        # Keep connections to the validator alive and share them between the scheduler's workers.
+        self.session = requests.Session()
+        self.session.auth = (self.username, self.password)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, payload, timeout, retry_on, stream=False):
+        """GET the validator endpoint, retrying with an exponential backoff when one of [retry_on] is raised.
+
+        Raises CircuitOpenError without making the request while the validator's circuit breaker is open.
+        """
+        retry = self.breaker.allow()
+        if retry:
+            raise CircuitOpenError(self.endpoint, retry)
+
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(self.endpoint, params = payload, timeout = timeout, stream = stream)
+            except retry_on:
+                if attempt >= self.retries:
+                    self.breaker.failed()
+                    raise
+                time.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+            except ReadTimeout:
+                # Not one to retry on, so it's what we were expecting, starting a validation that is.
+                self.breaker.succeeded()
+                raise
+            else:
+                if response.status_code >= 500:
+                    self.breaker.failed()
+                else:
+                    self.breaker.succeeded()
+                return response
 
     def start(self, feed):
         payload = {
@@ -22,76 +133,178 @@ class Validator(object):
             "validation-type": "all-data",
         }
 
-        try:
-            # We just assume this is going to timeout and move to polling the results endpoint
-            requests.get(self.endpoint, auth = (self.username, self.password), params = payload, timeout = 1)
-        except requests.exceptions.Timeout:
-            feed.validation_start_time = datetime.now()
+        with metrics.timer('flmx_validator_start_seconds', 'Time taken sending validation requests'):
+            try:
+                # We just assume this is going to timeout and move to polling the results endpoint. Where there is
+                # a ConnectTimeout it is a ConnectionError as well, so it is retried rather than taken as a start.
+                self.get(payload, self.start_timeout, (requests.exceptions.ConnectionError,))
+            except ReadTimeout:
+                feed.validation_start_time = self.clock.now()
 
     def poll_results(self, feed):
-        validation_finished = False
-        total_issues = 0
-        response_json = None
         payload = {
             "validation-type": "all-data",
             "results": feed.endpoint,
             "json": 1,
         }
 
-        response = requests.get(self.endpoint, auth = (self.username, self.password), params = payload, timeout = 10)
-        if response.status_code == 200:
+        with metrics.timer('flmx_validator_poll_seconds', 'Time taken polling for validation results'):
+            response = self.get(payload, self.poll_timeout, (requests.exceptions.ConnectionError, requests.exceptions.Timeout), stream=self.spool_dir is not None)
+            if response.status_code != 200:
+                response.close()
+                raise requests.exceptions.HTTPError('Validator responded {0} to the results request for {1}'.format(response.status_code, feed.endpoint), response=response)
+            streamed = self.stream_results(feed, response) if self.spool_dir is not None else None
+
+        if self.spool_dir is not None and streamed is None:
+            # Still the results of the validation before.
+            return False, False, 0, None
+        elif streamed is not None:
+            validation_finished, total_issues, response_json = self.check_results(feed, streamed)
+        else:
             validation_finished, total_issues, response_json = self.handle_results_response(feed, response.text)
 
         return validation_finished, total_issues == 0, total_issues, response_json
 
+    def stream_results(self, feed, response):
+        """Read the results in [response] a chunk at a time, spooling them to disk as they come, along with their
+        issues sorted for comparing with the next results.
+
+        Returns None, keeping nothing, if they turn out to be the results of an earlier validation.
+        """
+        reader = ResultsReader(self.sample_size, IssueSorter(self.spool_dir))
+        spool = Spool(self.spool_dir, feed.endpoint)
+        issues = IssueFile(self.spool_dir, feed.endpoint)
+        text = codecs.getincrementaldecoder('utf-8')()
+        try:
+            for chunk in response.iter_content(65536):
+                spool.write(chunk)
+                reader.feed(text.decode(chunk))
+                if self.finished(feed, reader.results) is False:
+                    # No need to read the rest, or to swap them in for the last finished results.
+                    spool.discard()
+                    reader.sorter.discard()
+                    return None
+            reader.feed(text.decode(b'', True))
+            results = reader.close()
+            if self.finished(feed, results) is False:
+                spool.discard()
+                reader.sorter.discard()
+                return None
+            results.error_fingerprint, results.warning_fingerprint = reader.sorter.commit(issues.path)
+        except Exception:
+            spool.discard()
+            reader.sorter.discard()
+            raise
+        finally:
+            response.close()
+
+        results.spool_path = spool.commit()
+        results.issues = issues
+        return results
+
     def handle_results_response(self, feed, response):
+        # Checking every error and warning of a huge result is slow, so only check the shape of those.
+        structural_only = self.structural_threshold is not None and len(response) > self.structural_threshold
+        return self.check_results(feed, json.loads(response), structural_only)
+
+    def finished(self, feed, response_json):
+        """Whether [response_json] are the results of [feed]'s validation rather than one before, None if they
+        don't say when they are from, yet"""
+        test_time = response_json.get('test-time')
+        if not isinstance(test_time, (int, float)) or isinstance(test_time, bool):
+            return None
+        return datetime.fromtimestamp(test_time) > feed.validation_start_time
+
+    def check_results(self, feed, response_json, structural_only=False):
         validation_finished = False
         total_issues = 0
-        response_json = json.loads(response)
 
-        with open("{0}/schemas/results.json".format(os.path.dirname(os.path.realpath(__file__))), "r") as schema_file:
-            jsonschema.validate(response_json, json.load(schema_file))
+        with metrics.timer('flmx_schema_validation_seconds', 'Time taken checking validation results against the results schema'):
+            schemas.validate('results', response_json, structural_only)
 
-        if datetime.fromtimestamp(response_json['test-time']) > feed.validation_start_time:
+        if self.finished(feed, response_json):
             validation_finished = True
-            feed.last_validated = datetime.now()
+            feed.last_validated = self.clock.now()
             feed.validation_start_time = None
 
-            if feed.ignore_warnings:
+            if feed.ignore_warnings and isinstance(response_json, StreamedResults):
+                total_issues = response_json.error_count
+            elif feed.ignore_warnings:
                 total_issues = len(response_json['validation-results']['errors']) if 'errors' in response_json['validation-results'] else 0
             else:
                 total_issues = int(response_json['total-issue-count'])
 
         return validation_finished, total_issues, response_json
 
+class Credentials(object):
+    """A feed's username and password, shared between the feeds that use the same ones"""
+    __slots__ = ('username', 'password', '__weakref__')
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+shared_credentials = weakref.WeakValueDictionary()
+shared_next_tries = {}
+shared_lock = threading.Lock()
+
+def parse_credentials(username, password):
+    with shared_lock:
+        credentials = shared_credentials.get((username, password))
+        if credentials is None:
+            credentials = shared_credentials[(username, password)] = Credentials(username, password)
+        return credentials
+
+def parse_next_try(next_try):
+    """[next_try] as a timedelta, the same one for every feed with the same next_try"""
+    with shared_lock:
+        if next_try in shared_next_tries:
+            return shared_next_tries[next_try]
+
+    result = re.match('^(\d+)([m|M|h|H|d|D])$', next_try)
+    if result:
+        duration = int(result.group(1))
+        period = result.group(2).lower()
+
+        if duration == 0:
+            raise ValueError('Invalid next_try value provided. Valid format is [delta][m|h|d] (i.e "10m", "3h", "2d")')
+
+        duration_types = {"m": "minutes", "h": "hours", "d": "days"}
+        delta_kwargs = {}
+        delta_kwargs[duration_types[period]] = duration
+    else:
+        raise ValueError('Invalid next_try value provided. Valid format is [delta][m|h|d] (i.e "10m", "3h", "2d")')
+
+    with shared_lock:
+        return shared_next_tries.setdefault(next_try, timedelta(**delta_kwargs))
+
 class Feed(object):
-    """Represents a Feed as stored in the json settings file"""
+    """Represents a Feed as stored in the json settings file.
+
+    There can be a hundred thousand of these, so they have slots rather than a dict, and their credentials,
+    recipients and next_try are parsed once and shared with any other feeds that have the same ones.
+    """
+    __slots__ = ('name', 'endpoint', 'credentials', 'next_try', 'ignore_warnings', 'failure_email', 'last_validated', 'validation_start_time', 'validator_endpoint')
+
     def __init__(self, name, endpoint, username, password, next_try, ignore_warnings, failure_email):
         super(Feed, self).__init__()
         self.last_validated = None
         self.validation_start_time = None
+        self.validator_endpoint = None
         self.name = name
         self.endpoint = endpoint
-        self.username = username
-        self.password = password
-        self.failure_email = failure_email
+        self.credentials = parse_credentials(username, password)
+        self.failure_email = parse_recipients(failure_email)
         self.ignore_warnings = ignore_warnings
+        self.next_try = parse_next_try(next_try)
 
-        result = re.match('^(\d+)([m|M|h|H|d|D])$', next_try)
-        if result:
-            duration = int(result.group(1))
-            period = result.group(2).lower()
-
-            if duration == 0:
-                raise ValueError('Invalid next_try value provided. Valid format is [delta][m|h|d] (i.e "10m", "3h", "2d")')
+    @property
+    def username(self):
+        return self.credentials.username
 
-            duration_types = {"m": "minutes", "h": "hours", "d": "days"}
-            delta_kwargs = {}
-            delta_kwargs[duration_types[period]] = duration
-
-            self.next_try = timedelta(**delta_kwargs)
-        else:
-            raise ValueError('Invalid next_try value provided. Valid format is [delta][m|h|d] (i.e "10m", "3h", "2d")')
+    @property
+    def password(self):
+        return self.credentials.password
 
 class JsonSettings(object):
     def __init__(self, json_path):
@@ -100,8 +313,7 @@ class JsonSettings(object):
         self.validate()
 
     def validate(self):
-        with open("{0}/schemas/settings.json".format(os.path.dirname(os.path.realpath(__file__))), "r") as schema_file:
-            jsonschema.validate(self.json_data, json.load(schema_file))
+        schemas.validate('settings', self.json_data)
 
     def load(self, json_path):
         try:
@@ -113,83 +325,227 @@ class JsonSettings(object):
 
         return json_data
 
+class SettingsWatcher(object):
+    """Watches the json settings file for changes, adding, removing and updating feeds on [scheduler] to match"""
+    def __init__(self, json_path, settings, scheduler, interval=10):
+        super(SettingsWatcher, self).__init__()
+        self.json_path = json_path
+        self.scheduler = scheduler
+        self.interval = interval
+        self.json_data = settings.json_data
+        self.mtime = os.stat(json_path).st_mtime
+
+    def check(self):
+        """Apply any changes made to the settings since they were last checked, returning whether there were any"""
+        logger = logging.getLogger('flmx-logger')
+        try:
+            mtime = os.stat(self.json_path).st_mtime
+        except OSError as e:
+            logger.error("Unable to check {0} for changes: {1}".format(self.json_path, e))
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+
+        # Check the whole file before changing anything so a bad edit leaves everything as it was.
+        try:
+            settings = JsonSettings(self.json_path)
+            current = dict((feed['endpoint'], feed) for feed in self.json_data['feeds'])
+            changed = []
+            for feed in settings.json_data['feeds']:
+                if current.get(feed['endpoint']) != feed:
+                    changed.append(Feed(**feed))
+            endpoints = set(feed['endpoint'] for feed in settings.json_data['feeds'])
+            if len(endpoints) != len(settings.json_data['feeds']):
+                raise ValueError('Every feed must have a different endpoint')
+        except Exception as e:
+            logger.error("Ignoring changes to {0}: {1}".format(self.json_path, e))
+            return False
+
+        for feed in changed:
+            if feed.endpoint in current:
+                self.scheduler.update_feed(feed)
+                logger.info("Feed at endpoint {0} updated".format(feed.endpoint))
+            else:
+                self.scheduler.add_feed(feed)
+                logger.info("Feed at endpoint {0} initialised".format(feed.endpoint))
+        for endpoint in current:
+            if endpoint not in endpoints:
+                self.scheduler.remove_feed(endpoint)
+                logger.info("Feed at endpoint {0} removed".format(endpoint))
+
+        for key in set(self.json_data.keys()) | set(settings.json_data.keys()):
+            if key != 'feeds' and self.json_data.get(key) != settings.json_data.get(key):
+                logger.info("Changes to {0} in {1} need a restart to take effect".format(key, self.json_path))
+
+        self.json_data = settings.json_data
+        return True
+
+    def start(self):
+        def work():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.check()
+                except Exception as e:
+                    # Keep watching, the next change to the settings may well go through.
+                    logging.getLogger('flmx-logger').error("Unable to apply changes to {0}: {1}".format(self.json_path, e))
+                    logging.getLogger('flmx-logger').debug(traceback.format_exc())
+        thread = threading.Thread(target=work, name='flmx-settings-watcher')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+def settings_relative(settings_path, path):
+    """[path] from the settings at [settings_path], taken from the directory they are in if it is relative, so it
+    doesn't matter where we are run from"""
+    return os.path.join(os.path.dirname(os.path.abspath(settings_path)), path)
+
+def validator_settings(settings_path, v):
+    """The validator block [v] with its spool_dir, if any, taken from the directory the settings are in"""
+    if v.get('spool_dir') is not None:
+        v = dict(v, spool_dir=settings_relative(settings_path, v['spool_dir']))
+    return v
+
+def parse_options(args):
+    parser = OptionParser(usage="usage: python app.py [options] [settings.json] [log.out]")
+    parser.add_option("--once", action="store_true", default=False, help="validate every feed once and exit, non-zero if any of them failed")
+    parser.add_option("--feed", action="append", dest="feeds", metavar="FEED", help="with --once, only validate the feed with this name or endpoint, can be given more than once")
+    parser.add_option("--workers", type="int", default=32, help="with --once, feeds to start or poll at the same time [default: %default]")
+    parser.add_option("--timeout", type="float", default=3600, help="with --once, seconds to wait for the feeds to finish validating [default: %default]")
+    parser.add_option("--json", dest="json_path", metavar="PATH", help="with --once, write a json summary of the results to PATH, - for stdout")
+    parser.add_option("--junit", dest="junit_path", metavar="PATH", help="with --once, write the results as a JUnit xml report to PATH, - for stdout")
+    parser.add_option("--email", action="store_true", default=False, help="with --once, email the failures as well")
+    parser.add_option("--status", action="store_true", default=False, help="print the status of every worker sharing the feeds in the shard database as json and exit")
+    options, args = parser.parse_args(args)
+    if options.feeds and not options.once:
+        parser.error("--feed only works with --once")
+    return options, args
+
 def main():
     # Deal with the command line arguments
+    options, args = parse_options(sys.argv[1:])
     current_dir = os.path.dirname(os.path.realpath(__file__))
-    settings_path = sys.argv[1] if len(sys.argv) >= 2 else '{0}/settings.json'.format(current_dir)
-    log_path = sys.argv[2] if len(sys.argv) >= 3 else '{0}/flmx-validator.log'.format(current_dir)
-
-    # First off set up the logging.
-    logger = logging.getLogger('flmx-logger')
-    logger.setLevel(logging.DEBUG)
+    settings_path = args[0] if len(args) >= 1 else '{0}/settings.json'.format(current_dir)
+    log_path = args[1] if len(args) >= 2 else '{0}/flmx-validator.log'.format(current_dir)
 
-    handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=104857600, backupCount=3)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # First off set up the logging, records are written out to the log file from a background thread.
+    log_pipeline = LogPipeline(log_path)
+    logger = log_pipeline.logger
+    coordinator = None
 
     try:
         # Load json settings, either from command line argument or default location.
         settings = JsonSettings(settings_path)
+        log_pipeline.configure(**settings.json_data.get('logging', {}))
         logger.info("Settings loaded from {0}".format(settings_path))
 
-        # Setup validator, emailer and feeds.
-        validator = Validator(**settings.json_data['validator'])
+        shard_settings = settings.json_data.get('shard')
+        if options.status:
+            if shard_settings is None:
+                raise ValueError('--status needs a shard database in the settings')
+            sys.stdout.write(json.dumps(LeaseStore(shard_settings['path']).status(), indent=4, separators=(',', ': '), sort_keys=True) + '\n')
+            log_pipeline.stop()
+            sys.exit(0)
+
+        # Setup validator, emailer and feeds, each validator and feed has a circuit breaker for when it keeps failing.
+        breaker_settings = settings.json_data.get('breaker', {})
+        if isinstance(settings.json_data['validator'], list):
+            validator = Dispatcher([Validator(breaker=CircuitBreaker('validator', v['endpoint'], **breaker_settings), **validator_settings(settings_path, v)) for v in settings.json_data['validator']])
+        else:
+            v = validator_settings(settings_path, settings.json_data['validator'])
+            validator = Validator(breaker=CircuitBreaker('validator', v['endpoint'], **breaker_settings), **v)
         logger.info("Validator at endpoint {0} initialised".format(validator.endpoint))
 
         feeds = []
         for feed in settings.json_data['feeds']:
+            if options.once and options.feeds and feed['name'] not in options.feeds and feed['endpoint'] not in options.feeds:
+                continue
             f = Feed(**feed)
             feeds.append(f)
             logger.info("Feed at endpoint {0} initialised".format(f.endpoint))
 
-        emailer = Emailer(settings.json_data['email'])
+        if options.once and not feeds:
+            # Nothing to validate is a mistake on the command line, not a pass.
+            message = "No feeds in {0} match --feed {1}".format(settings_path, ", ".join(options.feeds)) if options.feeds else "No feeds in {0}".format(settings_path)
+            logger.error(message)
+            sys.stderr.write(message + '\n')
+            log_pipeline.stop()
+            sys.exit(2)
+
+        emailer = None
+        if not options.once or options.email:
+            emailer = Emailer(settings.json_data['email'])
+            emailer.start()
+
+        # Hold back starts and polls so the validator isn't flooded, after a restart say.
+        admission = AdmissionController(**settings.json_data.get('admission', {}))
+
+        if options.once:
+            # Validate everything straight away, as many feeds at once as allowed, rather than spreading them out.
+            scheduler_settings = settings.json_data.get('scheduler', {})
+            exit_code = run_once(validator, feeds, emailer, options.json_path, options.junit_path, options.timeout,
+                workers=max(min(options.workers, len(feeds)), 1), admission=admission,
+                breakers=CircuitBreakers('feed', **breaker_settings),
+                poll_interval=scheduler_settings.get('poll_interval', 60),
+                poll_max=scheduler_settings.get('poll_max', 1800),
+                poll_backoff=scheduler_settings.get('poll_backoff', 2))
+            log_pipeline.stop()
+            sys.exit(exit_code)
+
+        # If the validator can push results back to us, poll for them much less often.
+        receiver_settings = settings.json_data.get('receiver', {})
+        poll_fallback = receiver_settings.get('fallback_poll', 1800) if receiver_settings.get('enabled') else None
+
+        # Keep the state of each feed on disk so a restart carries on where it left off.
+        store = None
+        if 'state' in settings.json_data:
+            store = StateStore(settings_relative(settings_path, settings.json_data['state']['path']))
+            logger.info("Feed state stored in {0}".format(store.path))
 
         # Start validation loop.
-        while (True):
-            for feed in feeds:
-                # If feed is not currently being validated, and it was last validated longer than [next_try] ago, start validation.
-                if feed.validation_start_time is None and (feed.last_validated is None or datetime.now() > feed.last_validated + feed.next_try):
-                    logger.info("Sending validation request for {0} [{1}] to {2}".format(feed.name, feed.endpoint, validator.endpoint))
-                    validator.start(feed)
-
-                # Else if the validation must have started
-                elif feed.validation_start_time is not None:
-                    logger.info("Polling validation results for {0} [{1}] from {2}".format(feed.name, feed.endpoint, validator.endpoint))
-                    completed, success, total_issues, response_json = validator.poll_results(feed)
-
-                    # If the process has completed and the result was a failure, send an email notification.
-                    if completed:
-                        if not success:
-                            logger.info("Validation for {0} [{1}] resulted in errors, sending email to {2}".format(feed.name, feed.endpoint, feed.failure_email))
-
-                            title = u'Validation failed for {feed} [{endpoint}] ({total_issues} {issues})'.format(
-                                    feed = feed.name,
-                                    endpoint = feed.endpoint,
-                                    total_issues = total_issues,
-                                    issues = "Issues" if total_issues > 1 else "Issue")
-                            body = json.dumps(response_json, indent=4, separators=(',', ': '), sort_keys=True)
-                            emailer.send(feed.failure_email, title, body)
-
-                            logger.info("Email sent to {0}".format(feed.failure_email))
-                        else:
-                            logger.info("Validation completed successfully for {0} [{1}]".format(feed.name, feed.endpoint))
-
-                    # Check to make sure we haven't hit some weird behaviour and have been stuck polling for > 6 hours.
-                    elif feed.last_validated is not None and datetime.now() > feed.last_validated + timedelta(hours=6):
-                        # If we have then let's just kick off another validation request.
-                        feed.validation_start_time = None
-                        logger.debug("Have been polling {0} for > 6 hours, must be a problem lets rinse and repeat.".format(feed.name))
-                        break
-
-            time.sleep(300) # Wait for a bit to try again, hopefully this should account for most differences in time between the executing and validation server too.
+        scheduler = Scheduler(validator, emailer, feeds if shard_settings is None else [], poll_fallback=poll_fallback, store=store, admission=admission,
+            breakers=CircuitBreakers('feed', **breaker_settings), **settings.json_data.get('scheduler', {}))
+        logger.info("Scheduler started with {0} workers".format(len(scheduler.pool.threads)))
+
+        # Share the feeds out with any other workers using the same shard database, each only validating its share.
+        if shard_settings is not None:
+            leases = LeaseStore(shard_settings['path'], shard_settings.get('worker_id'), shard_settings.get('lease', 60))
+            coordinator = ShardCoordinator(scheduler, leases, feeds, shard_settings.get('interval', 15))
+            coordinator.sync()
+            coordinator.start()
+            logger.info("Worker {0} sharing feeds through {1}".format(leases.worker_id, leases.path))
+
+        if receiver_settings.get('enabled'):
+            receiver = ResultsReceiver(scheduler, receiver_settings.get('host', '127.0.0.1'), receiver_settings.get('port', 8089))
+            receiver.start()
+            logger.info("Listening for validation results on {0}:{1}".format(*receiver.server_address))
+
+        metrics_settings = settings.json_data.get('metrics', {})
+        if 'port' in metrics_settings:
+            metrics_server = MetricsServer(metrics, metrics_settings.get('host', '127.0.0.1'), metrics_settings['port'], {'/issues': scheduler.issues.index.report})
+            metrics_server.start()
+            logger.info("Serving metrics on {0}:{1}".format(*metrics_server.server_address))
+        if metrics_settings.get('summary_interval'):
+            metrics.log_summaries(metrics_settings['summary_interval'])
+
+        reload_settings = settings.json_data.get('reload', {})
+        if reload_settings.get('enabled'):
+            SettingsWatcher(settings_path, settings, coordinator if coordinator is not None else scheduler, reload_settings.get('interval', 10)).start()
+            logger.info("Watching {0} for changes to feeds".format(settings_path))
+
+        scheduler.run()
 
     except Exception as e:
         logger.debug("Unhandled exception occured: {0}".format(e))
         logger.debug(traceback.format_exc())
         logger.debug("Closing application.")
+        if coordinator is not None:
+            coordinator.stop()
+        log_pipeline.stop()
 
-        sys.exit()
+        # A batch run that couldn't finish mustn't look like one where every feed passed.
+        sys.exit(2 if options.once or options.status else None)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,120 @@
+import sys, time, json, logging
+from datetime import datetime, timedelta
+from xml.etree import ElementTree
+from scheduler import Scheduler, seconds
+from breaker import CircuitBreaker
+from issues import read_issues
+
+logger = logging.getLogger('flmx-logger')
+
+class BatchScheduler(Scheduler):
+    """Validates each feed once, all in parallel, keeping the outcome of each instead of carrying on forever.
+
+    A feed whose circuit breaker opens is given up on, as are any still going after [timeout] seconds.
+    Failure emails are only sent if there is an [emailer].
+    """
+    def __init__(self, validator, emailer, feeds, **kwargs):
+        self.results = {}
+        self.started = {}
+        Scheduler.__init__(self, validator, emailer, feeds, **kwargs)
+
+    def attempt(self, feed):
+        self.started.setdefault(feed.endpoint, time.time())
+        due = Scheduler.attempt(self, feed)
+        if feed.endpoint in self.results:
+            return None
+
+        breaker = self.breakers.get(feed.endpoint)
+        if breaker is not None and breaker.state == CircuitBreaker.OPEN:
+            self.finish(feed, 'error', message='Gave up after {0} failures in a row, see the log for details'.format(breaker.failed_count))
+            return None
+        return due
+
+    def complete(self, feed, success, total_issues, response_json):
+        Scheduler.complete(self, feed, success, total_issues, response_json)
+        errors, warnings = read_issues(feed, response_json)
+        self.finish(feed, 'passed' if success else 'failed', total_issues, sorted(errors), sorted(warnings))
+
+    def notify(self, feed, total_issues, response_json, changes):
+        if self.emailer is not None:
+            Scheduler.notify(self, feed, total_issues, response_json, changes)
+
+    def finish(self, feed, result, total_issues=0, errors=(), warnings=(), message=None):
+        with self.condition:
+            self.results[feed.endpoint] = {
+                "name": feed.name,
+                "endpoint": feed.endpoint,
+                "result": result,
+                "total_issues": total_issues,
+                "errors": list(errors),
+                "warnings": list(warnings),
+                "message": message,
+                "seconds": round(time.time() - self.started.get(feed.endpoint, time.time()), 1),
+            }
+            self.condition.notify()
+
+    def run(self, timeout=None):
+        """Validate every feed, returning the result of each in the order the feeds were given"""
+        deadline = datetime.now() + timedelta(seconds=timeout) if timeout is not None else None
+        with self.condition:
+            while len(self.results) < len(self.feeds):
+                now = datetime.now()
+                if deadline is not None and now >= deadline:
+                    break
+                for feed in self.pop_due(now):
+                    self.pool.submit(self.dispatch, feed)
+
+                # Sleep until the next feed is due, something finishes or we run out of time.
+                wake = [due for due in (self.queue[0][0] if self.queue else None, deadline) if due is not None]
+                self.condition.wait(max(0, seconds(min(wake) - now)) if wake else None)
+
+            for feed in self.feeds:
+                if feed.endpoint not in self.results:
+                    self.finish(feed, 'timeout', message='Still not finished after {0} seconds'.format(timeout))
+            return [self.results[feed.endpoint] for feed in self.feeds]
+
+def summary(results, elapsed):
+    """Counts of each outcome along with the result of every feed"""
+    counts = dict((outcome, len([r for r in results if r["result"] == outcome])) for outcome in ('passed', 'failed', 'error', 'timeout'))
+    return dict(counts, feeds=results, total=len(results), seconds=round(elapsed, 1))
+
+def junit(summary):
+    """The summary as a JUnit xml report, with a test case for each feed"""
+    suite = ElementTree.Element('testsuite', {
+        "name": "flmx-validator",
+        "tests": str(summary["total"]),
+        "failures": str(summary["failed"]),
+        "errors": str(summary["error"] + summary["timeout"]),
+        "time": str(summary["seconds"]),
+    })
+    for result in summary["feeds"]:
+        case = ElementTree.SubElement(suite, 'testcase', {"classname": "flmx-validator", "name": u"{0} [{1}]".format(result["name"], result["endpoint"]), "time": str(result["seconds"])})
+        if result["result"] == 'failed':
+            failure = ElementTree.SubElement(case, 'failure', {"message": u"{0} issues".format(result["total_issues"])})
+            failure.text = u"\n".join([u"Error: " + issue for issue in result["errors"]] + [u"Warning: " + issue for issue in result["warnings"]])
+        elif result["result"] in ('error', 'timeout'):
+            ElementTree.SubElement(case, 'error', {"message": result["message"], "type": result["result"]})
+    return ElementTree.tostring(suite)
+
+def write(path, content):
+    if path == '-':
+        sys.stdout.write(content + '\n')
+    else:
+        with open(path, 'w') as output:
+            output.write(content)
+
+def run_once(validator, feeds, emailer=None, json_path=None, junit_path=None, timeout=None, **kwargs):
+    """Validate [feeds] once, writing out the summary, returning the exit code: 0 if every feed passed, 1 if not"""
+    started = time.time()
+    scheduler = BatchScheduler(validator, emailer, feeds, **kwargs)
+    logger.info("Validating {0} feeds once with {1} workers".format(len(feeds), len(scheduler.pool.threads)))
+    report = summary(scheduler.run(timeout), time.time() - started)
+    logger.info("Validated {total} feeds in {seconds} seconds: {passed} passed, {failed} failed, {error} errors and {timeout} timed out".format(**report))
+
+    if emailer is not None:
+        emailer.flush()
+    if json_path is not None:
+        write(json_path, json.dumps(report, indent=4, separators=(',', ': '), sort_keys=True))
+    if junit_path is not None:
+        write(junit_path, junit(report).decode('utf-8'))
+    return 0 if report["passed"] == report["total"] else 1
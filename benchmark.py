@@ -0,0 +1,299 @@
+"""Measures how the scheduler copes with many feeds, against a fake FLM validator and mail server running in-process.
+
+Run `python benchmark.py` for the default 10 / 1000 / 10000 feed runs, see `python benchmark.py --help` for the options.
+`python benchmark.py --memory --feeds 100000` measures the memory each feed takes instead.
+"""
+import os, sys, gc, time, json, math, random, resource, threading, subprocess, logging
+from optparse import OptionParser
+from datetime import datetime
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from app import Validator, Feed
+from notify import Emailer
+from scheduler import Scheduler
+
+class FakeValidatorHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        params = dict((key, values[0]) for key, values in parse_qs(urlparse(self.path).query).items())
+        time.sleep(server.latency)
+
+        if 'results' in params:
+            server.count('polls')
+            if random.random() < server.error_rate:
+                return self.reply(500, 'Fake validator error')
+            return self.reply(200, json.dumps(server.results(params['results'])))
+
+        server.count('starts')
+        server.start_job(params['url'])
+        # The real validator doesn't answer until the validation is done, clients give up and poll instead.
+        time.sleep(server.start_hang)
+        self.reply(200, '')
+
+    def reply(self, status, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except IOError:
+            pass # The client stopped waiting, which is what is meant to happen for a start.
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeValidator(ThreadingMixIn, HTTPServer):
+    """Implements the start and results (json=1) requests Validator makes, with jobs that take [job_duration] seconds"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, job_duration=2, latency=0, error_rate=0, result_size=10, start_hang=0.5, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), FakeValidatorHandler)
+        self.job_duration = job_duration
+        self.latency = latency
+        self.error_rate = error_rate
+        self.result_size = result_size
+        self.start_hang = start_hang
+        self.jobs = {}
+        self.counts = {'starts': 0, 'polls': 0}
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return 'http://{0}:{1}/validator'.format(*self.server_address)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def start_job(self, url):
+        # Vary each job's duration a little so the feeds don't all finish together.
+        duration = self.job_duration * random.uniform(0.5, 1.5)
+        with self.lock:
+            self.jobs[url] = time.time() + duration
+
+    def results(self, url):
+        with self.lock:
+            finish = self.jobs.get(url)
+
+        # Until the job is done the last results, from well before this validation started, are handed back.
+        finished = finish is not None and time.time() >= finish
+        test_time = int(math.ceil(finish)) if finished else 0
+        errors = ['Fake error {0} for {1}'.format(i, url) for i in range(self.result_size)]
+        return {
+            "test-time": test_time,
+            "test-duration": int(self.job_duration),
+            "total-issue-count": len(errors),
+            "url": url,
+            "validation-type": "all-data",
+            "validation-results": {"errors": errors, "warnings": []},
+        }
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='fake-validator')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+class SmtpSinkHandler(StreamRequestHandler):
+    """Just enough of an smtp server to accept and count whatever is sent"""
+    def handle(self):
+        self.reply('220 localhost fake smtp sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                for data in iter(self.rfile.readline, b''):
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data)
+                self.server.received(size)
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+class SmtpSink(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        TCPServer.__init__(self, (host, port), SmtpSinkHandler)
+        self.messages = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def received(self, size):
+        with self.lock:
+            self.messages += 1
+            self.bytes += size
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='smtp-sink')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+class StartingValidator(object):
+    """Stands in for Validator without making any requests, every validation starting straight away"""
+    endpoint = 'starting'
+
+    def start(self, feed):
+        feed.validation_start_time = datetime.now()
+
+class CountingScheduler(Scheduler):
+    """Scheduler that keeps count of the validations it has seen through"""
+    def __init__(self, *args, **kwargs):
+        Scheduler.__init__(self, *args, **kwargs)
+        self.completed = 0
+        self.count_lock = threading.Lock()
+
+    def complete(self, feed, success, total_issues, response_json):
+        Scheduler.complete(self, feed, success, total_issues, response_json)
+        with self.count_lock:
+            self.completed += 1
+
+def run(feeds, options):
+    """Validate [feeds] fake feeds for [options.duration] seconds, returning what was measured"""
+    validator_server = FakeValidator(options.job_duration, options.latency, options.error_rate, options.result_size, options.start_timeout * 2)
+    validator_server.start()
+    sink = SmtpSink()
+    sink.start()
+
+    validator = Validator(validator_server.endpoint, 'username', 'password', pool_size=options.workers, retries=0, start_timeout=options.start_timeout)
+    emailer = Emailer({"host": sink.server_address[0], "port": sink.server_address[1], "sender": "flmx-validator@example.com", "digest_window": 0})
+    emailer.start()
+
+    memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    feed_list = [Feed('Feed {0}'.format(i), 'http://feed{0}.example.com/FLM/'.format(i), 'username', 'password', options.next_try, False, {"to": ["flmx-failures@example.com"]}) for i in range(feeds)]
+    scheduler = CountingScheduler(validator, emailer, feed_list, workers=options.workers, poll_interval=options.poll_interval, poll_max=options.poll_interval * 8)
+
+    thread = threading.Thread(target=scheduler.run, name='scheduler')
+    thread.daemon = True
+    started = time.time()
+    thread.start()
+    time.sleep(options.duration)
+    elapsed = time.time() - started
+
+    return {
+        "feeds": feeds,
+        "seconds": round(elapsed, 1),
+        "validated": scheduler.completed,
+        "validated_per_hour": int(scheduler.completed * 3600 / elapsed),
+        "start_requests": validator_server.counts['starts'],
+        "poll_requests": validator_server.counts['polls'],
+        "polls_per_validation": round(validator_server.counts['polls'] / float(max(scheduler.completed, 1)), 2),
+        "emails": sink.messages,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "rss_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory_before,
+    }
+
+def memory_used():
+    """Bytes allocated by python if tracemalloc is there to count them, otherwise the peak resident set size"""
+    gc.collect()
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[0]
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure_memory(feeds, options):
+    """Bytes each of [feeds] feeds takes once loaded from the settings, and once they are scheduled and have had their
+    validations started, with everything the scheduler keeps for a feed from then on.
+
+    The feeds are loaded from json the way the settings file is, sharing 50 usernames and passwords, 100 sets of
+    failure email recipients and 3 next_try values between them. The name and endpoint strings belong to the settings,
+    so aren't counted.
+    """
+    settings = json.loads(json.dumps([{
+        "name": "Feed {0}".format(i),
+        "endpoint": "http://feed{0}.example.com/FLM/".format(i),
+        "username": "user{0}".format(i % 50),
+        "password": "password{0}".format(i % 50),
+        "next_try": ["1h", "6h", "1d"][i % 3],
+        "ignore_warnings": False,
+        "failure_email": {"to": ["flmx-failures-{0}@example.com".format(i % 100)], "cc": "ops@example.com, noc@example.com"},
+    } for i in range(feeds)]))
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+    before = memory_used()
+    feed_list = [Feed(**feed) for feed in settings]
+    loaded = memory_used()
+    scheduler = Scheduler(StartingValidator(), None, feed_list, workers=1)
+    scheduler.tick()
+    scheduled = memory_used()
+    if tracemalloc is not None:
+        tracemalloc.stop()
+
+    return {
+        "feeds": feeds,
+        "bytes_per_feed": int((loaded - before) / feeds),
+        "bytes_per_scheduled_feed": int((scheduled - before) / feeds),
+        "total_mb": round((scheduled - before) / 1048576.0, 1),
+        "measured_with": "tracemalloc" if tracemalloc is not None else "max_rss",
+    }
+
+def parse_options(args):
+    parser = OptionParser(usage="usage: python benchmark.py [options]")
+    parser.add_option("--feeds", default="10,1000,10000", help="comma separated feed counts to run, each in its own process [default: %default]")
+    parser.add_option("--duration", type="float", default=60, help="seconds to run each feed count for [default: %default]")
+    parser.add_option("--workers", type="int", default=16, help="scheduler workers [default: %default]")
+    parser.add_option("--next-try", default="1m", help="next_try for every feed [default: %default]")
+    parser.add_option("--poll-interval", type="int", default=1, help="scheduler poll_interval in seconds [default: %default]")
+    parser.add_option("--start-timeout", type="float", default=0.1, help="validator start_timeout in seconds [default: %default]")
+    parser.add_option("--job-duration", type="float", default=2, help="average seconds each fake validation takes [default: %default]")
+    parser.add_option("--latency", type="float", default=0, help="seconds the fake validator waits before answering [default: %default]")
+    parser.add_option("--error-rate", type="float", default=0, help="fraction of polls the fake validator fails [default: %default]")
+    parser.add_option("--result-size", type="int", default=10, help="errors in every fake result [default: %default]")
+    parser.add_option("--memory", action="store_true", default=False, help="measure the memory taken by each feed rather than running them")
+    return parser.parse_args(args)
+
+def main():
+    options, args = parse_options(sys.argv[1:])
+    logging.getLogger('flmx-logger').addHandler(logging.StreamHandler())
+    logging.getLogger('flmx-logger').setLevel(logging.WARNING)
+
+    counts = [int(count) for count in options.feeds.split(',')]
+    if len(counts) == 1:
+        sys.stdout.write(json.dumps((measure_memory if options.memory else run)(counts[0], options)) + '\n')
+        return
+
+    # Run each feed count in a fresh process so their threads and memory use don't affect each other.
+    columns = ["feeds", "validated", "validated_per_hour", "start_requests", "poll_requests", "polls_per_validation", "emails", "max_rss_kb"]
+    if options.memory:
+        columns = ["feeds", "bytes_per_feed", "bytes_per_scheduled_feed", "total_mb"]
+    sys.stdout.write(" ".join(column.rjust(20) for column in columns) + '\n')
+    for count in counts:
+        argv = [sys.executable, os.path.realpath(__file__)] + sys.argv[1:] + ['--feeds', str(count)]
+        output = subprocess.Popen(argv, stdout=subprocess.PIPE).communicate()[0]
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        sys.stdout.write(" ".join(str(result[column]).rjust(20) for column in columns) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import threading, logging
+from metrics import metrics
+from clock import system_clock
+
+logger = logging.getLogger('flmx-logger')
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request through an open circuit breaker"""
+    def __init__(self, name, retry):
+        super(CircuitOpenError, self).__init__('Circuit for {0} is open, retrying in {1:.0f} seconds'.format(name, retry))
+        self.retry = retry
+
+class CircuitBreaker(object):
+    """Stops trying something that keeps failing, checking now and again whether it has come back.
+
+    Closed, everything goes through. After [failures] failures in a row it opens and nothing goes through for
+    [cooldown] seconds. Then it is half-open, letting a single attempt through: if that works it closes again,
+    if not it opens for twice as long as the time before, up to [cooldown_max] seconds.
+    """
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half-open', 'open'
+    states = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, kind, name, failures=3, cooldown=60, cooldown_max=3600, clock=None):
+        super(CircuitBreaker, self).__init__()
+        self.clock = clock if clock is not None else system_clock
+        self.kind = kind
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.cooldown_max = cooldown_max
+
+        self.state = self.CLOSED
+        self.failed_count = 0
+        self.opened_count = 0 # Times opened since it was last closed, for the exponential cool-down.
+        self.retry_at = 0
+        self.lock = threading.Lock()
+        self.set_state(self.CLOSED)
+
+    def set_state(self, state):
+        self.state = state
+        metrics.gauge('flmx_circuit_state', 'State of each circuit breaker, 0 closed, 1 half-open and 2 open').set(self.states[state], kind=self.kind, name=self.name)
+
+    def remaining(self, now=None):
+        """Seconds until an attempt would be let through, 0 if one would be now"""
+        now = self.clock.time() if now is None else now
+        with self.lock:
+            return max(0, self.retry_at - now) if self.state != self.CLOSED else 0
+
+    def allow(self, now=None):
+        """Ask to make an attempt, returning 0 if it can go ahead, otherwise the seconds until it could"""
+        now = self.clock.time() if now is None else now
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0
+            if now < self.retry_at:
+                return self.retry_at - now
+
+            # Let one attempt through, anything else waits for it. Should it never report back, let another one
+            # through after a while.
+            if self.state == self.OPEN:
+                self.set_state(self.HALF_OPEN)
+                logger.info("Circuit for {0} {1} is half-open, trying it again".format(self.kind, self.name))
+            self.retry_at = now + self.cooldown
+            return 0
+
+    def succeeded(self):
+        with self.lock:
+            self.failed_count = 0
+            if self.state != self.CLOSED:
+                self.opened_count = 0
+                self.retry_at = 0
+                self.set_state(self.CLOSED)
+                logger.info("Circuit for {0} {1} is closed again".format(self.kind, self.name))
+
+    def failed(self, now=None):
+        now = self.clock.time() if now is None else now
+        with self.lock:
+            self.failed_count += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failed_count >= self.failures):
+                cooldown = min(self.cooldown * (2 ** self.opened_count), self.cooldown_max)
+                self.opened_count += 1
+                self.retry_at = now + cooldown
+                self.set_state(self.OPEN)
+                metrics.counter('flmx_circuit_opened_total', 'Times a circuit breaker has opened').inc(kind=self.kind)
+                logger.warning("Circuit for {0} {1} opened after {2} failures in a row, trying again in {3} seconds".format(self.kind, self.name, self.failed_count, cooldown))
+
+class CircuitBreakers(object):
+    """A CircuitBreaker for each of a kind of thing, made the first time one of them fails and dropped once it has
+    closed again, so the things that are working, most of them, don't need one"""
+    def __init__(self, kind, failures=3, cooldown=60, cooldown_max=3600, clock=None):
+        super(CircuitBreakers, self).__init__()
+        self.kind = kind
+        self.settings = {'failures': failures, 'cooldown': cooldown, 'cooldown_max': cooldown_max, 'clock': clock}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """The breaker for [name], None if it hasn't failed since it last worked"""
+        with self.lock:
+            return self.breakers.get(name)
+
+    def allow(self, name):
+        breaker = self.get(name)
+        return breaker.allow() if breaker is not None else 0
+
+    def remaining(self, name):
+        breaker = self.get(name)
+        return breaker.remaining() if breaker is not None else 0
+
+    def failed(self, name):
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(self.kind, name, **self.settings)
+            breaker = self.breakers[name]
+        breaker.failed()
+
+    def succeeded(self, name):
+        breaker = self.get(name)
+        if breaker is not None:
+            breaker.succeeded()
+            self.forget(name)
+
+    def forget(self, name):
+        with self.lock:
+            if self.breakers.pop(name, None) is not None:
+                metrics.gauge('flmx_circuit_state').remove(kind=self.kind, name=name)
@@ -0,0 +1,32 @@
+import time, calendar
+from datetime import datetime, timedelta
+
+class Clock(object):
+    """Where the scheduler, and everything it uses, gets the time from"""
+    def now(self):
+        return datetime.now()
+
+    def time(self):
+        return time.time()
+
+class VirtualClock(Clock):
+    """A clock that only moves when it is told to, starting at the datetime [start]"""
+    def __init__(self, start=None):
+        super(VirtualClock, self).__init__()
+        self.current = start if start is not None else datetime.now()
+
+    def now(self):
+        return self.current
+
+    def time(self):
+        # Only ever compared with other times from this clock, so it doesn't matter which timezone it's taken to be in.
+        return calendar.timegm(self.current.timetuple()) + self.current.microsecond / 1000000.0
+
+    def advance(self, seconds):
+        self.current += timedelta(seconds=max(0, seconds))
+
+    def advance_to(self, when):
+        """Move on to the datetime [when], if it is still to come"""
+        self.current = max(self.current, when)
+
+system_clock = Clock()
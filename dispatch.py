@@ -0,0 +1,136 @@
+import threading, logging
+from admission import TokenBucket
+
+logger = logging.getLogger('flmx-logger')
+
+class LostValidationError(Exception):
+    """Raised when a validation was started on a validator that is no longer configured, so can't be polled"""
+    def __init__(self, endpoint, validator_endpoint):
+        super(LostValidationError, self).__init__('The validation of {0} was started on {1}, which is not one of the configured validators'.format(endpoint, validator_endpoint))
+        self.endpoint = endpoint
+        self.validator_endpoint = validator_endpoint
+
+class Dispatcher(object):
+    """Spreads feed validations over several validators, standing in for a single Validator.
+
+    New validations go to the validator with the fewest outstanding jobs for its weight. A feed is always polled
+    on the validator its validation was started on. A validator whose circuit breaker is open, because it keeps
+    failing, gets no new validations until the breaker lets a request through again. Nor does one that is running
+    its [max_in_flight] validations, or has started them faster than its [start_rate], see reserve.
+    """
+    def __init__(self, validators):
+        super(Dispatcher, self).__init__()
+        if not validators:
+            raise ValueError('At least one validator is needed to dispatch validations to')
+
+        self.validators = validators
+        self.by_endpoint = dict((validator.endpoint, validator) for validator in validators)
+
+        self.assigned = {} # Feed endpoint to the validator running its validation.
+        self.outstanding = dict((validator.endpoint, 0) for validator in validators)
+        self.starts = dict((validator.endpoint, TokenBucket(validator.start_rate, validator.start_burst)) for validator in validators if validator.start_rate)
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return ", ".join(validator.endpoint for validator in self.validators)
+
+    def choose(self, validators=None):
+        """The validator out of [validators], all of them by default, that should take the next validation"""
+        validators = validators if validators is not None else self.validators
+        available = [validator for validator in validators if not validator.breaker.remaining()]
+        if not available:
+            # Every breaker is open, so fall back on whichever validator comes back soonest.
+            return min(validators, key=lambda validator: validator.breaker.remaining())
+        return min(available, key=lambda validator: self.outstanding[validator.endpoint] / float(validator.weight))
+
+    def reserve(self, feed, now):
+        """Set aside a validator for [feed]'s validation, within its own limits, for start to use. Returns 0 if one
+        was, otherwise the seconds until one could be, or None if they are all busy until a validation finishes.
+
+        Called by the AdmissionController once the limits on all the validators together let [feed] through.
+        """
+        with self.lock:
+            free = [validator for validator in self.validators
+                    if validator.max_in_flight is None or self.outstanding[validator.endpoint] < validator.max_in_flight]
+            if not free:
+                return None
+            waits = [(self.starts[validator.endpoint].wait(now) if validator.endpoint in self.starts else 0, validator) for validator in free]
+            ready = [validator for wait, validator in waits if not wait]
+            if not ready:
+                return min(wait for wait, validator in waits)
+
+            validator = self.choose(ready)
+            if validator.endpoint in self.starts:
+                self.starts[validator.endpoint].take(now)
+            self.assign(feed, validator)
+            return 0
+
+    def assign(self, feed, validator):
+        previous = self.assigned.get(feed.endpoint)
+        if previous is not None:
+            self.outstanding[previous.endpoint] -= 1
+        self.assigned[feed.endpoint] = validator
+        self.outstanding[validator.endpoint] += 1
+        feed.validator_endpoint = validator.endpoint
+
+    def release(self, feed):
+        validator = self.assigned.pop(feed.endpoint, None)
+        if validator is not None:
+            self.outstanding[validator.endpoint] -= 1
+        feed.validator_endpoint = None
+
+    def validator_for(self, feed):
+        """The validator [feed]'s validation is running on, picking its state back up after a restart.
+
+        Raises LostValidationError if that validator isn't known, the job is lost and needs starting again.
+        """
+        with self.lock:
+            validator = self.assigned.get(feed.endpoint)
+            if validator is None:
+                validator = self.by_endpoint.get(feed.validator_endpoint)
+                if validator is None:
+                    raise LostValidationError(feed.endpoint, feed.validator_endpoint)
+                self.assign(feed, validator)
+            return validator
+
+    def forget(self, endpoint):
+        """Stop counting the validation of the feed at [endpoint] against its validator, the feed has gone"""
+        with self.lock:
+            validator = self.assigned.pop(endpoint, None)
+            if validator is not None:
+                self.outstanding[validator.endpoint] -= 1
+
+    def start(self, feed):
+        with self.lock:
+            validator = self.assigned.get(feed.endpoint)
+            if validator is None:
+                validator = self.choose()
+                self.assign(feed, validator)
+        logger.debug("Validation of {0} [{1}] assigned to {2}".format(feed.name, feed.endpoint, validator.endpoint))
+
+        try:
+            validator.start(feed)
+        finally:
+            if feed.validation_start_time is None:
+                with self.lock:
+                    self.release(feed)
+
+    def poll_results(self, feed):
+        results = self.validator_for(feed).poll_results(feed)
+        if results[0]:
+            with self.lock:
+                self.release(feed)
+        return results
+
+    def handle_results_response(self, feed, response):
+        try:
+            validator = self.validator_for(feed)
+        except LostValidationError:
+            # The results are here whichever validator they came from, any of them can read them.
+            validator = self.validators[0]
+        results = validator.handle_results_response(feed, response)
+        if results[0]:
+            with self.lock:
+                self.release(feed)
+        return results
@@ -0,0 +1,278 @@
+import re, heapq, hashlib, threading
+
+whitespace = re.compile(r'\s+')
+
+def normalize(issue):
+    """Tidy up an issue string so the same issue always reads the same"""
+    return whitespace.sub(u' ', issue).strip()
+
+class Fingerprint(object):
+    """Hash of a set of issue lines that doesn't depend on the order they were added in, the sum of the sha1 of each
+    line, so it can be worked out a line at a time"""
+    modulus = 1 << 160
+
+    def __init__(self, total=0):
+        super(Fingerprint, self).__init__()
+        self.total = total
+
+    def add(self, line):
+        self.total = (self.total + int(hashlib.sha1(line.encode('utf-8')).hexdigest(), 16)) % self.modulus
+
+    def __add__(self, other):
+        return Fingerprint((self.total + other.total) % self.modulus)
+
+    def hexdigest(self):
+        return '{0:040x}'.format(self.total)
+
+def fingerprint(errors, warnings):
+    """Hash of a set of issues that doesn't depend on the order they were reported in"""
+    total = Fingerprint()
+    for issue in errors:
+        total.add(u'E ' + issue)
+    for issue in warnings:
+        total.add(u'W ' + issue)
+    return total.hexdigest()
+
+def read_issues(feed, response_json):
+    """Normalised sets of the errors and warnings in a validation result, leaving out warnings if the feed ignores them.
+
+    Streamed results only hold a sample of their issues, so that is all there is of them, see StreamedResults.
+    """
+    results = response_json.get('validation-results', {})
+    errors = frozenset(normalize(issue) for issue in results.get('errors', []))
+    warnings = frozenset() if feed.ignore_warnings else frozenset(normalize(issue) for issue in results.get('warnings', []))
+    return errors, warnings
+
+change_titles = [('new', 'E', u"New errors"), ('new', 'W', u"New warnings"), ('resolved', 'E', u"Resolved errors"), ('resolved', 'W', u"Resolved warnings")]
+
+def diff_lines(previous, current, limit=None):
+    """Compare two sorted runs of issue lines, [u'E ' + error, ...] then [u'W ' + warning, ...], a line at a time.
+
+    Returns how many lines are in both, and (title, count, first [limit] issues) for each kind of change.
+    """
+    counts = dict((key, 0) for key in ('new', 'resolved', 'unchanged'))
+    examples = dict(((change, kind), []) for change, kind, title in change_titles)
+    counted = dict(((change, kind), 0) for change, kind, title in change_titles)
+
+    previous, current = iter(previous), iter(current)
+    old, new = next(previous, None), next(current, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old < new):
+            change, line = 'resolved', old
+            old = next(previous, None)
+        elif old is None or new < old:
+            change, line = 'new', new
+            new = next(current, None)
+        else:
+            counts['unchanged'] += 1
+            old, new = next(previous, None), next(current, None)
+            continue
+
+        key = (change, line[0])
+        counted[key] += 1
+        if limit is None or len(examples[key]) < limit:
+            examples[key].append(line[2:])
+
+    return counts['unchanged'], [(title, counted[(change, kind)], examples[(change, kind)]) for change, kind, title in change_titles]
+
+class IssueChanges(object):
+    """How the issues found by a validation differ from the ones found by the validation before.
+
+    [new_errors], [resolved_errors] and the like are worked out from the issues held in memory. Results with too
+    many issues to hold have theirs compared on disk instead, see compare_lines(). Only the first [limit] of each
+    kind of change are described.
+    """
+    def __init__(self, fingerprint, errors, warnings, previous_errors=None, previous_warnings=None, limit=None):
+        super(IssueChanges, self).__init__()
+        self.fingerprint = fingerprint
+        self.errors = errors
+        self.warnings = warnings
+        self.first = previous_errors is None
+        self.limit = limit
+        self.issues = None # Where the issues were compared, if not in memory, see IssueFile.
+
+        previous_errors = previous_errors or frozenset()
+        previous_warnings = previous_warnings or frozenset()
+        self.new_errors = errors - previous_errors
+        self.new_warnings = warnings - previous_warnings
+        self.resolved_errors = previous_errors - errors
+        self.resolved_warnings = previous_warnings - warnings
+        self.unchanged = len(errors & previous_errors) + len(warnings & previous_warnings)
+        self.error_count = len(errors)
+        self.warning_count = len(warnings)
+        self.sections = [(title, len(issues), sorted(issues)[:limit]) for title, issues in [(u"New errors", self.new_errors), (u"New warnings", self.new_warnings),
+            (u"Resolved errors", self.resolved_errors), (u"Resolved warnings", self.resolved_warnings)]]
+
+    def compare_lines(self, previous, current):
+        """Take what changed from the sorted issue lines [previous] and [current] rather than the issues in memory,
+        see diff_lines()"""
+        self.unchanged, self.sections = diff_lines(previous, current, self.limit)
+
+    @property
+    def changed(self):
+        return self.first or any(count for title, count, issues in self.sections)
+
+    @property
+    def truncated(self):
+        """Whether there are more changes than describe() lists"""
+        return any(count > len(issues) for title, count, issues in self.sections)
+
+    def describe(self):
+        """Plain text summary of what changed"""
+        if not self.changed:
+            return u"Still failing with the same {0} errors and {1} warnings as the last validation.".format(self.error_count, self.warning_count)
+
+        new = sum(count for title, count, issues in self.sections[:2])
+        resolved = sum(count for title, count, issues in self.sections[2:])
+        lines = [u"{0} new, {1} resolved and {2} unchanged issues since the last validation.".format(new, resolved, self.unchanged)]
+        for title, count, issues in self.sections:
+            if count:
+                lines.append(u"")
+                lines.append(u"{0} (first {1} of {2}):".format(title, len(issues), count) if len(issues) < count else u"{0}:".format(title))
+                lines.extend(u"- {0}".format(issue) for issue in issues)
+        if self.truncated and self.issues is not None:
+            lines.append(u"")
+            lines.append(u"The full results are attached.")
+        return u"\n".join(lines)
+
+class IssueIndex(object):
+    """Which feeds each error and warning is affecting right now, across every feed, for reports on the most
+    widespread issues. Kept up to date one result at a time from how its issues changed, see IssueChanges.
+
+    Issue strings are interned, so an issue reported by a thousand feeds is only held once.
+    """
+    def __init__(self):
+        super(IssueIndex, self).__init__()
+        self.feeds = {'error': {}, 'warning': {}} # Issue to the endpoints of the feeds it affects, for each kind.
+        self.strings = {}
+        self.lock = threading.Lock()
+
+    def intern(self, issues):
+        with self.lock:
+            return frozenset(self.strings.setdefault(issue, issue) for issue in issues)
+
+    def add(self, endpoint, errors, warnings):
+        with self.lock:
+            for kind, issues in (('error', errors), ('warning', warnings)):
+                for issue in issues:
+                    self.feeds[kind].setdefault(self.strings.setdefault(issue, issue), set()).add(endpoint)
+
+    def remove(self, endpoint, errors, warnings):
+        with self.lock:
+            for kind, issues in (('error', errors), ('warning', warnings)):
+                for issue in issues:
+                    endpoints = self.feeds[kind].get(issue)
+                    if endpoints is None:
+                        continue
+                    endpoints.discard(endpoint)
+                    if not endpoints:
+                        del self.feeds[kind][issue]
+                        if issue not in self.feeds['error'] and issue not in self.feeds['warning']:
+                            self.strings.pop(issue, None)
+
+    def update(self, endpoint, changes):
+        """Move the feed at [endpoint] on to the issues it has gained and off the ones it has lost"""
+        self.remove(endpoint, changes.resolved_errors, changes.resolved_warnings)
+        self.add(endpoint, changes.new_errors, changes.new_warnings)
+
+    def affected(self, issue, kind='error'):
+        """Endpoints of the feeds [issue] is affecting"""
+        with self.lock:
+            return frozenset(self.feeds[kind].get(issue, ()))
+
+    def top(self, kind='error', limit=10):
+        """The [limit] issues of [kind] affecting the most feeds, as (issue, endpoints) pairs, most feeds first"""
+        with self.lock:
+            ranked = heapq.nsmallest(limit, self.feeds[kind].items(), key=lambda item: (-len(item[1]), item[0]))
+            return [(issue, sorted(endpoints)) for issue, endpoints in ranked]
+
+    def report(self, limit=20, examples=10):
+        """The [limit] most widespread errors and warnings, with how many feeds each affects and up to [examples] of them"""
+        report = {}
+        for kind in ('error', 'warning'):
+            report[kind + 's'] = [{"issue": issue, "feeds": len(endpoints), "endpoints": endpoints[:examples]} for issue, endpoints in self.top(kind, limit)]
+        with self.lock:
+            report["distinct_errors"] = len(self.feeds['error'])
+            report["distinct_warnings"] = len(self.feeds['warning'])
+        return report
+
+class IssueTracker(object):
+    """Remembers the issues from each feed's last validation, comparing every new result against them. Every feed's
+    current issues are also kept in [index], see IssueIndex. Emails list up to [limit] of each kind of change."""
+    def __init__(self, store=None, limit=100):
+        super(IssueTracker, self).__init__()
+        self.store = store
+        self.limit = limit
+        self.previous = {}
+        self.index = IssueIndex()
+        self.lock = threading.Lock()
+
+    def load(self, endpoint):
+        """Pick up the issues saved for the feed at [endpoint], unless it already has some"""
+        with self.lock:
+            self.restore(endpoint)
+
+    def restore(self, endpoint):
+        if endpoint in self.previous or self.store is None:
+            return
+        saved = self.store.issues(endpoint)
+        if saved is not None:
+            fingerprint, errors, warnings = saved
+            self.previous[endpoint] = (fingerprint, self.index.intern(errors), self.index.intern(warnings))
+            self.index.add(endpoint, errors, warnings)
+
+    def forget(self, endpoint):
+        """Drop the issues of the feed at [endpoint], it is no longer being validated here"""
+        with self.lock:
+            previous = self.previous.pop(endpoint, None)
+            if previous is not None:
+                self.index.remove(endpoint, previous[1], previous[2])
+
+    def check(self, feed, response_json):
+        """Work out how the issues in [response_json] differ from the ones found the last time [feed] was validated,
+        without remembering them, see remember()"""
+        errors, warnings = read_issues(feed, response_json)
+
+        with self.lock:
+            self.restore(feed.endpoint)
+            previous = self.previous.get(feed.endpoint)
+        previous_errors, previous_warnings = previous[1:] if previous is not None else (None, None)
+
+        issues = getattr(response_json, 'issues', None)
+        if issues is None:
+            return IssueChanges(fingerprint(errors, warnings), errors, warnings, previous_errors, previous_warnings, self.limit)
+
+        # Streamed results only have a sample of their issues in memory, to remember and index. Every one of them is
+        # compared on disk instead, where they have been sorted, and then only if they have changed.
+        changes = IssueChanges(response_json.fingerprint(feed.ignore_warnings), errors, warnings, previous_errors, previous_warnings, self.limit)
+        changes.issues = issues
+        changes.error_count = response_json.error_count
+        changes.warning_count = 0 if feed.ignore_warnings else response_json.warning_count
+        if previous is not None and previous[0] == changes.fingerprint:
+            changes.compare_lines((), ())
+        elif previous is not None:
+            changes.compare_lines(issues.previous_lines(feed.ignore_warnings), issues.lines(feed.ignore_warnings))
+        return changes
+
+    def remember(self, feed, changes):
+        """Compare the next validation of [feed] against the issues in [changes], see check()"""
+        if changes.issues is not None:
+            changes.issues.keep()
+
+        with self.lock:
+            previous = self.previous.get(feed.endpoint)
+            if previous is not None and previous[0] == changes.fingerprint:
+                return
+
+            # Only remember, and store, the issues when they have changed.
+            errors, warnings = self.index.intern(changes.errors), self.index.intern(changes.warnings)
+            self.previous[feed.endpoint] = (changes.fingerprint, errors, warnings)
+            self.index.update(feed.endpoint, changes)
+            if self.store is not None:
+                self.store.save_issues(feed.endpoint, changes.fingerprint, errors, warnings)
+
+    def compare(self, feed, response_json):
+        """Check the issues in [response_json] against the last ones found for [feed] and remember them"""
+        changes = self.check(feed, response_json)
+        self.remember(feed, changes)
+        return changes
@@ -0,0 +1,129 @@
+import json, time, threading, logging, logging.handlers
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+def feed_extra(feed, rate_limit=None):
+    """Fields to log along with a message about [feed], see logging's extra argument.
+
+    Messages of the same [rate_limit] kind about the same feed are rate limited together, see RateLimitFilter.
+    """
+    extra = {'feed': feed.name, 'endpoint': feed.endpoint}
+    if rate_limit is not None:
+        extra['rate_limit'] = (rate_limit, feed.endpoint)
+    return extra
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line json object, including the feed it is about if there is one"""
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in ('feed', 'endpoint'):
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, sort_keys=True)
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most [burst] records with the same rate_limit key every [period] seconds.
+
+    Records without a rate_limit key always get through. The first record let through after some were held back
+    says how many were.
+    """
+    def __init__(self, period=60, burst=10):
+        logging.Filter.__init__(self)
+        self.period = period
+        self.burst = burst
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'rate_limit', None)
+        if key is None:
+            return True
+
+        now = time.time()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                suppressed = window[2] if window is not None else 0
+                window = self.windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.msg = u"{0} ({1} similar messages suppressed)".format(record.msg, suppressed)
+
+            window[1] += 1
+            if window[1] > self.burst:
+                window[2] += 1
+                return False
+        return True
+
+class QueueHandler(logging.Handler):
+    """Puts records on a queue for a QueueListener to format and write out"""
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.records = records
+
+    def emit(self, record):
+        self.records.put(record)
+
+class QueueListener(object):
+    """Hands queued records to [handler] from a background thread"""
+    def __init__(self, records, handler):
+        super(QueueListener, self).__init__()
+        self.records = records
+        self.handler = handler
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.work, name='flmx-log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def work(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                return
+            self.handler.handle(record)
+
+    def stop(self):
+        """Write out everything already queued and stop"""
+        self.records.put(None)
+        self.thread.join()
+        self.handler.close()
+
+class LogPipeline(object):
+    """Logging for [logger_name] that only queues records on the calling thread, formatting and writing them to the
+    rotating log file at [log_path] in the background"""
+    def __init__(self, log_path, logger_name='flmx-logger'):
+        super(LogPipeline, self).__init__()
+        self.file_handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=104857600, backupCount=3)
+        self.file_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        records = queue.Queue()
+        self.rate_limit = RateLimitFilter()
+        self.handler = QueueHandler(records)
+        self.handler.addFilter(self.rate_limit)
+        self.listener = QueueListener(records, self.file_handler)
+
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+        self.listener.start()
+
+    def configure(self, json_lines=False, rate_limit_period=60, rate_limit_burst=10):
+        self.file_handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(TEXT_FORMAT))
+        self.rate_limit.period = rate_limit_period
+        self.rate_limit.burst = rate_limit_burst
+
+    def stop(self):
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
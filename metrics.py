@@ -0,0 +1,229 @@
+import time, json, threading, logging
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+logger = logging.getLogger('flmx-logger')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [u'{0}="{1}"'.format(name, u'{0}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return u'{' + u','.join(escaped) + u'}'
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        super(Counter, self).__init__()
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in sorted(self.values.items())]
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+class Gauge(Counter):
+    """A value that goes up and down, either set directly or read from [function] whenever it is needed"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, function=None):
+        super(Gauge, self).__init__(name, help)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+    def remove(self, **labels):
+        """Stop reporting the value with [labels]"""
+        with self.lock:
+            self.values.pop(label_key(labels), None)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), self.function())]
+        return super(Gauge, self).samples()
+
+    def total(self):
+        if self.function is not None:
+            return self.function()
+        with self.lock:
+            return max(self.values.values()) if self.values else 0
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__()
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {} # Label key to [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            counts = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (buckets, total, count) in sorted(self.values.items()):
+                for bound, bucket in zip(self.buckets, buckets):
+                    samples.append((self.name + '_bucket', key + (('le', format_value(bound)),), bucket))
+                samples.append((self.name + '_bucket', key + (('le', '+Inf'),), count))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, count))
+        return samples
+
+    def totals(self):
+        """Sum and count of every observation, whatever its labels"""
+        with self.lock:
+            return sum(v[1] for v in self.values.values()), sum(v[2] for v in self.values.values())
+
+class Timer(object):
+    """Context manager observing how long its block took in a histogram"""
+    def __init__(self, histogram, labels):
+        super(Timer, self).__init__()
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.started, **self.labels)
+
+class Metrics(object):
+    """Counters, gauges and latency histograms for each stage of validating a feed"""
+    def __init__(self):
+        super(Metrics, self).__init__()
+        self.metrics = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help, *args):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, *args)
+                self.order.append(name)
+            return self.metrics[name]
+
+    def counter(self, name, help=''):
+        return self.get(Counter, name, help)
+
+    def gauge(self, name, help='', function=None):
+        gauge = self.get(Gauge, name, help)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self.get(Histogram, name, help, buckets)
+
+    def timer(self, name, help='', **labels):
+        return Timer(self.histogram(name, help), labels)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for name in list(self.order):
+            metric = self.metrics[name]
+            lines.append(u'# HELP {0} {1}'.format(name, metric.help))
+            lines.append(u'# TYPE {0} {1}'.format(name, metric.kind))
+            for sample_name, key, value in metric.samples():
+                lines.append(u'{0}{1} {2}'.format(sample_name, format_labels(key), format_value(value)))
+        return u'\n'.join(lines) + u'\n'
+
+    def summary(self):
+        """One line overview of the metrics for the log"""
+        parts = []
+        for name in list(self.order):
+            metric = self.metrics[name]
+            if metric.kind == 'histogram':
+                total, count = metric.totals()
+                parts.append(u'{0} n={1} avg={2:.3f}s'.format(name, count, total / count if count else 0))
+            else:
+                parts.append(u'{0}={1}'.format(name, format_value(metric.total())))
+        return u', '.join(parts)
+
+    def log_summaries(self, interval):
+        """Log a summary every [interval] seconds from a background thread"""
+        def work():
+            while True:
+                time.sleep(interval)
+                logger.info("Metrics: {0}".format(self.summary()))
+        thread = threading.Thread(target=work, name='flmx-metrics-summary')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in self.server.reports:
+            body = json.dumps(self.server.reports[path](), indent=4, separators=(',', ': '), sort_keys=True).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        else:
+            body = self.server.metrics.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """Serves the metrics to Prometheus, or anything else that asks, on any path. [reports] maps other paths to
+    functions returning reports to serve there as json."""
+    daemon_threads = True
+
+    def __init__(self, metrics, host='127.0.0.1', port=9100, reports=None):
+        HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.metrics = metrics
+        self.reports = reports or {}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='flmx-metrics')
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -1,55 +1,232 @@
-import smtplib
-
-class NotifyError(Exception):
-    def __init__(self, value):
-        self.value = value
-    def __str__(self):
-        return repr(self.value)
-
-class Emailer:
-    def __init__(self, settings):
-        self.host = settings['host']
-        self.port = settings['port']
-        self.ssl_enabled = False
-        if 'ssl' in settings and 'enabled' in settings['ssl'] and settings['ssl']['enabled']:
-            self.ssl_enabled = True
-            self.key_file = settings['ssl']['key']
-            self.certificate = settings['ssl']['cert']
-        self.sender = settings['sender']
-
-    # Put in this method so it's easier to test our code is working in an automated fashion.
-    def format(self, recipients, subject, body):
-        message = u"From: {from_addr}\r\n".format(from_addr=self.sender)
-
-        if not isinstance(recipients, dict) or not set.intersection(set(recipients.keys()), set(['to', 'cc', 'bcc'])):
-            raise NotifyError("Must supply either a 'to', 'cc' or 'bcc' to send an email.")
-
-        for cat in recipients:
-            # First cast any strings passed in to arrays of strings.
-            if not isinstance(recipients[cat], list):
-                # Strip out any spaces for niceity.
-                recipients[cat] = [x.strip() for x in recipients[cat].split(',')]
-
-            # 'bcc' is not included in the message bit apparently so skip.
-            if not cat.lower() == 'bcc':
-                # Join the recipients with commas because the message format requires that!
-                message += u"{cat}: {recipients}\r\n".format(cat=cat.title(), recipients=u", ".join(recipients[cat]))
-
-        message += u"Subject: {subject}\r\n\r\n{body}".format(subject=subject, body=body)
-
-        # Concat the recipients together, smtp doesn't care what types they are.
-        recipient_addrs = [x for sublist in recipients.itervalues() for x in sublist]
-
-        return recipient_addrs, message
-
-    def connect(self):
-        if self.ssl_enabled:
-            self.server = smtplib.SMTP_SSL(host=self.host, port=self.port, keyfile=self.key_file, certfile=self.certificate)
-        else:
-            self.server = smtplib.SMTP(host=self.host, port=self.port)
-
-    def send(self, recipients, subject, body):
-        recipient_addrs, message = self.format(recipients, subject, body)
-        self.connect()
-        self.server.sendmail(self.sender, recipient_addrs, message)
-        self.server.quit()
\ No newline at end of file
+import os, smtplib, socket, time, weakref, threading, logging
+from email import encoders
+from email.header import Header
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from metrics import metrics
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger('flmx-logger')
+
+class NotifyError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+class Recipients(object):
+    """Who an email goes to, as (category, addresses) pairs with the addresses in a tuple, 'to' first then 'cc' and
+    'bcc'. Made by parse_recipients, which hands out the same one for the same people."""
+    __slots__ = ('categories', '__weakref__')
+    order = {'to': 0, 'cc': 1, 'bcc': 2}
+
+    def __init__(self, categories):
+        self.categories = categories
+
+    def items(self):
+        return self.categories
+
+    def addresses(self):
+        return [addr for cat, addrs in self.categories for addr in addrs]
+
+    def __eq__(self, other):
+        return isinstance(other, Recipients) and self.categories == other.categories
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.categories)
+
+    def __str__(self):
+        return "; ".join("{0}: {1}".format(cat, ", ".join(addrs)) for cat, addrs in self.categories)
+
+shared_recipients = weakref.WeakValueDictionary()
+shared_recipients_lock = threading.Lock()
+
+def parse_recipients(recipients):
+    """[recipients] as Recipients, each of them either a list of addresses or a comma separated string"""
+    if isinstance(recipients, Recipients):
+        return recipients
+    if not isinstance(recipients, dict):
+        raise NotifyError("Recipients must be a dict of 'to', 'cc' and 'bcc' addresses.")
+
+    categories = []
+    for cat in sorted(recipients, key=lambda cat: (Recipients.order.get(cat.lower(), 3), cat)):
+        addrs = recipients[cat]
+        if not isinstance(addrs, list):
+            # Strip out any spaces for niceity.
+            addrs = [x.strip() for x in addrs.split(',')]
+        categories.append((cat, tuple(addrs)))
+    categories = tuple(categories)
+
+    with shared_recipients_lock:
+        parsed = shared_recipients.get(categories)
+        if parsed is None:
+            parsed = shared_recipients[categories] = Recipients(categories)
+        return parsed
+
+class Emailer:
+    def __init__(self, settings):
+        self.host = settings['host']
+        self.port = settings['port']
+        self.ssl_enabled = False
+        if 'ssl' in settings and 'enabled' in settings['ssl'] and settings['ssl']['enabled']:
+            self.ssl_enabled = True
+            self.key_file = settings['ssl']['key']
+            self.certificate = settings['ssl']['cert']
+        self.sender = settings['sender']
+
+        # Emails queued within [digest_window] seconds of each other for the same recipients go out as one.
+        self.digest_window = settings.get('digest_window', 0)
+        self.outbox = queue.Queue()
+        self.server = None
+        self.lock = threading.Lock()
+
+    # Put in this method so it's easier to test our code is working in an automated fashion.
+    def format(self, recipients, subject, body, attachments=()):
+        message = u"From: {from_addr}\r\n".format(from_addr=self.sender)
+
+        # Feeds' recipients were parsed when they were loaded, anything else is parsed here.
+        recipients = parse_recipients(recipients)
+        if not set.intersection(set(cat for cat, addrs in recipients.items()), set(['to', 'cc', 'bcc'])):
+            raise NotifyError("Must supply either a 'to', 'cc' or 'bcc' to send an email.")
+
+        for cat, addrs in recipients.items():
+            # 'bcc' is not included in the message bit apparently so skip.
+            if not cat.lower() == 'bcc':
+                # Join the recipients with commas because the message format requires that!
+                message += u"{cat}: {recipients}\r\n".format(cat=cat.title(), recipients=u", ".join(addrs))
+
+        message += u"Subject: {subject}\r\n\r\n{body}".format(subject=subject, body=body)
+
+        # Concat the recipients together, smtp doesn't care what types they are.
+        recipient_addrs = recipients.addresses()
+
+        if attachments:
+            message = self.attach(recipients, subject, body, attachments)
+        return recipient_addrs, message
+
+    def attach(self, recipients, subject, body, attachments):
+        """MIME message with [attachments], a list of (filename, path) pairs, sent as gzipped files"""
+        message = MIMEMultipart()
+        message['From'] = self.sender
+        for cat, addrs in recipients.items():
+            if not cat.lower() == 'bcc':
+                message[cat.title()] = u", ".join(addrs)
+        message['Subject'] = Header(subject, 'utf-8')
+        message.attach(MIMEText(body.encode('utf-8'), 'plain', 'utf-8'))
+
+        for filename, path in attachments:
+            part = MIMEBase('application', 'gzip')
+            with open(path, 'rb') as attachment:
+                part.set_payload(attachment.read())
+            encoders.encode_base64(part)
+            part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(filename))
+            message.attach(part)
+        return message.as_string()
+
+    def digest(self, emails):
+        """Group [emails] going to the same recipients, combining each group of more than one into a single email"""
+        groups = {}
+        order = []
+        for email in emails:
+            key = tuple(sorted((cat.lower(), tuple(sorted(addrs))) for cat, addrs in parse_recipients(email[0]).items()))
+
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(email)
+
+        digests = []
+        for key in order:
+            group = groups[key]
+            if len(group) == 1:
+                digests.append(group[0])
+            else:
+                subject = u"Digest of {0} notifications".format(len(group))
+                body = u"\r\n\r\n".join(u"{0}\r\n{1}\r\n{2}".format(e[1], u"=" * len(e[1]), e[2]) for e in group)
+                attachments = [attachment for e in group for attachment in (e[3] if len(e) > 3 else ())]
+                digests.append((group[0][0], subject, body, attachments))
+        return digests
+
+    def connect(self):
+        if self.ssl_enabled:
+            self.server = smtplib.SMTP_SSL(host=self.host, port=self.port, keyfile=self.key_file, certfile=self.certificate)
+        else:
+            self.server = smtplib.SMTP(host=self.host, port=self.port)
+
+    def close(self):
+        with self.lock:
+            if self.server is not None:
+                try:
+                    self.server.quit()
+                except (smtplib.SMTPException, socket.error):
+                    pass
+                self.server = None
+
+    def send(self, recipients, subject, body, attachments=()):
+        recipient_addrs, message = self.format(recipients, subject, body, attachments)
+
+        # Keep the connection open between emails, reconnecting if the server has dropped it since the last one.
+        with self.lock:
+            with metrics.timer('flmx_email_send_seconds', 'Time taken sending emails'):
+                if self.server is None:
+                    self.connect()
+                try:
+                    self.server.sendmail(self.sender, recipient_addrs, message)
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    self.connect()
+                    self.server.sendmail(self.sender, recipient_addrs, message)
+        metrics.counter('flmx_emails_sent_total', 'Emails sent').inc()
+
+    def enqueue(self, recipients, subject, body, attachments=()):
+        """Hand an email to the background worker to send, see start. The files in [attachments] are the emailer's
+        from then on, removed once the email has been dealt with."""
+        self.outbox.put((recipients, subject, body, attachments))
+
+    def start(self):
+        thread = threading.Thread(target=self.work, name='flmx-emailer')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def flush(self):
+        """Wait until every queued email has been dealt with"""
+        self.outbox.join()
+
+    def work(self):
+        while True:
+            batch = [self.outbox.get()]
+
+            # Hold on to the first email for the digest window, gathering up everything else queued in that time.
+            deadline = time.time() + self.digest_window
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.outbox.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            for email in self.digest(batch):
+                try:
+                    self.send(*email)
+                except Exception as e:
+                    logger.error("Unable to send email to {0}: {1}".format(email[0], e))
+                    metrics.counter('flmx_email_failures_total', 'Emails that could not be sent').inc()
+                    self.close()
+
+            for email in batch:
+                for filename, path in email[3]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.outbox.task_done()
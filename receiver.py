@@ -0,0 +1,51 @@
+import threading, logging
+import jsonschema
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+logger = logging.getLogger('flmx-logger')
+
+class ResultsHandler(BaseHTTPRequestHandler):
+    """Takes the json results of a finished validation POSTed to any path"""
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        response = self.rfile.read(length).decode('utf-8')
+
+        try:
+            completed = self.server.scheduler.receive(response)
+        except LookupError as e:
+            self.reply(404, str(e))
+        except (ValueError, KeyError, jsonschema.ValidationError) as e:
+            self.reply(400, 'Invalid validation results: {0}'.format(e))
+        else:
+            self.reply(200, 'Validation completed' if completed else 'Validation not in progress or not finished')
+
+    def reply(self, status, message):
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Results receiver: {0} - {1}".format(self.client_address[0], format % args))
+
+class ResultsReceiver(ThreadingMixIn, HTTPServer):
+    """Embedded http listener the validator, or a proxy in front of it, can push finished results to"""
+    daemon_threads = True
+
+    def __init__(self, scheduler, host='127.0.0.1', port=8089):
+        HTTPServer.__init__(self, (host, port), ResultsHandler)
+        self.scheduler = scheduler
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='flmx-receiver')
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,290 @@
+import os, re, json, gzip, heapq, shutil, hashlib, tempfile
+from issues import normalize, Fingerprint
+
+whitespace = re.compile(r'[ \t\n\r]*')
+decoder = json.JSONDecoder()
+missing = object()
+
+class StreamedResults(dict):
+    """Validation results read a bit at a time, the errors and warnings cut down to a sample of the first few.
+
+    [error_count] and [warning_count] are how many were reported. [spool_path] is where the results are kept as they
+    came, gzipped, and [issues] where every distinct issue is kept, sorted, see IssueFile.
+    """
+    def __init__(self):
+        super(StreamedResults, self).__init__()
+        self.error_count = 0
+        self.warning_count = 0
+        self.error_fingerprint = Fingerprint()
+        self.warning_fingerprint = Fingerprint()
+        self.spool_path = None
+        self.issues = None
+
+    def fingerprint(self, ignore_warnings=False):
+        """Hash of every distinct issue, the same as issues.fingerprint() would give if they were all in memory"""
+        return (self.error_fingerprint if ignore_warnings else self.error_fingerprint + self.warning_fingerprint).hexdigest()
+
+    def describe(self):
+        """Plain text overview of the results, for when they are too big to send in full"""
+        results = self.get('validation-results', {})
+        lines = [u"{0} errors and {1} warnings, the full results are attached.".format(self.error_count, self.warning_count)]
+        for title, sample, count in [(u"Errors", results.get('errors', []), self.error_count), (u"Warnings", results.get('warnings', []), self.warning_count)]:
+            if sample:
+                lines.append(u"")
+                lines.append(u"{0} (first {1} of {2}):".format(title, len(sample), count) if len(sample) < count else u"{0}:".format(title))
+                lines.extend(u"- {0}".format(issue) for issue in sample)
+        return u"\n".join(lines)
+
+class ResultsReader(object):
+    """Parses a validation results document fed to it in chunks, without ever holding the whole thing.
+
+    Everything but the errors and warnings is kept as it is. Each error and warning is counted as it is read, and
+    handed to [sorter] normalised if there is one, with only the first [sample_size] of each kept as they were reported.
+    """
+    def __init__(self, sample_size=20, sorter=None):
+        super(ResultsReader, self).__init__()
+        self.sample_size = sample_size
+        self.sorter = sorter
+        self.results = StreamedResults()
+        self.buffer = u''
+        self.position = 0
+        self.state = 'start'
+        self.depth = 1 # 1 in the results object itself, 2 in its validation-results object.
+        self.key = None
+        self.closed = False
+
+    def feed(self, text):
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+        self.parse()
+
+    def close(self):
+        """Finish off parsing, returning the results"""
+        self.closed = True
+        self.parse()
+        if self.state != 'done':
+            raise ValueError('Validation results ended before they were complete')
+        return self.results
+
+    def decode(self):
+        """The json value at the current position, or [missing] if it hasn't all arrived yet"""
+        try:
+            value, end = decoder.raw_decode(self.buffer, idx=self.position)
+        except ValueError:
+            if self.closed:
+                raise
+            return missing
+
+        # A number at the very end of the buffer might carry on in the next chunk.
+        if end >= len(self.buffer) and not self.closed:
+            return missing
+        self.position = end
+        return value
+
+    def expect(self, char):
+        if self.buffer[self.position] != char:
+            raise ValueError('Expected {0} at {1!r} in the validation results'.format(char, self.buffer[self.position:self.position + 20]))
+        self.position += 1
+
+    def parse(self):
+        while self.state != 'done':
+            self.position = whitespace.match(self.buffer, self.position).end()
+            if self.position >= len(self.buffer):
+                return
+            char = self.buffer[self.position]
+
+            if self.state == 'start':
+                self.expect('{')
+                self.state = 'key'
+
+            elif self.state == 'key':
+                if char == '}':
+                    self.position += 1
+                    self.depth -= 1
+                    self.state = 'key' if self.depth else 'done'
+                elif char == ',':
+                    self.position += 1
+                else:
+                    key = self.decode()
+                    if key is missing:
+                        return
+                    self.key = key
+                    self.state = 'colon'
+
+            elif self.state == 'colon':
+                self.expect(':')
+                self.state = 'value'
+
+            elif self.state == 'value':
+                if self.depth == 1 and self.key == 'validation-results':
+                    self.expect('{')
+                    self.results[self.key] = {}
+                    self.depth = 2
+                    self.state = 'key'
+                elif self.depth == 2 and self.key in ('errors', 'warnings'):
+                    self.expect('[')
+                    self.results['validation-results'][self.key] = []
+                    self.state = 'items'
+                else:
+                    value = self.decode()
+                    if value is missing:
+                        return
+                    (self.results if self.depth == 1 else self.results['validation-results'])[self.key] = value
+                    self.state = 'key'
+
+            elif self.state == 'items':
+                if char == ']':
+                    self.position += 1
+                    self.state = 'key'
+                elif char == ',':
+                    self.position += 1
+                else:
+                    item = self.decode()
+                    if item is missing:
+                        return
+                    self.add(self.key, item)
+
+        if whitespace.match(self.buffer, self.position).end() < len(self.buffer):
+            raise ValueError('Extra data after the validation results')
+
+    def add(self, kind, item):
+        sample = self.results['validation-results'][kind]
+        if not isinstance(item, type(u'')):
+            # Keep hold of it so checking the results against their schema picks it up.
+            sample.append(item)
+            return
+
+        if kind == 'errors':
+            self.results.error_count += 1
+        else:
+            self.results.warning_count += 1
+        if self.sorter is not None:
+            self.sorter.add(u'{0} {1}'.format('E' if kind == 'errors' else 'W', normalize(item)))
+        if len(sample) < self.sample_size:
+            sample.append(item)
+
+class Spool(object):
+    """Writes the results for [endpoint] to a gzipped file in [directory], replacing the last ones once complete"""
+    def __init__(self, directory, endpoint):
+        super(Spool, self).__init__()
+        self.path = os.path.join(directory, '{0}.json.gz'.format(hashlib.sha1(endpoint.encode('utf-8')).hexdigest()))
+        handle, self.temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        os.close(handle)
+        self.file = gzip.open(self.temp_path, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        """Swap in the complete results, returning their path"""
+        self.file.close()
+        os.rename(self.temp_path, self.path)
+        return self.path
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+def snapshot(path):
+    """A file of its own with what is in [path] now, which the next results being swapped in won't touch. Hard
+    linked where possible, copied otherwise."""
+    directory, name = os.path.split(path)
+    handle, snapshot_path = tempfile.mkstemp(prefix=name.split('.')[0] + '.', suffix='.attachment.gz', dir=directory)
+    os.close(handle)
+    try:
+        os.remove(snapshot_path)
+        os.link(path, snapshot_path)
+    except (OSError, AttributeError):
+        shutil.copyfile(path, snapshot_path)
+    return snapshot_path
+
+def read_lines(path):
+    """Each line of the gzipped file at [path]"""
+    lines = gzip.open(path, 'rb')
+    try:
+        for line in lines:
+            yield line.decode('utf-8').rstrip(u'\n')
+    finally:
+        lines.close()
+
+class IssueSorter(object):
+    """Sorts issue lines (see diff_lines) into a gzipped file, one to a line, leaving out repeats. No more than
+    [chunk_size] lines are held at once, each chunk being sorted and written to a temporary file in [directory] to
+    be merged with the others at the end."""
+    def __init__(self, directory, chunk_size=100000):
+        super(IssueSorter, self).__init__()
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.chunk_paths = []
+
+    def add(self, line):
+        self.chunk.append(line)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        handle, path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(handle)
+        self.chunk_paths.append(path)
+        chunk = gzip.open(path, 'wb')
+        try:
+            for line in sorted(self.chunk):
+                chunk.write(line.encode('utf-8') + b'\n')
+        finally:
+            chunk.close()
+        self.chunk = []
+
+    def commit(self, path):
+        """Write every line to [path] in order, returning the fingerprints of the errors and of the warnings"""
+        fingerprints = {'E': Fingerprint(), 'W': Fingerprint()}
+        handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(handle)
+        sorted_file = gzip.open(temp_path, 'wb')
+        try:
+            last = None
+            for line in heapq.merge(sorted(self.chunk), *[read_lines(chunk_path) for chunk_path in self.chunk_paths]):
+                if line != last:
+                    sorted_file.write(line.encode('utf-8') + b'\n')
+                    fingerprints[line[0]].add(line)
+                    last = line
+            sorted_file.close()
+            os.rename(temp_path, path)
+        except Exception:
+            sorted_file.close()
+            os.remove(temp_path)
+            raise
+        finally:
+            self.discard()
+        return fingerprints['E'], fingerprints['W']
+
+    def discard(self):
+        for chunk_path in self.chunk_paths:
+            os.remove(chunk_path)
+        self.chunk = []
+        self.chunk_paths = []
+
+class IssueFile(object):
+    """Where the sorted issues (see IssueSorter) of the latest results for [endpoint] are kept in [directory], next to
+    the ones they are compared against, those of the results before"""
+    def __init__(self, directory, endpoint):
+        super(IssueFile, self).__init__()
+        name = hashlib.sha1(endpoint.encode('utf-8')).hexdigest()
+        self.path = os.path.join(directory, '{0}.issues.new.gz'.format(name))
+        self.previous_path = os.path.join(directory, '{0}.issues.gz'.format(name))
+
+    def lines(self, ignore_warnings=False):
+        return self.read(self.path, ignore_warnings)
+
+    def previous_lines(self, ignore_warnings=False):
+        return self.read(self.previous_path, ignore_warnings)
+
+    def read(self, path, ignore_warnings):
+        if not os.path.exists(path):
+            return iter(())
+        return (line for line in read_lines(path) if not (ignore_warnings and line.startswith(u'W ')))
+
+    def keep(self):
+        """Compare the next results against these ones"""
+        if os.path.exists(self.path):
+            os.rename(self.path, self.previous_path)
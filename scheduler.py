@@ -0,0 +1,493 @@
+import re, json, heapq, hashlib, itertools, random, threading, traceback, logging
+from datetime import timedelta
+import requests
+from issues import IssueTracker
+from results import snapshot
+from admission import AdmissionController
+from breaker import CircuitBreaker, CircuitBreakers, CircuitOpenError
+from dispatch import LostValidationError
+from metrics import metrics
+from clock import system_clock
+from logs import feed_extra
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger('flmx-logger')
+
+class WorkerPool(object):
+    """A fixed number of threads working through a shared queue of jobs"""
+    def __init__(self, size):
+        super(WorkerPool, self).__init__()
+        if size < 1:
+            raise ValueError('A worker pool needs at least one worker, {0} requested'.format(size))
+
+        self.jobs = queue.Queue()
+        self.errors = []
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.work, name='flmx-worker-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        self.jobs.put((func, args))
+
+    def work(self):
+        while True:
+            func, args = self.jobs.get()
+            try:
+                func(*args)
+            except Exception as e:
+                # Keep hold of the error so the thread waiting on the pool can deal with it, the worker carries on.
+                logger.debug(traceback.format_exc())
+                self.errors.append(e)
+            finally:
+                self.jobs.task_done()
+
+    def join(self):
+        """Wait for every submitted job to finish, re-raising the first error any of them hit"""
+        self.jobs.join()
+        if self.errors:
+            error = self.errors[0]
+            self.errors = []
+            raise error
+
+class PollPlanner(object):
+    """Works out when to poll a running validation, learning how long each feed's validations take.
+
+    The first poll is made around when the validation is expected to finish, going by a rolling average of its
+    previous test durations. Polls after that back off exponentially from [poll_interval] up to [poll_max] seconds.
+    """
+    def __init__(self, poll_interval=60, poll_max=1800, backoff=2, smoothing=0.3):
+        super(PollPlanner, self).__init__()
+        self.poll_interval = poll_interval
+        self.poll_max = poll_max
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.estimates = {}
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def record(self, feed, duration):
+        """Fold the [duration] in seconds of a finished validation into the feed's estimate"""
+        with self.lock:
+            estimate = self.estimates.get(feed.endpoint)
+            self.estimates[feed.endpoint] = duration if estimate is None else estimate + self.smoothing * (duration - estimate)
+
+    def first_poll(self, feed):
+        with self.lock:
+            self.attempts[feed.endpoint] = 0
+            estimate = self.estimates.get(feed.endpoint)
+
+        if estimate is None:
+            return feed.validation_start_time + timedelta(seconds=self.poll_interval)
+        return feed.validation_start_time + timedelta(seconds=estimate)
+
+    def next_poll(self, feed, now):
+        with self.lock:
+            attempt = self.attempts.get(feed.endpoint, 0)
+            self.attempts[feed.endpoint] = attempt + 1
+
+        return now + timedelta(seconds=min(self.poll_interval * (self.backoff ** attempt), self.poll_max))
+
+def seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+class Stagger(object):
+    """Spreads validations out so feeds sharing a next_try don't all hit the validator, and the mail server, at once.
+
+    A feed that has never been validated is first started at an offset of up to [spread] of its next_try, worked out
+    from a hash of its endpoint so it is the same every time. After that each validation is due next_try after the
+    last one, give or take up to [jitter] of next_try at random. The jitter averages out, so each feed keeps to its
+    next_try in the long run while feeds that happen to line up drift apart.
+    """
+    def __init__(self, spread=0, jitter=0):
+        super(Stagger, self).__init__()
+        self.spread = spread
+        self.jitter = jitter
+        self.random = random.Random()
+
+    def offset(self, feed):
+        """Where in its next_try [feed] is first started, as a fraction"""
+        digest = hashlib.sha1(feed.endpoint.encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) / float(0x100000000) * self.spread
+
+    def first_due(self, feed, now):
+        return now + timedelta(seconds=self.offset(feed) * seconds(feed.next_try))
+
+    def next_due(self, feed):
+        return feed.last_validated + timedelta(seconds=seconds(feed.next_try) * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def is_due(self, feed, now):
+        """Whether [feed] could be due for validating again, allowing for it being jittered early"""
+        return feed.last_validated is None or now >= feed.last_validated + timedelta(seconds=seconds(feed.next_try) * (1 - self.jitter))
+
+class Scheduler(object):
+    """Starts and polls the validation of every feed, working on up to [workers] feeds at the same time.
+
+    Feeds are kept in a min-heap keyed by when their next start or poll is due, so the scheduler only wakes up
+    when there is something to do and each feed costs O(log n) to pick up and put back. New validations and polls
+    go through [admission], which can hold them back to keep from flooding the validator. [stagger] and [jitter] spread
+    feeds' validations out over their next_try, see Stagger. A feed that keeps failing is left alone for a while by
+    its circuit breaker in [breakers], without holding up any other feed. The time comes from [clock].
+    """
+    def __init__(self, validator, emailer, feeds, workers=4, poll_interval=60, poll_max=1800, poll_backoff=2, poll_fallback=None, store=None, admission=None, stagger=0, jitter=0, breakers=None, clock=None):
+        super(Scheduler, self).__init__()
+        self.clock = clock if clock is not None else system_clock
+        self.validator = validator
+        self.emailer = emailer
+        self.store = store
+        self.issues = IssueTracker(store)
+        self.planner = PollPlanner(poll_interval, poll_max, poll_backoff)
+        self.stagger = Stagger(stagger, jitter)
+        self.breakers = breakers if breakers is not None else CircuitBreakers('feed')
+        self.pool = WorkerPool(workers)
+        self.admission = admission if admission is not None else AdmissionController()
+
+        # When results are pushed to us, only poll for them once [poll_fallback] seconds have gone by without them.
+        self.poll_fallback = timedelta(seconds=poll_fallback) if poll_fallback is not None else None
+
+        self.queue = []
+        self.counter = itertools.count() # Breaks ties between feeds due at the same time without comparing them.
+        self.entries = {} # Sequence number of the queue entry that counts for each feed, any others are stale.
+        self.condition = threading.Condition()
+        self.errors = []
+
+        self.feeds = []
+        self.endpoints = {}
+        self.feed_locks = {}
+
+        metrics.gauge('flmx_validations_in_flight', 'Feeds with a validation in progress',
+            lambda: len([feed for feed in self.feeds if feed.validation_start_time is not None]))
+
+        restored = len([feed for feed in feeds if self.add_feed(feed)])
+        if store is not None:
+            logger.info("Restored the state of {0} feeds from {1}".format(restored, store.path))
+
+    def add_feed(self, feed):
+        """Start scheduling [feed], picking up where it left off before a restart, returning whether it did"""
+        restored = False
+        if self.store is not None:
+            # Including how long each feed's validations take, and the issues it had.
+            restored = self.store.restore([feed]) > 0
+            for completed, success, total_issues, test_duration in reversed(self.store.history(feed.endpoint)):
+                if test_duration is not None:
+                    self.planner.record(feed, test_duration)
+            self.issues.load(feed.endpoint)
+
+        with self.condition:
+            self.feeds.append(feed)
+            self.endpoints[feed.endpoint] = feed
+            self.feed_locks.setdefault(feed.endpoint, threading.Lock())
+        if feed.validation_start_time is not None:
+            self.admission.occupy(feed)
+        self.schedule(feed, self.initial_due(feed))
+        return restored
+
+    def remove_feed(self, endpoint):
+        """Stop scheduling the feed at [endpoint], a validation of it already under way is left to finish"""
+        with self.condition:
+            feed = self.endpoints.pop(endpoint)
+            self.entries.pop(endpoint, None)
+            self.feeds = [f for f in self.feeds if f is not feed]
+        self.admission.forget(endpoint)
+        self.breakers.forget(endpoint)
+        self.issues.forget(endpoint)
+        metrics.gauge('flmx_feed_schedule_lag_seconds').remove(feed=endpoint)
+
+        # Only a Dispatcher keeps track of which feeds each validator is running.
+        forget = getattr(self.validator, 'forget', None)
+        if forget is not None:
+            forget(endpoint)
+        self.wake_waiting()
+        return feed
+
+    def update_feed(self, feed):
+        """Copy the settings of [feed] on to the scheduled feed with the same endpoint, keeping its schedule state"""
+        current = self.endpoints[feed.endpoint]
+        with self.feed_locks[feed.endpoint]:
+            for attribute in ('name', 'credentials', 'next_try', 'ignore_warnings', 'failure_email'):
+                setattr(current, attribute, getattr(feed, attribute))
+
+            # A new next_try changes when an idle feed is next due.
+            if current.validation_start_time is None:
+                self.schedule(current, self.initial_due(current))
+        return current
+
+    def initial_due(self, feed):
+        if feed.validation_start_time is not None:
+            return self.planner.first_poll(feed)
+        elif feed.last_validated is not None:
+            return feed.last_validated + feed.next_try
+        return self.stagger.first_due(feed, self.clock.now())
+
+    def schedule(self, feed, due):
+        """Put [feed] on the queue for [due], replacing wherever it was on the queue before"""
+        with self.condition:
+            # Removed feeds are finished with once any validation work already under way is done.
+            if self.endpoints.get(feed.endpoint) is not feed:
+                return
+
+            sequence = next(self.counter)
+            self.entries[feed.endpoint] = sequence
+            heapq.heappush(self.queue, (due, sequence, feed))
+            self.condition.notify()
+
+    def pop_due(self, now):
+        """Take every feed due at or before [now] off the queue"""
+        feeds = []
+        with self.condition:
+            while self.queue and self.queue[0][0] <= now:
+                due, sequence, feed = heapq.heappop(self.queue)
+                if self.entries.get(feed.endpoint) == sequence:
+                    del self.entries[feed.endpoint]
+                    feeds.append(feed)
+
+                    # How far behind schedule the feed is being picked up.
+                    lag = seconds(now - due)
+                    metrics.gauge('flmx_feed_schedule_lag_seconds', 'Seconds behind schedule each feed was last picked up').set(lag, feed=feed.endpoint)
+                    metrics.histogram('flmx_schedule_lag_seconds', 'Seconds behind schedule feeds are picked up').observe(lag)
+        return feeds
+
+    def wait(self):
+        """Block until at least one feed is due, returning the feeds that are"""
+        with self.condition:
+            while True:
+                if self.errors:
+                    error = self.errors[0]
+                    self.errors = []
+                    raise error
+
+                now = self.clock.now()
+                feeds = self.pop_due(now)
+                if feeds:
+                    return feeds
+
+                # Sleep until the earliest feed is due, or until a worker puts a feed back on the queue.
+                timeout = None
+                if self.queue:
+                    timeout = seconds(self.queue[0][0] - now)
+                self.condition.wait(timeout)
+
+    def run(self):
+        while (True):
+            for feed in self.wait():
+                self.pool.submit(self.dispatch, feed)
+
+    def tick(self):
+        """Deal with every feed that is due right now and wait until they are done"""
+        for feed in self.pop_due(self.clock.now()):
+            self.pool.submit(self.dispatch, feed)
+        self.pool.join()
+
+        if self.errors:
+            error = self.errors[0]
+            self.errors = []
+            raise error
+
+    def dispatch(self, feed):
+        try:
+            with self.feed_locks[feed.endpoint]:
+                due = self.attempt(feed)
+        except Exception as e:
+            # Hand the error over to the thread running the scheduler, it decides what happens next.
+            logger.debug(traceback.format_exc())
+            with self.condition:
+                self.errors.append(e)
+                self.condition.notify()
+        else:
+            # Feeds waiting to be let through to the validator are woken up when it's their turn instead.
+            if due is not None:
+                self.schedule(feed, due)
+
+    def attempt(self, feed):
+        """Process [feed] unless its circuit breaker is open, dealing with whatever goes wrong on the way"""
+        retry = self.breakers.allow(feed.endpoint)
+        if retry:
+            return self.clock.now() + timedelta(seconds=retry)
+
+        try:
+            due = self.process(feed)
+        except CircuitOpenError as e:
+            # The validator's breaker is open, that's no fault of the feed.
+            logger.debug("Not sending {0} [{1}] to the validator: {2}".format(feed.name, feed.endpoint, e), extra=feed_extra(feed))
+            return self.clock.now() + timedelta(seconds=e.retry)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            logger.warning("Could not reach the validator for {0} [{1}]: {2}".format(feed.name, feed.endpoint, e), extra=feed_extra(feed))
+            return self.clock.now() + timedelta(seconds=self.planner.poll_interval)
+        except Exception as e:
+            if isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code >= 500:
+                logger.warning("Validator error for {0} [{1}]: {2}".format(feed.name, feed.endpoint, e), extra=feed_extra(feed))
+                return self.clock.now() + timedelta(seconds=self.planner.poll_interval)
+
+            logger.error("Validating {0} [{1}] failed: {2}".format(feed.name, feed.endpoint, e), extra=feed_extra(feed))
+            logger.debug(traceback.format_exc())
+            metrics.counter('flmx_feed_failures_total', 'Starts and polls that failed because of the feed').inc()
+            self.breakers.failed(feed.endpoint)
+
+            # A poll that keeps failing, on a job the validator has lost say, mustn't hold on to its place for good.
+            breaker = self.breakers.get(feed.endpoint)
+            if feed.validation_start_time is not None and (self.stuck(feed) or (breaker is not None and breaker.state == CircuitBreaker.OPEN)):
+                self.abandon(feed)
+                logger.warning("Giving up on the validation of {0} [{1}], it will be started again".format(feed.name, feed.endpoint), extra=feed_extra(feed))
+            return self.clock.now() + timedelta(seconds=max(self.breakers.remaining(feed.endpoint), self.planner.poll_interval))
+
+        self.breakers.succeeded(feed.endpoint)
+        return due
+
+    def wake_waiting(self):
+        """Put the feed at the front of the admission queue back on the schedule if it could start now"""
+        endpoint = self.admission.next_waiting()
+        feed = self.endpoints.get(endpoint) if endpoint is not None else None
+        if feed is not None:
+            self.schedule(feed, self.clock.now())
+
+    def release(self, feed):
+        self.admission.release(feed)
+        self.wake_waiting()
+
+    def stuck(self, feed):
+        """Whether [feed]'s validation has been going for so long something must have gone wrong"""
+        return self.clock.now() > feed.validation_start_time + timedelta(hours=6)
+
+    def abandon(self, feed):
+        """Forget about [feed]'s validation so it is started again"""
+        feed.validation_start_time = None
+        feed.validator_endpoint = None
+        forget = getattr(self.validator, 'forget', None)
+        if forget is not None:
+            forget(feed.endpoint)
+        self.checkpoint(feed)
+        self.release(feed)
+
+    def process(self, feed):
+        """Start or poll the validation of [feed], returning when it next needs looking at, or None if it is waiting
+        for its turn to start"""
+        now = self.clock.now()
+
+        # If feed is not currently being validated, and it was last validated longer than [next_try] ago, start validation.
+        if feed.validation_start_time is None and self.stagger.is_due(feed, now):
+            admitted, retry = self.admission.admit(feed, reserve=getattr(self.validator, 'reserve', None))
+            if not admitted:
+                return now + timedelta(seconds=retry) if retry is not None else None
+            self.wake_waiting()
+
+            logger.info("Sending validation request for %s [%s] to %s", feed.name, feed.endpoint, self.validator.endpoint, extra=feed_extra(feed))
+            try:
+                self.validator.start(feed)
+            except Exception:
+                self.release(feed)
+                raise
+
+            if feed.validation_start_time is None:
+                self.release(feed)
+                raise ValueError('Validation request was not accepted')
+            self.checkpoint(feed)
+            metrics.counter('flmx_validations_started_total', 'Validations started').inc()
+            if self.poll_fallback is not None:
+                return max(self.planner.first_poll(feed), feed.validation_start_time + self.poll_fallback)
+            return self.planner.first_poll(feed)
+
+        # Else if the validation must have started
+        elif feed.validation_start_time is not None:
+            retry = self.admission.poll()
+            if retry:
+                return now + timedelta(seconds=retry)
+
+            # Polls come round often, so leave formatting them to the log writer and hold back a feed's repeats.
+            logger.info("Polling validation results for %s [%s] from %s", feed.name, feed.endpoint, self.validator.endpoint, extra=feed_extra(feed, 'poll'))
+            try:
+                completed, success, total_issues, response_json = self.validator.poll_results(feed)
+            except LostValidationError as e:
+                # Nothing to poll, so start the validation again.
+                logger.warning("Restarting the validation of {0} [{1}]: {2}".format(feed.name, feed.endpoint, e), extra=feed_extra(feed))
+                self.abandon(feed)
+                return self.clock.now()
+
+            if completed:
+                self.complete(feed, success, total_issues, response_json)
+                return self.stagger.next_due(feed)
+
+            # Check to make sure we haven't hit some weird behaviour and have been stuck polling for > 6 hours.
+            elif self.stuck(feed):
+                # If we have then let's just kick off another validation request.
+                self.abandon(feed)
+                logger.debug("Have been polling {0} for > 6 hours, must be a problem lets rinse and repeat.".format(feed.name), extra=feed_extra(feed))
+                return self.clock.now()
+
+            return self.planner.next_poll(feed, self.clock.now())
+
+        return feed.last_validated + feed.next_try
+
+    def receive(self, response):
+        """Deal with validation results pushed to us instead of polled for, returning whether they finished a validation"""
+        feed = self.endpoints.get(json.loads(response).get('url'))
+        if feed is None:
+            raise LookupError('Results received for a feed that is not being validated')
+
+        with self.feed_locks[feed.endpoint]:
+            if feed.validation_start_time is None:
+                return False
+
+            logger.info("Received validation results for {0} [{1}]".format(feed.name, feed.endpoint), extra=feed_extra(feed))
+            completed, total_issues, response_json = self.validator.handle_results_response(feed, response)
+            if completed:
+                self.complete(feed, total_issues == 0, total_issues, response_json)
+                self.schedule(feed, self.stagger.next_due(feed))
+
+        return completed
+
+    def checkpoint(self, feed):
+        if self.store is not None:
+            self.store.checkpoint(feed)
+
+    def complete(self, feed, success, total_issues, response_json):
+        try:
+            changes = self.issues.check(feed, response_json)
+            self.planner.record(feed, response_json['test-duration'])
+            metrics.counter('flmx_validations_completed_total', 'Validations completed').inc(result='success' if success else 'failure')
+
+            # If the result was a failure, send an email notification. Only once it's on its way are the issues
+            # remembered, so they are sent again next time if anything goes wrong before then.
+            if not success:
+                self.notify(feed, total_issues, response_json, changes)
+            else:
+                logger.info("Validation completed successfully for {0} [{1}]".format(feed.name, feed.endpoint), extra=feed_extra(feed))
+
+            self.issues.remember(feed, changes)
+            if self.store is not None:
+                self.store.record(feed, success, total_issues, response_json, changes.fingerprint)
+        finally:
+            self.release(feed)
+
+    def notify(self, feed, total_issues, response_json, changes):
+        logger.info("Validation for {0} [{1}] resulted in errors, sending email to {2}".format(feed.name, feed.endpoint, feed.failure_email), extra=feed_extra(feed))
+
+        title = u'Validation {result} for {feed} [{endpoint}] ({total_issues} {issues})'.format(
+                result = "failed" if changes.changed else "still failing",
+                feed = feed.name,
+                endpoint = feed.endpoint,
+                total_issues = total_issues,
+                issues = "Issues" if total_issues > 1 else "Issue")
+
+        # Only the first failure gets the full results, after that just say what has changed. Results too big to
+        # have been read in one go are attached from where they were spooled, compressed, rather than put inline,
+        # and so are they when there are more changes than are listed. The emailer gets a copy of its own, as the
+        # spool may well have been replaced by the next results by the time the email goes out.
+        spool_path = getattr(response_json, 'spool_path', None)
+        attachments = []
+        if spool_path is not None and (changes.first or changes.truncated):
+            attachments.append((u'{0}-results.json.gz'.format(re.sub(r'[^A-Za-z0-9_.-]+', '-', feed.name).strip('-') or 'feed'), snapshot(spool_path)))
+        if changes.first and spool_path is not None:
+            body = response_json.describe()
+        elif changes.first:
+            body = json.dumps(response_json, indent=4, separators=(',', ': '), sort_keys=True)
+        else:
+            body = changes.describe()
+        self.emailer.enqueue(feed.failure_email, title, body, attachments)
+
+        logger.info("Email queued for {0}".format(feed.failure_email), extra=feed_extra(feed))
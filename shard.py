@@ -0,0 +1,210 @@
+import os, math, time, socket, sqlite3, threading, logging
+from metrics import metrics
+from clock import system_clock
+
+logger = logging.getLogger('flmx-logger')
+
+class LeaseStore(object):
+    """Shares feeds out between workers through a sqlite database at [path] they can all get at, each feed leased to
+    one worker at a time for [lease] seconds. A worker that stops renewing its leases, because it died say, loses its
+    feeds to the others once they run out.
+
+    Each worker also keeps its status up to date in the database, see status().
+    """
+    def __init__(self, path, worker_id=None, lease=60, clock=None):
+        super(LeaseStore, self).__init__()
+        self.clock = clock if clock is not None else system_clock
+        self.path = path
+        self.worker_id = worker_id or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.lease = lease
+        self.started = self.clock.time()
+        self.held = set()
+        self.lock = threading.Lock()
+
+        # Transactions are begun by hand, so sharing out the feeds can lock the other workers out while it happens.
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.create()
+
+    def create(self):
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS feed_leases (endpoint TEXT PRIMARY KEY, owner TEXT, expires REAL NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, host TEXT, pid INTEGER, started REAL, heartbeat REAL, feeds INTEGER, in_flight INTEGER, validations INTEGER, failures INTEGER)")
+
+    def locked(self, work):
+        """Run [work] on the database with every other worker locked out, returning what it returns"""
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(self.connection)
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+            return result
+
+    def sync(self, endpoints, busy=(), status=None):
+        """Renew this worker's leases and even out the share of [endpoints] it has with the other live workers.
+
+        Feeds in [busy] are never given up to even things out. [status] is saved as this worker's status.
+        Returns the endpoints claimed, those lost to another worker and those given up, as lists.
+        """
+        status = status or {}
+        def work(connection):
+            now = self.clock.time()
+            connection.execute("INSERT OR REPLACE INTO workers (worker_id, host, pid, started, heartbeat, feeds, in_flight, validations, failures) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.worker_id, socket.gethostname(), os.getpid(), self.started, now, status.get('feeds', len(self.held)), status.get('in_flight', 0), status.get('validations', 0), status.get('failures', 0)))
+
+            leases = dict((endpoint, (owner, expires)) for endpoint, owner, expires in connection.execute("SELECT endpoint, owner, expires FROM feed_leases"))
+            owned = set(endpoint for endpoint in endpoints if leases.get(endpoint, (None, 0))[0] == self.worker_id)
+            lost = sorted(self.held - owned)
+
+            # Everyone gets the same share, rounded up so every feed has somewhere to go.
+            live = connection.execute("SELECT COUNT(*) FROM workers WHERE heartbeat >= ?", (now - self.lease,)).fetchone()[0]
+            share = int(math.ceil(len(endpoints) / float(max(live, 1))))
+
+            claimed, released = [], []
+            if len(owned) > share:
+                released = sorted(owned - set(busy))[:len(owned) - share]
+                connection.executemany("UPDATE feed_leases SET owner = NULL, expires = 0 WHERE endpoint = ?", [(endpoint,) for endpoint in released])
+            elif len(owned) < share:
+                free = [endpoint for endpoint in endpoints if endpoint not in owned and (endpoint not in leases or leases[endpoint][0] is None or leases[endpoint][1] < now)]
+                claimed = sorted(free)[:share - len(owned)]
+                connection.executemany("INSERT OR REPLACE INTO feed_leases (endpoint, owner, expires) VALUES (?, ?, 0)", [(endpoint, self.worker_id) for endpoint in claimed])
+            connection.execute("UPDATE feed_leases SET expires = ? WHERE owner = ?", (now + self.lease, self.worker_id))
+
+            self.held = (owned - set(released)) | set(claimed)
+            return claimed, lost, released
+
+        return self.locked(work)
+
+    def remove(self, endpoint):
+        """Forget the lease on [endpoint], the feed has gone"""
+        def work(connection):
+            connection.execute("DELETE FROM feed_leases WHERE endpoint = ?", (endpoint,))
+            self.held.discard(endpoint)
+        self.locked(work)
+
+    def release_all(self):
+        """Give up every lease this worker has, and its place among the workers, so the others take over straight away"""
+        def work(connection):
+            connection.execute("UPDATE feed_leases SET owner = NULL, expires = 0 WHERE owner = ?", (self.worker_id,))
+            connection.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+            self.held = set()
+        self.locked(work)
+
+    def status(self):
+        """The status of every worker, and the totals across those still alive"""
+        now = self.clock.time()
+        with self.lock:
+            rows = self.connection.execute("SELECT worker_id, host, pid, started, heartbeat, feeds, in_flight, validations, failures FROM workers ORDER BY worker_id").fetchall()
+            leases = self.connection.execute("SELECT COUNT(*), SUM(CASE WHEN owner IS NULL OR expires < ? THEN 1 ELSE 0 END) FROM feed_leases", (now,)).fetchone()
+
+        workers = []
+        for worker_id, host, pid, started, heartbeat, feeds, in_flight, validations, failures in rows:
+            workers.append({
+                "worker_id": worker_id,
+                "host": host,
+                "pid": pid,
+                "alive": heartbeat >= now - self.lease,
+                "uptime": round(now - started),
+                "last_seen": round(now - heartbeat, 1),
+                "feeds": feeds,
+                "in_flight": in_flight,
+                "validations": validations,
+                "failures": failures,
+            })
+        alive = [worker for worker in workers if worker["alive"]]
+        return {
+            "workers": workers,
+            "alive": len(alive),
+            "feeds": leases[0],
+            "unowned": leases[1] or 0,
+            "in_flight": sum(worker["in_flight"] for worker in alive),
+            "validations": sum(worker["validations"] for worker in workers),
+            "failures": sum(worker["failures"] for worker in workers),
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class ShardCoordinator(object):
+    """Keeps [scheduler] to the share of [feeds] leased to this worker by [leases], checking every [interval] seconds.
+
+    Stands in for the scheduler with SettingsWatcher, so feeds added, changed or removed in the settings are shared
+    out along with the rest. A feed taken over from another worker carries on where it left off as long as the
+    scheduler's state store is shared too.
+    """
+    def __init__(self, scheduler, leases, feeds, interval=15):
+        super(ShardCoordinator, self).__init__()
+        self.scheduler = scheduler
+        self.leases = leases
+        self.interval = interval
+        self.feeds = dict((feed.endpoint, feed) for feed in feeds)
+        self.lock = threading.Lock()
+        metrics.gauge('flmx_shard_feeds', 'Feeds leased to this worker', lambda: len(self.leases.held))
+
+    def status(self):
+        return {
+            "feeds": len(self.scheduler.feeds),
+            "in_flight": len([feed for feed in self.scheduler.feeds if feed.validation_start_time is not None]),
+            "validations": metrics.counter('flmx_validations_completed_total').total(),
+            "failures": metrics.counter('flmx_feed_failures_total').total(),
+        }
+
+    def sync(self):
+        """Bring the feeds being scheduled in line with the leases held, returning the endpoints added and removed"""
+        with self.lock:
+            busy = [feed.endpoint for feed in self.scheduler.feeds if feed.validation_start_time is not None]
+            claimed, lost, released = self.leases.sync(set(self.feeds), busy, self.status())
+
+            for endpoint in lost + released:
+                if endpoint in self.scheduler.endpoints:
+                    self.scheduler.remove_feed(endpoint)
+            for endpoint in claimed:
+                if endpoint not in self.scheduler.endpoints:
+                    self.scheduler.add_feed(self.feeds[endpoint])
+
+        if lost:
+            logger.warning("Lost the leases on {0} feeds to other workers".format(len(lost)))
+        if claimed or released:
+            logger.info("Took on {0} feeds and handed over {1}, now validating {2} of {3}".format(len(claimed), len(released), len(self.leases.held), len(self.feeds)))
+        return claimed, lost + released
+
+    def add_feed(self, feed):
+        with self.lock:
+            self.feeds[feed.endpoint] = feed
+
+    def update_feed(self, feed):
+        with self.lock:
+            if feed.endpoint in self.scheduler.endpoints:
+                self.feeds[feed.endpoint] = self.scheduler.update_feed(feed)
+            else:
+                self.feeds[feed.endpoint] = feed
+            return self.feeds[feed.endpoint]
+
+    def remove_feed(self, endpoint):
+        with self.lock:
+            feed = self.feeds.pop(endpoint)
+            if endpoint in self.scheduler.endpoints:
+                self.scheduler.remove_feed(endpoint)
+            self.leases.remove(endpoint)
+            return feed
+
+    def start(self):
+        def work():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.sync()
+                except Exception as e:
+                    logger.error("Unable to sync feed leases with {0}: {1}".format(self.leases.path, e))
+        thread = threading.Thread(target=work, name='flmx-shard-coordinator')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Hand every feed over to the other workers"""
+        with self.lock:
+            self.leases.release_all()
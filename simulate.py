@@ -0,0 +1,212 @@
+"""Replays the scheduler against a simulated validator on a virtual clock, to see how a set of feeds behaves over days
+of operation in a few seconds.
+
+Run `python simulate.py` to simulate 2000 feeds for a week, see `python simulate.py --help` for the options.
+"""
+import sys, json, time, random, threading, logging
+from optparse import OptionParser
+from datetime import datetime
+
+from app import Feed, JsonSettings
+from notify import parse_recipients
+from admission import AdmissionController
+from breaker import CircuitBreakers
+from clock import VirtualClock
+from scheduler import Scheduler, seconds
+
+class SimulatedValidator(object):
+    """Stands in for Validator on [clock], each validation taking [job_duration] seconds give or take half that.
+    A validation finds [issues] errors [failure_rate] of the time.
+    """
+    def __init__(self, clock, job_duration=600, failure_rate=0.1, issues=10, seed=0):
+        super(SimulatedValidator, self).__init__()
+        self.endpoint = 'simulated'
+        self.clock = clock
+        self.job_duration = job_duration
+        self.failure_rate = failure_rate
+        self.issues = issues
+        self.random = random.Random(seed)
+        self.jobs = {}
+        self.intervals = [] # When each validation started and finished, to work out the validator's concurrency.
+        self.lags = [] # How long after each feed was due its validation was started.
+        self.starts = 0
+        self.polls = 0
+        self.lock = threading.Lock()
+
+    def start(self, feed):
+        with self.lock:
+            started = self.clock.time()
+            finish = started + self.job_duration * self.random.uniform(0.5, 1.5)
+            self.jobs[feed.endpoint] = (started, finish)
+            self.intervals.append((started, finish))
+            self.starts += 1
+            if feed.last_validated is not None:
+                self.lags.append(max(0, seconds(self.clock.now() - feed.last_validated - feed.next_try)))
+        feed.validation_start_time = self.clock.now()
+
+    def poll_results(self, feed):
+        with self.lock:
+            self.polls += 1
+            started, finish = self.jobs[feed.endpoint]
+            if self.clock.time() < finish:
+                return False, False, 0, None
+            del self.jobs[feed.endpoint]
+            failed = self.random.random() < self.failure_rate
+
+        errors = [u'Simulated error {0}'.format(i) for i in range(self.issues)] if failed else []
+        feed.last_validated = self.clock.now()
+        feed.validation_start_time = None
+        response_json = {
+            "test-time": int(finish),
+            "test-duration": int(finish - started),
+            "total-issue-count": len(errors),
+            "validation-results": {"errors": errors, "warnings": []},
+        }
+        return True, not failed, len(errors), response_json
+
+    def concurrency(self, start, end):
+        """The most validations running at once between [start] and [end], and the average number running"""
+        events = sorted([(s, 1) for s, f in self.intervals] + [(min(f, end), -1) for s, f in self.intervals])
+        running = peak = 0
+        area = 0
+        last = start
+        for when, change in events:
+            area += running * (when - last)
+            last = when
+            running += change
+            peak = max(peak, running)
+        return peak, area / float(end - start)
+
+class SimulatedEmailer(object):
+    """Counts the emails queued on [clock], and how many would go out once those within [digest_window] seconds of
+    each other for the same recipients are combined"""
+    def __init__(self, clock, digest_window=0):
+        super(SimulatedEmailer, self).__init__()
+        self.clock = clock
+        self.digest_window = digest_window
+        self.queued = []
+        self.lock = threading.Lock()
+
+    def enqueue(self, recipients, subject, body, attachments=()):
+        with self.lock:
+            self.queued.append((self.clock.time(), parse_recipients(recipients)))
+
+    def sent(self):
+        windows = {}
+        sent = 0
+        for when, key in sorted(self.queued, key=lambda email: email[0]):
+            if key not in windows or when > windows[key] + self.digest_window:
+                windows[key] = when
+                sent += 1
+        return sent
+
+class SimulatedScheduler(Scheduler):
+    """Scheduler that works through due feeds itself rather than in its workers, keeping count as it goes"""
+    def __init__(self, *args, **kwargs):
+        self.completed = 0
+        Scheduler.__init__(self, *args, **kwargs)
+
+    def complete(self, feed, success, total_issues, response_json):
+        Scheduler.complete(self, feed, success, total_issues, response_json)
+        self.completed += 1
+
+    def tick(self):
+        for feed in self.pop_due(self.clock.now()):
+            self.dispatch(feed)
+
+def generate_feeds(count, next_tries, recipients=20):
+    """[count] feeds with next_try values taken in turn from [next_tries], failures going to one of [recipients] addresses"""
+    return [Feed('Feed {0}'.format(i), 'http://feed{0}.example.com/FLM/'.format(i), 'username', 'password', next_tries[i % len(next_tries)], False,
+        {"to": ["flmx-failures-{0}@example.com".format(i % recipients)]}) for i in range(count)]
+
+def run(feeds, options, settings=None):
+    """Simulate [feeds] for [options.days] days, returning what happened"""
+    settings = settings or {}
+    clock = VirtualClock(datetime(2013, 1, 1))
+    validator = SimulatedValidator(clock, options.job_duration, options.failure_rate, options.issues, options.seed)
+    emailer = SimulatedEmailer(clock, settings.get('email', {}).get('digest_window', options.digest_window))
+    admission = AdmissionController(clock=clock, **settings.get('admission', {
+        "max_in_flight": options.max_in_flight,
+        "start_rate": options.start_rate,
+    }))
+    scheduler_settings = settings.get('scheduler', {
+        "poll_interval": options.poll_interval,
+        "poll_max": options.poll_max,
+        "stagger": options.stagger,
+        "jitter": options.jitter,
+    })
+    scheduler_settings.pop('workers', None)
+    scheduler = SimulatedScheduler(validator, emailer, feeds, workers=1, admission=admission, clock=clock,
+        breakers=CircuitBreakers('feed', clock=clock, **settings.get('breaker', {})), **scheduler_settings)
+    scheduler.stagger.random.seed(options.seed)
+
+    started = time.time()
+    start = clock.time()
+    end = start + options.days * 86400
+    while True:
+        scheduler.tick()
+        with scheduler.condition:
+            due = scheduler.queue[0][0] if scheduler.queue else None
+        if due is None:
+            break
+        clock.advance_to(due)
+        if clock.time() >= end:
+            break
+
+    lags = sorted(validator.lags) or [0]
+    peak, mean = validator.concurrency(start, end)
+    return {
+        "feeds": len(feeds),
+        "days": options.days,
+        "real_seconds": round(time.time() - started, 1),
+        "validations": scheduler.completed,
+        "validations_per_day": int(scheduler.completed / float(options.days)),
+        "start_requests": validator.starts,
+        "poll_requests": validator.polls,
+        "polls_per_validation": round(validator.polls / float(max(scheduler.completed, 1)), 2),
+        "polls_per_hour": int(validator.polls / (options.days * 24.0)),
+        "peak_concurrency": peak,
+        "mean_concurrency": round(mean, 1),
+        "lag_mean_seconds": round(sum(lags) / len(lags), 1),
+        "lag_p95_seconds": round(lags[int(len(lags) * 0.95)], 1),
+        "lag_max_seconds": round(lags[-1], 1),
+        "emails_queued": len(emailer.queued),
+        "emails_sent": emailer.sent(),
+    }
+
+def parse_options(args):
+    parser = OptionParser(usage="usage: python simulate.py [options]")
+    parser.add_option("--settings", help="take the feeds, scheduler, admission, breaker and digest_window settings from this settings file instead of the options below")
+    parser.add_option("--feeds", type="int", default=2000, help="feeds to simulate [default: %default]")
+    parser.add_option("--next-try", default="1h,6h,1d", help="comma separated next_try values, handed out to the feeds in turn [default: %default]")
+    parser.add_option("--poll-interval", type="float", default=60, help="scheduler poll_interval in seconds [default: %default]")
+    parser.add_option("--poll-max", type="float", default=1800, help="scheduler poll_max in seconds [default: %default]")
+    parser.add_option("--stagger", type="float", default=0, help="scheduler stagger [default: %default]")
+    parser.add_option("--jitter", type="float", default=0, help="scheduler jitter [default: %default]")
+    parser.add_option("--max-in-flight", type="int", help="admission max_in_flight [default: no limit]")
+    parser.add_option("--start-rate", type="float", help="admission start_rate [default: no limit]")
+    parser.add_option("--digest-window", type="float", default=300, help="email digest_window in seconds [default: %default]")
+    parser.add_option("--days", type="float", default=7, help="days to simulate [default: %default]")
+    parser.add_option("--job-duration", type="float", default=600, help="average seconds each simulated validation takes [default: %default]")
+    parser.add_option("--failure-rate", type="float", default=0.1, help="fraction of validations that find issues [default: %default]")
+    parser.add_option("--issues", type="int", default=10, help="errors found by each failing validation [default: %default]")
+    parser.add_option("--seed", type="int", default=0, help="seed for the simulated validator and the scheduler's jitter [default: %default]")
+    return parser.parse_args(args)
+
+def main():
+    options, args = parse_options(sys.argv[1:])
+    logging.getLogger('flmx-logger').addHandler(logging.StreamHandler())
+    logging.getLogger('flmx-logger').setLevel(logging.ERROR)
+
+    if options.settings:
+        settings = JsonSettings(options.settings).json_data
+        feeds = [Feed(**feed) for feed in settings['feeds']]
+    else:
+        settings = None
+        feeds = generate_feeds(options.feeds, options.next_try.split(','))
+
+    result = run(feeds, options, settings)
+    sys.stdout.write(json.dumps(result, indent=4, separators=(',', ': '), sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main()
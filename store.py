@@ -0,0 +1,96 @@
+import time, sqlite3, threading
+from datetime import datetime
+
+def to_timestamp(value):
+    if value is None:
+        return None
+    return time.mktime(value.timetuple()) + value.microsecond / 1000000.0
+
+def from_timestamp(value):
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value)
+
+class StateStore(object):
+    """Keeps each feed's schedule and the outcome of its validations in a local sqlite database, so they survive a restart"""
+    def __init__(self, path):
+        super(StateStore, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.create()
+
+    def create(self):
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS feed_state (endpoint TEXT PRIMARY KEY, last_validated REAL, validation_start_time REAL, validator_endpoint TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, endpoint TEXT NOT NULL, completed REAL NOT NULL, success INTEGER NOT NULL, total_issues INTEGER NOT NULL, test_duration INTEGER)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_endpoint_completed ON results (endpoint, completed)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS feed_fingerprints (endpoint TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS feed_issues (endpoint TEXT NOT NULL, kind TEXT NOT NULL, issue TEXT NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS feed_issues_endpoint ON feed_issues (endpoint)")
+
+            # Databases from before results were fingerprinted, or there could be several validators, need the columns adding.
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]
+            if 'fingerprint' not in columns:
+                self.connection.execute("ALTER TABLE results ADD COLUMN fingerprint TEXT")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(feed_state)")]
+            if 'validator_endpoint' not in columns:
+                self.connection.execute("ALTER TABLE feed_state ADD COLUMN validator_endpoint TEXT")
+            self.connection.commit()
+
+    def checkpoint(self, feed):
+        """Save where [feed] is up to with its validation"""
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO feed_state (endpoint, last_validated, validation_start_time, validator_endpoint) VALUES (?, ?, ?, ?)",
+                (feed.endpoint, to_timestamp(feed.last_validated), to_timestamp(feed.validation_start_time), feed.validator_endpoint))
+            self.connection.commit()
+
+    def record(self, feed, success, total_issues, response_json, fingerprint=None):
+        """Save the outcome of a finished validation of [feed], along with where it is up to"""
+        with self.lock:
+            self.connection.execute("INSERT INTO results (endpoint, completed, success, total_issues, test_duration, fingerprint) VALUES (?, ?, ?, ?, ?, ?)",
+                (feed.endpoint, to_timestamp(feed.last_validated), int(success), total_issues, response_json.get('test-duration'), fingerprint))
+            self.connection.execute("INSERT OR REPLACE INTO feed_state (endpoint, last_validated, validation_start_time, validator_endpoint) VALUES (?, ?, ?, ?)",
+                (feed.endpoint, to_timestamp(feed.last_validated), to_timestamp(feed.validation_start_time), feed.validator_endpoint))
+            self.connection.commit()
+
+    def restore(self, feeds):
+        """Put back the saved state of each of [feeds], returning how many had any"""
+        restored = 0
+        with self.lock:
+            for feed in feeds:
+                row = self.connection.execute("SELECT last_validated, validation_start_time, validator_endpoint FROM feed_state WHERE endpoint = ?", (feed.endpoint,)).fetchone()
+                if row is not None:
+                    feed.last_validated = from_timestamp(row[0])
+                    feed.validation_start_time = from_timestamp(row[1])
+                    feed.validator_endpoint = row[2]
+                    restored += 1
+        return restored
+
+    def history(self, endpoint, limit=10):
+        """The most recent [limit] results for [endpoint] as (completed, success, total_issues, test_duration), newest first"""
+        with self.lock:
+            rows = self.connection.execute("SELECT completed, success, total_issues, test_duration FROM results WHERE endpoint = ? ORDER BY completed DESC LIMIT ?", (endpoint, limit)).fetchall()
+        return [(from_timestamp(completed), bool(success), total_issues, test_duration) for completed, success, total_issues, test_duration in rows]
+
+    def issues(self, endpoint):
+        """The fingerprint, errors and warnings saved for [endpoint], or None if nothing has been saved"""
+        with self.lock:
+            saved = self.connection.execute("SELECT fingerprint FROM feed_fingerprints WHERE endpoint = ?", (endpoint,)).fetchone()
+            rows = self.connection.execute("SELECT kind, issue FROM feed_issues WHERE endpoint = ?", (endpoint,)).fetchall()
+        if saved is None:
+            return None
+        return saved[0], frozenset(issue for kind, issue in rows if kind == 'error'), frozenset(issue for kind, issue in rows if kind == 'warning')
+
+    def save_issues(self, endpoint, fingerprint, errors, warnings):
+        """Replace the fingerprint, errors and warnings saved for [endpoint]"""
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO feed_fingerprints (endpoint, fingerprint) VALUES (?, ?)", (endpoint, fingerprint))
+            self.connection.execute("DELETE FROM feed_issues WHERE endpoint = ?", (endpoint,))
+            self.connection.executemany("INSERT INTO feed_issues (endpoint, kind, issue) VALUES (?, ?, ?)",
+                [(endpoint, 'error', issue) for issue in errors] + [(endpoint, 'warning', issue) for issue in warnings])
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
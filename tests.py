@@ -1,8 +1,24 @@
-import unittest, time, json, datetime, os
-import jsonschema
+import unittest, time, json, datetime, os, gzip, shutil, smtplib, sqlite3, tempfile
+import jsonschema, requests
 
 from notify import Emailer, NotifyError
-from app import Feed, JsonSettings, Validator
+from app import Feed, JsonSettings, Validator, SchemaRegistry, SettingsWatcher, ReadTimeout, schemas, parse_options, validator_settings, settings_relative
+from scheduler import Scheduler, PollPlanner, Stagger
+from receiver import ResultsReceiver
+from store import StateStore
+from issues import IssueTracker, read_issues, fingerprint
+from benchmark import FakeValidator, SmtpSink, measure_memory, parse_options as parse_benchmark_options
+from dispatch import Dispatcher
+from admission import AdmissionController, TokenBucket
+from breaker import CircuitBreaker, CircuitBreakers, CircuitOpenError
+from metrics import Metrics, MetricsServer, metrics
+from logs import LogPipeline, feed_extra
+from batch import BatchScheduler, summary, junit, run_once
+from results import ResultsReader, IssueSorter, IssueFile
+from clock import VirtualClock
+from shard import LeaseStore, ShardCoordinator
+import simulate
+from xml.etree import ElementTree
 
 class EmailerTests(unittest.TestCase):
     def setUp(self):
@@ -43,12 +59,113 @@ class EmailerTests(unittest.TestCase):
         }
         recipient_addrs, message = self.emailer.format(recipients, u"This is the subject!", u"This is the body!")
 
-        expected_recipient_addrs = ['test-email1@example.com', 'test-email2@example.com', 'test-email@example.com', 'test-email3@example.com', 'test-email4@example.com', 'test-email5@example.com']
+        # Whatever order they are given in, 'to' comes first, then 'cc' and 'bcc'.
+        expected_recipient_addrs = ['test-email@example.com', 'test-email1@example.com', 'test-email2@example.com', 'test-email3@example.com', 'test-email4@example.com', 'test-email5@example.com']
         self.assertEqual(recipient_addrs, expected_recipient_addrs)
 
-        expected_msg = u"From: flmx-validator@example.com\r\nCc: test-email1@example.com, test-email2@example.com\r\nTo: test-email@example.com\r\nSubject: This is the subject!\r\n\r\nThis is the body!"
+        expected_msg = u"From: flmx-validator@example.com\r\nTo: test-email@example.com\r\nCc: test-email1@example.com, test-email2@example.com\r\nSubject: This is the subject!\r\n\r\nThis is the body!"
         self.assertEqual(message, expected_msg)
 
+        reordered = dict((cat, recipients[cat]) for cat in ("bcc", "cc", "to"))
+        self.assertEqual(self.emailer.format(reordered, u"This is the subject!", u"This is the body!"), (expected_recipient_addrs, expected_msg))
+
+    def test_recipients_left_alone(self):
+        # Test that the recipients given are parsed without being changed.
+        recipients = {"to": "test-email@example.com, test-email1@example.com"}
+        recipient_addrs, message = self.emailer.format(recipients, u"This is the subject!", u"This is the body!")
+        self.assertEqual(recipient_addrs, ['test-email@example.com', 'test-email1@example.com'])
+        self.assertEqual(recipients, {"to": "test-email@example.com, test-email1@example.com"})
+
+class StubSMTP(object):
+    """Stands in for an smtplib connection, dropping the connection on the first [drops] emails"""
+    def __init__(self, drops=0):
+        self.drops = drops
+        self.sent = []
+
+    def sendmail(self, sender, recipient_addrs, message):
+        if self.drops:
+            self.drops -= 1
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.sent.append((recipient_addrs, message))
+
+    def quit(self):
+        pass
+
+class EmailerDeliveryTests(unittest.TestCase):
+    def setUp(self):
+        self.emailer = Emailer({"host": "localhost", "port": 25, "sender": "flmx-validator@example.com", "digest_window": 0})
+        self.connections = []
+        def connect():
+            self.emailer.server = StubSMTP(drops=1 if not self.connections else 0)
+            self.connections.append(self.emailer.server)
+        self.emailer.connect = connect
+
+    def test_connection_reused(self):
+        # Test that emails after the first go out over the same connection.
+        self.emailer.connect()
+        self.connections[0].drops = 0
+        self.emailer.send({"to": "test-email@example.com"}, u"One", u"Body")
+        self.emailer.send({"to": "test-email@example.com"}, u"Two", u"Body")
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(len(self.connections[0].sent), 2)
+
+    def test_reconnect(self):
+        # Test that a dropped connection is reopened and the email sent.
+        self.emailer.send({"to": "test-email@example.com"}, u"One", u"Body")
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(len(self.connections[1].sent), 1)
+
+    def test_digest(self):
+        # Test that emails for the same recipients are combined, whichever format the recipients are in.
+        emails = [
+            ({"to": ["a@example.com", "b@example.com"]}, u"First", u"Body one"),
+            ({"to": "c@example.com"}, u"Second", u"Body two"),
+            ({"to": "b@example.com, a@example.com"}, u"Third", u"Body three"),
+        ]
+        digests = self.emailer.digest(emails)
+        self.assertEqual(len(digests), 2)
+        self.assertEqual(digests[0][1], u"Digest of 2 notifications")
+        self.assertEqual(digests[0][2], u"First\r\n=====\r\nBody one\r\n\r\nThird\r\n=====\r\nBody three")
+        self.assertEqual(digests[1], emails[1])
+
+    def test_attachments(self):
+        # Test that attached files are sent gzipped alongside the body, and carried over into a digest.
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(path, 'wb') as attachment:
+                attachment.write(b'compressed results')
+            recipient_addrs, message = self.emailer.format({"to": "test-email@example.com"}, u"Subject", u"Body", [(u"feed-results.json.gz", path)])
+            self.assertEqual(recipient_addrs, ['test-email@example.com'])
+            self.assertEqual('Content-Type: application/gzip' in message, True)
+            self.assertEqual('filename="feed-results.json.gz"' in message, True)
+
+            digests = self.emailer.digest([({"to": "a@example.com"}, u"One", u"Body", [(u"one.json.gz", path)]), ({"to": "a@example.com"}, u"Two", u"Body", ())])
+            self.assertEqual(digests[0][3], [(u"one.json.gz", path)])
+        finally:
+            os.remove(path)
+
+    def test_background_delivery(self):
+        # Test that queued emails are sent by the worker thread.
+        self.emailer.digest_window = 1
+        self.emailer.start()
+        self.emailer.enqueue({"to": "test-email@example.com"}, u"One", u"Body")
+        self.emailer.enqueue({"to": "test-email@example.com"}, u"Two", u"Body")
+        self.emailer.flush()
+        self.assertEqual(len(self.connections[-1].sent), 1)
+        self.assertEqual(u"Subject: Digest of 2 notifications" in self.connections[-1].sent[0][1], True)
+
+    def test_background_delivery_attachments(self):
+        # Test that attachments handed over with queued emails are removed once they have been sent.
+        handle, path = tempfile.mkstemp()
+        os.write(handle, b'compressed results')
+        os.close(handle)
+        self.emailer.start()
+        self.emailer.enqueue({"to": "test-email@example.com"}, u"One", u"Body", [(u"feed-results.json.gz", path)])
+        self.emailer.flush()
+        self.assertEqual('filename="feed-results.json.gz"' in self.connections[-1].sent[0][1], True)
+        self.assertEqual(os.path.exists(path), False)
+
 class FeedTests(unittest.TestCase):
 
     def test_raw_next_try_minutes(self):
@@ -74,6 +191,17 @@ class FeedTests(unittest.TestCase):
         # Test that the feed correctly recognises a next_try value of 10s as being invalid
         self.assertRaises(ValueError, Feed, 'name', 'endpoint', 'username', 'password', '10s', False, {})
 
+    def test_shared(self):
+        # Test that feeds with the same credentials, recipients and next_try share them, parsed once.
+        a = Feed('a', 'endpoint-a', 'username', 'password', '1d', False, {"to": ["one@example.com", "two@example.com"], "cc": "three@example.com"})
+        b = Feed('b', 'endpoint-b', 'username', 'password', '1d', False, {"cc": ["three@example.com"], "to": "one@example.com, two@example.com"})
+        self.assertTrue(a.credentials is b.credentials)
+        self.assertTrue(a.failure_email is b.failure_email)
+        self.assertTrue(a.next_try is b.next_try)
+        self.assertEqual((b.username, b.password), ('username', 'password'))
+        self.assertEqual(a.failure_email.items(), (("to", ("one@example.com", "two@example.com")), ("cc", ("three@example.com",))))
+        self.assertRaises(AttributeError, setattr, a, 'notes', 'no room for these')
+
 class JsonSettingsTests(unittest.TestCase):
 
     test_settings_file_path = 'test_settings.json'
@@ -171,6 +299,56 @@ class JsonSettingsTests(unittest.TestCase):
         # Test that a invalid json file cannot be loaded
         self.assertRaises(jsonschema.ValidationError, JsonSettings, self.invalid_settings_file_path)
 
+class SettingsWatcherTests(unittest.TestCase):
+    settings_file_path = 'watched_settings.json'
+
+    def feed_settings(self, name, next_try="10m"):
+        return {"name": name, "endpoint": "http://{0}/FLM/".format(name), "username": "isdcf", "password": "isdcf",
+                "next_try": next_try, "ignore_warnings": False, "failure_email": {"to": ["flmx-failures@example.com"]}}
+
+    def write(self, feeds, mtime):
+        with open(self.settings_file_path, 'w') as settings_file:
+            json.dump({"feeds": feeds, "validator": {"endpoint": "http://flm.foxpico.com/validator", "username": "isdcf", "password": "isdcf"},
+                       "email": {"host": "localhost", "port": 25, "sender": "flmx-validator@example.com"}}, settings_file)
+        os.utime(self.settings_file_path, (mtime, mtime))
+
+    def setUp(self):
+        self.write([self.feed_settings("one"), self.feed_settings("two"), self.feed_settings("three")], 1000)
+        settings = JsonSettings(self.settings_file_path)
+        self.validator = StubValidator()
+        self.scheduler = Scheduler(self.validator, StubEmailer(), [Feed(**feed) for feed in settings.json_data['feeds']])
+        self.scheduler.tick()
+        self.watcher = SettingsWatcher(self.settings_file_path, settings, self.scheduler)
+
+    def tearDown(self):
+        os.remove(self.settings_file_path)
+
+    def test_unchanged(self):
+        self.assertEqual(self.watcher.check(), False)
+
+    def test_apply_changes(self):
+        # Test that only the added, removed and changed feeds are touched.
+        one = self.scheduler.endpoints["http://one/FLM/"]
+        self.write([self.feed_settings("one", "1h"), self.feed_settings("two"), self.feed_settings("four")], 2000)
+        self.assertEqual(self.watcher.check(), True)
+        self.assertEqual(sorted(self.scheduler.endpoints.keys()), ["http://four/FLM/", "http://one/FLM/", "http://two/FLM/"])
+        self.assertEqual(self.scheduler.endpoints["http://one/FLM/"] is one, True)
+        self.assertEqual(one.next_try, datetime.timedelta(hours=1))
+        self.assertEqual(one.validation_start_time is not None, True)
+
+        # Only the new feed is due to start, the removed one is never picked up again.
+        self.scheduler.tick()
+        self.assertEqual([feed.name for feed in self.validator.started[3:]], ["four"])
+
+    def test_reject_invalid(self):
+        # Test that a bad edit is ignored, leaving the feeds as they were.
+        self.write([self.feed_settings("one", "10s")], 2000)
+        self.assertEqual(self.watcher.check(), False)
+        self.assertEqual(len(self.scheduler.endpoints), 3)
+        self.write([self.feed_settings("one"), self.feed_settings("one")], 3000)
+        self.assertEqual(self.watcher.check(), False)
+        self.assertEqual(len(self.scheduler.endpoints), 3)
+
 class ValidatorTests(unittest.TestCase):
     populated_json_errors_and_warnings = {
         "test-duration": 2219,
@@ -334,5 +512,1267 @@ class ValidatorTests(unittest.TestCase):
         self.invalid_json["test-time"] = int(time.time())
         self.assertRaises(jsonschema.ValidationError, self.validator.handle_results_response, feed, json.dumps(self.invalid_json))
 
+class SchemaRegistryTests(unittest.TestCase):
+    def test_validator_compiled_once(self):
+        # Test that asking for the same schema twice hands back the same compiled validator.
+        self.assertEqual(schemas.validator('results') is schemas.validator('results'), True)
+        self.assertEqual(schemas.validator('results') is schemas.validator('results', structural_only=True), False)
+
+    def test_structural_only(self):
+        # Test that structural mode still checks the document's shape but not the items in its arrays.
+        result = dict(ValidatorTests.failure_json)
+        result["validation-results"] = {"errors": [1, 2, 3]}
+        self.assertRaises(jsonschema.ValidationError, schemas.validate, 'results', result)
+        schemas.validate('results', result, structural_only=True)
+        self.assertRaises(jsonschema.ValidationError, schemas.validate, 'results', ValidatorTests.invalid_json, True)
+
+    def test_structural_threshold(self):
+        # Test that only results bigger than the threshold skip checking their items.
+        feed = Feed('name', 'endpoint', 'username', 'password', '10m', False, {})
+        feed.validation_start_time = datetime.datetime.now() - datetime.timedelta(minutes=10)
+        result = dict(ValidatorTests.failure_json)
+        result["test-time"] = int(time.time())
+        result["validation-results"] = {"errors": [1, 2, 3]}
+        self.assertRaises(jsonschema.ValidationError, Validator("endpoint", "username", "password").handle_results_response, feed, json.dumps(result))
+        validation_finished, total_issues, response_json = Validator("endpoint", "username", "password", structural_threshold=10).handle_results_response(feed, json.dumps(result))
+        self.assertEqual(total_issues, 3)
+
+    def test_invalid_schema(self):
+        # Test that a broken schema is caught when it is first loaded.
+        registry = SchemaRegistry(os.path.dirname(os.path.realpath(__file__)))
+        registry.load = lambda name: {"type": 12}
+        self.assertRaises(jsonschema.SchemaError, registry.validator, 'broken')
+
+class StubResponse(object):
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def iter_content(self, chunk_size=1):
+        data = self.text.encode('utf-8')
+        return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    def close(self):
+        pass
+
+class StubSession(object):
+    """Stands in for requests.Session, raising or returning each of [outcomes] in turn"""
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def get(self, url, params=None, timeout=None, stream=False):
+        self.calls.append((url, params, timeout))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+class ValidatorSessionTests(unittest.TestCase):
+    def setUp(self):
+        self.validator = Validator("endpoint", "username", "password", retries=2, backoff=0, start_timeout=1, poll_timeout=10)
+        self.feed = Feed('name', 'endpoint', 'username', 'password', '10m', False, {})
+
+    def test_session_auth(self):
+        # Test that credentials are set once on the session rather than passed with every request.
+        self.assertEqual(self.validator.session.auth, ("username", "password"))
+
+    def test_start_timeout(self):
+        # Test that the expected timeout on starting a validation marks it as started without retrying.
+        self.validator.session = StubSession([ReadTimeout()])
+        self.validator.start(self.feed)
+        self.assertEqual(self.feed.validation_start_time is not None, True)
+        self.assertEqual(len(self.validator.session.calls), 1)
+        self.assertEqual(self.validator.session.calls[0][2], 1)
+
+    def test_start_connect_timeout(self):
+        # Test that not reaching the validator at all isn't taken as the validation having started.
+        if not hasattr(requests.exceptions, 'ConnectTimeout'):
+            # Older requests only have the one Timeout, see app.ReadTimeout.
+            return
+        self.validator.session = StubSession([requests.exceptions.ConnectTimeout()] * 3)
+        self.assertRaises(requests.exceptions.ConnectTimeout, self.validator.start, self.feed)
+        self.assertEqual(self.feed.validation_start_time, None)
+        self.assertEqual(len(self.validator.session.calls), 3)
+        self.assertEqual(self.validator.breaker.failed_count, 1)
+
+    def test_poll_retries(self):
+        # Test that polling retries when the validator can't be reached and uses the poll timeout.
+        result = dict(ValidatorTests.success_json)
+        result["test-time"] = int(time.time())
+        self.feed.validation_start_time = datetime.datetime.now() - datetime.timedelta(minutes=10)
+        self.validator.session = StubSession([requests.exceptions.ConnectionError(), requests.exceptions.Timeout(), StubResponse(200, json.dumps(result))])
+        completed, success, total_issues, response_json = self.validator.poll_results(self.feed)
+        self.assertEqual(completed, True)
+        self.assertEqual(len(self.validator.session.calls), 3)
+        self.assertEqual(self.validator.session.calls[2][2], 10)
+
+    def test_poll_retries_exhausted(self):
+        # Test that the error is raised once every retry has failed.
+        self.feed.validation_start_time = datetime.datetime.now()
+        self.validator.session = StubSession([requests.exceptions.ConnectionError()] * 3)
+        self.assertRaises(requests.exceptions.ConnectionError, self.validator.poll_results, self.feed)
+        self.assertEqual(len(self.validator.session.calls), 3)
+
+def make_feeds(count, next_try='10m', failure_email=None):
+    """[count] feeds named feed0, feed1... with endpoints endpoint0, endpoint1..."""
+    return [Feed('feed{0}'.format(i), 'endpoint{0}'.format(i), 'username', 'password', next_try, False,
+        failure_email if failure_email is not None else {"to": "test-email@example.com"}) for i in range(count)]
+
+class StubValidator(object):
+    """Stands in for Validator, finishing each feed on its first poll with the given number of issues"""
+    def __init__(self, total_issues=0, duration=5):
+        self.endpoint = "endpoint"
+        self.breaker = CircuitBreaker('validator', self.endpoint)
+        self.max_in_flight = None
+        self.start_rate = None
+        self.start_burst = 1
+        self.total_issues = total_issues
+        self.duration = duration
+        self.started = []
+        self.polled = []
+
+    def start(self, feed):
+        self.started.append(feed)
+        feed.validation_start_time = datetime.datetime.now()
+
+    def poll_results(self, feed):
+        self.polled.append(feed)
+        feed.last_validated = datetime.datetime.now()
+        feed.validation_start_time = None
+        return True, self.total_issues == 0, self.total_issues, {"total-issue-count": self.total_issues, "test-duration": self.duration}
+
+class StubEmailer(object):
+    def __init__(self):
+        self.sent = []
+        self.attachments = []
+
+    def enqueue(self, recipients, subject, body, attachments=()):
+        self.sent.append((recipients, subject, body))
+        self.attachments.extend(attachments)
+
+class ResultsReaderTests(unittest.TestCase):
+    result = {
+        "test-time": 1357000000,
+        "test-duration": 10,
+        "total-issue-count": 53,
+        "url": "http://redacted/FLM/",
+        "validation-type": "all-data",
+        "validation-results": {
+            "errors": [u"Error  {0} \u00e9".format(i) for i in range(50)],
+            "warnings": [u"A warning", u"Another warning", u"A warning"]
+        }
+    }
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def read(self, text, chunk_size, sample_size=5, sorter=None):
+        reader = ResultsReader(sample_size, sorter)
+        for i in range(0, len(text), chunk_size):
+            reader.feed(text[i:i + chunk_size])
+        return reader.close()
+
+    def test_chunks(self):
+        # Test that however the results are split up, the same sample and counts come out.
+        text = json.dumps(self.result, indent=4)
+        for chunk_size in (1, 7, 4096):
+            results = self.read(text, chunk_size)
+            self.assertEqual((results["test-time"], results["url"], results["total-issue-count"]), (1357000000, "http://redacted/FLM/", 53))
+            self.assertEqual(results["validation-results"]["errors"], self.result["validation-results"]["errors"][:5])
+            self.assertEqual((results.error_count, results.warning_count), (50, 3))
+
+    def test_sorted_issues(self):
+        # Test that every distinct issue is sorted on to disk, a few at a time, and fingerprinted the same way as
+        # issues held in memory.
+        sorter = IssueSorter(self.spool_dir, chunk_size=7)
+        self.read(json.dumps(self.result), 4096, sorter=sorter)
+        issues = IssueFile(self.spool_dir, 'endpoint')
+        errors, warnings = sorter.commit(issues.path)
+        lines = list(issues.lines())
+        self.assertEqual(len(lines), 52)
+        self.assertEqual(lines, sorted(lines))
+        self.assertEqual(lines[-2:], [u"W A warning", u"W Another warning"])
+        self.assertEqual(len(list(issues.lines(ignore_warnings=True))), 50)
+        self.assertEqual(sorted(os.listdir(self.spool_dir)), [os.path.basename(issues.path)])
+
+        expected = read_issues(Feed('name', 'endpoint', 'username', 'password', '10m', False, {}), self.result)
+        self.assertEqual((errors + warnings).hexdigest(), fingerprint(*expected))
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, self.read, '{"test-time": 1', 4)
+        self.assertRaises(ValueError, self.read, '{"test-time": 1}}', 4)
+        self.assertRaises(ValueError, self.read, '["test-time"]', 4)
+
+    def test_describe(self):
+        description = self.read(json.dumps(self.result), 4096, sample_size=2).describe()
+        self.assertEqual(description.splitlines()[:5], [u"50 errors and 3 warnings, the full results are attached.", u"", u"Errors (first 2 of 50):", u"- Error  0 \u00e9", u"- Error  1 \u00e9"])
+
+    def test_streamed_poll(self):
+        # Test that polled results are spooled to disk, gzipped, and the first failure email attaches them.
+        result = dict(self.result, **{"test-time": int(time.time()) + 1})
+        validator = Validator("endpoint", "username", "password", spool_dir=self.spool_dir, sample_size=5)
+        validator.session = StubSession([StubResponse(200, json.dumps(result))])
+        feed = Feed('A feed', 'http://redacted/FLM/', 'username', 'password', '10m', False, {"to": "test-email@example.com"})
+        feed.validation_start_time = datetime.datetime.now()
+
+        completed, success, total_issues, response_json = validator.poll_results(feed)
+        self.assertEqual((completed, success, total_issues), (True, False, 53))
+        self.assertEqual(len(response_json["validation-results"]["errors"]), 5)
+        with gzip.open(response_json.spool_path) as spooled:
+            self.assertEqual(json.loads(spooled.read().decode('utf-8')), result)
+
+        emailer = StubEmailer()
+        scheduler = Scheduler(validator, emailer, [])
+        scheduler.complete(feed, success, total_issues, response_json)
+        self.assertEqual([filename for filename, path in emailer.attachments], [u"A-feed-results.json.gz"])
+        self.assertEqual(emailer.sent[0][2].startswith(u"50 errors and 3 warnings"), True)
+
+        # The attachment is a file of its own, left alone when the next results are swapped in.
+        attachment = emailer.attachments[0][1]
+        self.assertTrue(attachment != response_json.spool_path)
+        feed.validation_start_time = datetime.datetime.now()
+        validator.session = StubSession([StubResponse(200, json.dumps(dict(result, **{"test-time": int(time.time()) + 2})))])
+        validator.poll_results(feed)
+        with gzip.open(attachment) as attached:
+            self.assertEqual(json.loads(attached.read().decode('utf-8')), result)
+
+    def test_streamed_poll_unfinished(self):
+        # Test that the results of the validation before, still there while the new one runs, are neither read in
+        # full nor kept in place of the last finished results.
+        validator = Validator("endpoint", "username", "password", spool_dir=self.spool_dir, sample_size=5)
+        feed = Feed('A feed', 'http://redacted/FLM/', 'username', 'password', '10m', False, {"to": "test-email@example.com"})
+        result = dict(self.result, **{"test-time": int(time.time()) + 1})
+        validator.session = StubSession([StubResponse(200, json.dumps(result))])
+        feed.validation_start_time = datetime.datetime.now()
+        response_json = validator.poll_results(feed)[3]
+        issues_path = response_json.issues.path
+
+        feed.validation_start_time = datetime.datetime.now() + datetime.timedelta(seconds=10)
+        validator.session = StubSession([StubResponse(200, json.dumps(dict(self.result, **{"test-time": int(time.time()) + 2})))])
+        self.assertEqual(validator.poll_results(feed), (False, False, 0, None))
+        with gzip.open(response_json.spool_path) as spooled:
+            self.assertEqual(json.loads(spooled.read().decode('utf-8')), result)
+        self.assertTrue(os.path.exists(issues_path))
+        self.assertEqual(sorted(name for name in os.listdir(self.spool_dir) if not name.endswith('.issues.gz')), sorted([os.path.basename(response_json.spool_path), os.path.basename(issues_path)]))
+
+    def test_streamed_changes(self):
+        # Test that later failures are compared with the one before on disk, every issue rather than the sample, with
+        # only a few changes listed and the rest attached.
+        validator = Validator("endpoint", "username", "password", spool_dir=self.spool_dir, sample_size=5)
+        feed = Feed('A feed', 'http://redacted/FLM/', 'username', 'password', '10m', False, {"to": "test-email@example.com"})
+        emailer = StubEmailer()
+        scheduler = Scheduler(validator, emailer, [])
+        scheduler.issues.limit = 3
+
+        errors = self.result["validation-results"]["errors"]
+        for i, changed in enumerate([errors, errors[:40] + [u"New error {0}".format(i) for i in range(5)], list(reversed(errors[:40])) + [u"New error {0}".format(i) for i in range(5)]]):
+            result = dict(self.result, **{"test-time": int(time.time()) + 1 + i})
+            result["validation-results"] = {"errors": changed, "warnings": []}
+            validator.session = StubSession([StubResponse(200, json.dumps(result))])
+            feed.validation_start_time = datetime.datetime.now()
+            scheduler.complete(feed, *validator.poll_results(feed)[1:])
+
+        lines = emailer.sent[1][2].splitlines()
+        self.assertEqual(lines[0], u"5 new, 10 resolved and 40 unchanged issues since the last validation.")
+        self.assertEqual(lines[2:6], [u"New errors (first 3 of 5):", u"- New error 0", u"- New error 1", u"- New error 2"])
+        self.assertEqual(lines[-1], u"The full results are attached.")
+        self.assertEqual(len(emailer.attachments), 2)
+
+        # The same issues in a different order are no change, even though the sample is different.
+        self.assertEqual(emailer.sent[2][1].startswith(u"Validation still failing"), True)
+        self.assertEqual(emailer.sent[2][2], u"Still failing with the same 45 errors and 0 warnings as the last validation.")
+        self.assertEqual(len(emailer.attachments), 2)
+
+    def test_streamed_ignore_warnings(self):
+        feed = Feed('name', 'endpoint', 'username', 'password', '10m', True, {})
+        feed.validation_start_time = datetime.datetime(2012, 1, 1)
+        completed, total_issues, response_json = Validator("endpoint", "username", "password").check_results(feed, self.read(json.dumps(self.result), 4096))
+        self.assertEqual((completed, total_issues), (True, 50))
+        self.assertEqual(IssueTracker().compare(feed, response_json).warnings, frozenset())
+
+class PollPlannerTests(unittest.TestCase):
+    def setUp(self):
+        self.planner = PollPlanner(poll_interval=60, poll_max=300, backoff=2, smoothing=0.5)
+        self.feed = Feed('name', 'endpoint', 'username', 'password', '10m', False, {})
+        self.feed.validation_start_time = datetime.datetime(2013, 1, 1)
+
+    def test_first_poll_without_history(self):
+        # Test that a feed with no history is first polled after the poll interval.
+        self.assertEqual(self.planner.first_poll(self.feed), datetime.datetime(2013, 1, 1, 0, 1))
+
+    def test_first_poll_with_history(self):
+        # Test that the first poll lands on the rolling estimate of the feed's test duration.
+        self.planner.record(self.feed, 10)
+        self.assertEqual(self.planner.first_poll(self.feed), datetime.datetime(2013, 1, 1, 0, 0, 10))
+        self.planner.record(self.feed, 30)
+        self.assertEqual(self.planner.first_poll(self.feed), datetime.datetime(2013, 1, 1, 0, 0, 20))
+
+    def test_backoff_capped(self):
+        # Test that the wait between polls doubles until it hits the maximum.
+        self.planner.first_poll(self.feed)
+        now = datetime.datetime(2013, 1, 1)
+        delays = [(self.planner.next_poll(self.feed, now) - now).seconds for i in range(5)]
+        self.assertEqual(delays, [60, 120, 240, 300, 300])
+
+    def test_backoff_reset(self):
+        # Test that a new validation starts backing off from the poll interval again.
+        now = datetime.datetime(2013, 1, 1)
+        self.planner.first_poll(self.feed)
+        self.planner.next_poll(self.feed, now)
+        self.planner.next_poll(self.feed, now)
+        self.planner.first_poll(self.feed)
+        self.assertEqual(self.planner.next_poll(self.feed, now), now + datetime.timedelta(seconds=60))
+
+class StaggerTests(unittest.TestCase):
+    def test_first_due_spread(self):
+        # Test that feeds sharing a next_try are spread over it, the same way every time.
+        now = datetime.datetime(2013, 1, 1)
+        feeds = make_feeds(100, '1d')
+        dues = [Stagger(spread=1).first_due(feed, now) for feed in feeds]
+        self.assertEqual(dues, [Stagger(spread=1).first_due(feed, now) for feed in feeds])
+        self.assertEqual(all(now <= due < now + datetime.timedelta(days=1) for due in dues), True)
+        hours = set(due.hour for due in dues)
+        self.assertEqual(len(hours) > 15, True)
+
+    def test_no_spread(self):
+        now = datetime.datetime(2013, 1, 1)
+        self.assertEqual(Stagger().first_due(make_feeds(1, '1d')[0], now), now)
+
+    def test_jitter_bounded(self):
+        stagger = Stagger(jitter=0.1)
+        feed = make_feeds(1, '1d')[0]
+        feed.last_validated = datetime.datetime(2013, 1, 1)
+        dues = [stagger.next_due(feed) for i in range(100)]
+        self.assertEqual(all(datetime.datetime(2013, 1, 1, 21, 36) <= due <= datetime.datetime(2013, 1, 2, 2, 24) for due in dues), True)
+        self.assertEqual(len(set(dues)) > 1, True)
+
+        # A feed jittered early is still started when it is picked up.
+        self.assertEqual(stagger.is_due(feed, datetime.datetime(2013, 1, 1, 21, 36)), True)
+        self.assertEqual(stagger.is_due(feed, datetime.datetime(2013, 1, 1, 21, 35)), False)
+
+    def test_scheduler_staggers_new_feeds(self):
+        validator = StubValidator()
+        scheduler = Scheduler(validator, StubEmailer(), make_feeds(10, '1d'), stagger=1)
+        scheduler.tick()
+        self.assertEqual(len(validator.started) < 10, True)
+        self.assertEqual(len(scheduler.pop_due(datetime.datetime.now() + datetime.timedelta(days=1))), 10 - len(validator.started))
+
+class SchedulerTests(unittest.TestCase):
+    def test_tick_starts_every_feed(self):
+        # Test that every new feed is due straight away and started, even with fewer workers than feeds.
+        validator = StubValidator()
+        feeds = make_feeds(10)
+        scheduler = Scheduler(validator, StubEmailer(), feeds, workers=3)
+        scheduler.tick()
+        self.assertEqual(sorted(f.name for f in validator.started), sorted(f.name for f in feeds))
+
+    def test_tick_polls_started_feeds(self):
+        # Test that the next tick polls the feeds that were started and emails the failures.
+        validator = StubValidator(total_issues=2)
+        emailer = StubEmailer()
+        scheduler = Scheduler(validator, emailer, make_feeds(5), workers=2, poll_interval=0)
+        scheduler.tick()
+        scheduler.tick()
+        self.assertEqual(len(validator.polled), 5)
+        self.assertEqual(len(emailer.sent), 5)
+        self.assertEqual(emailer.sent[0][1].endswith(u"(2 Issues)"), True)
+
+    def test_tick_success_sends_no_email(self):
+        emailer = StubEmailer()
+        scheduler = Scheduler(StubValidator(), emailer, make_feeds(3), poll_interval=0)
+        scheduler.tick()
+        scheduler.tick()
+        self.assertEqual(emailer.sent, [])
+
+    def test_complete_store_fails(self):
+        # Test that a result the store can't record still sends its email, and remembers the issues sent, and frees up
+        # the feed's slot.
+        store = StateStore(':memory:')
+        def record(*args):
+            raise sqlite3.OperationalError('database is locked')
+        store.record = record
+        emailer = StubEmailer()
+        feed = make_feeds(1)[0]
+        scheduler = Scheduler(StubValidator(), emailer, [feed], store=store, admission=AdmissionController(max_in_flight=1))
+        scheduler.admission.occupy(feed)
+        response_json = {"test-duration": 5, "validation-results": {"errors": ["an error"], "warnings": []}}
+        self.assertRaises(sqlite3.OperationalError, scheduler.complete, feed, False, 1, response_json)
+        self.assertEqual(len(emailer.sent), 1)
+        self.assertEqual(scheduler.admission.in_flight, set())
+        self.assertEqual(scheduler.issues.check(feed, response_json).changed, False)
+        store.close()
+
+    def test_complete_email_fails(self):
+        # Test that issues that couldn't be emailed are sent again after the next validation.
+        emailer = StubEmailer()
+        def enqueue(*args):
+            raise ValueError('no recipients')
+        emailer.enqueue = enqueue
+        feed = make_feeds(1)[0]
+        scheduler = Scheduler(StubValidator(), emailer, [feed])
+        response_json = {"test-duration": 5, "validation-results": {"errors": ["an error"], "warnings": []}}
+        self.assertRaises(ValueError, scheduler.complete, feed, False, 1, response_json)
+        self.assertEqual(scheduler.issues.check(feed, response_json).first, True)
+
+    def test_poll_waits_for_interval(self):
+        # Test that a started feed with no history is not polled until the poll interval has passed.
+        validator = StubValidator()
+        scheduler = Scheduler(validator, StubEmailer(), make_feeds(1), poll_interval=60)
+        scheduler.tick()
+        scheduler.tick()
+        self.assertEqual(validator.polled, [])
+        self.assertEqual(len(scheduler.pop_due(datetime.datetime.now() + datetime.timedelta(seconds=61))), 1)
+
+    def test_completed_feed_due_after_next_try(self):
+        # Test that a finished feed goes back on the queue for [next_try] after it was validated.
+        scheduler = Scheduler(StubValidator(), StubEmailer(), make_feeds(1), poll_interval=0)
+        scheduler.tick()
+        scheduler.tick()
+        self.assertEqual(scheduler.pop_due(datetime.datetime.now() + datetime.timedelta(minutes=9)), [])
+        self.assertEqual(len(scheduler.pop_due(datetime.datetime.now() + datetime.timedelta(minutes=10))), 1)
+
+    def test_pop_due_in_order(self):
+        # Test that feeds come off the queue earliest first, whatever order they went on in.
+        feeds = make_feeds(3)
+        now = datetime.datetime.now()
+        for i, feed in enumerate(feeds):
+            feed.last_validated = now - datetime.timedelta(minutes=10 + i)
+        scheduler = Scheduler(StubValidator(), StubEmailer(), feeds)
+        self.assertEqual([f.name for f in scheduler.pop_due(now)], ['feed2', 'feed1', 'feed0'])
+
+    def test_tick_survives_feed_errors(self):
+        # Test that an error starting a feed is put down to the feed and it's tried again later, other feeds carry on.
+        validator = StubValidator()
+        start = validator.start
+        def failing_start(feed):
+            if feed.name == 'feed0':
+                raise ValueError("Feed fell over")
+            start(feed)
+        validator.start = failing_start
+        scheduler = Scheduler(validator, StubEmailer(), make_feeds(2), poll_interval=60)
+        scheduler.tick()
+        self.assertEqual([f.name for f in validator.started], ['feed1'])
+        self.assertEqual(scheduler.breakers.get('endpoint0').failed_count, 1)
+        self.assertEqual(len(scheduler.pop_due(datetime.datetime.now() + datetime.timedelta(seconds=61))), 2)
+
+    def test_invalid_worker_count(self):
+        self.assertRaises(ValueError, Scheduler, StubValidator(), StubEmailer(), [], workers=0)
+
+class AdmissionControllerTests(unittest.TestCase):
+    def test_token_bucket(self):
+        # Test that a burst goes straight through and after that requests wait for the rate.
+        bucket = TokenBucket(2, burst=2)
+        self.assertEqual([bucket.take(100), bucket.take(100), bucket.take(100)], [0, 0, 0.5])
+        self.assertEqual(bucket.take(100.5), 0)
+
+    def test_max_in_flight(self):
+        # Test that feeds past the limit wait, in order, for a validation to finish.
+        admission = AdmissionController(max_in_flight=2)
+        feeds = make_feeds(4)
+        self.assertEqual([admission.admit(feed, 0) for feed in feeds], [(True, None), (True, None), (False, None), (False, None)])
+        self.assertEqual(admission.next_waiting(), None)
+        admission.release(feeds[0])
+        self.assertEqual(admission.next_waiting(), 'endpoint2')
+        self.assertEqual(admission.admit(feeds[3], 5), (False, None))
+        self.assertEqual(admission.admit(feeds[2], 5), (True, None))
+        self.assertEqual(list(admission.waiting), ['endpoint3'])
+
+    def test_start_rate(self):
+        admission = AdmissionController(start_rate=0.5)
+        feeds = make_feeds(2)
+        self.assertEqual(admission.admit(feeds[0], 0), (True, None))
+        self.assertEqual(admission.admit(feeds[1], 0), (False, 2))
+        self.assertEqual(admission.admit(feeds[1], 2), (True, None))
+
+    def test_forget(self):
+        admission = AdmissionController(max_in_flight=1)
+        feeds = make_feeds(3)
+        for feed in feeds:
+            admission.admit(feed, 0)
+        admission.forget('endpoint0')
+        admission.forget('endpoint1')
+        self.assertEqual(admission.next_waiting(), 'endpoint2')
+
+    def test_scheduler_holds_back_starts(self):
+        # Test that the scheduler only starts [max_in_flight] feeds, starting the rest as validations finish.
+        validator = StubValidator(duration=0)
+        scheduler = Scheduler(validator, StubEmailer(), make_feeds(5), workers=2, poll_interval=0, admission=AdmissionController(max_in_flight=2))
+        scheduler.tick()
+        self.assertEqual([f.name for f in validator.started], ['feed0', 'feed1'])
+        self.assertEqual(len(scheduler.admission.waiting), 3)
+        scheduler.tick()
+        self.assertEqual(len(validator.polled), 2)
+        # Each feed let through wakes up the one behind it in the queue.
+        scheduler.tick()
+        scheduler.tick()
+        self.assertEqual([f.name for f in validator.started], ['feed0', 'feed1', 'feed2', 'feed3'])
+        self.assertEqual(list(scheduler.admission.waiting), ['endpoint4'])
+
+    def test_scheduler_rate_limits_polls(self):
+        validator = StubValidator(duration=0)
+        scheduler = Scheduler(validator, StubEmailer(), make_feeds(3), poll_interval=0, admission=AdmissionController(poll_rate=0.01))
+        scheduler.tick()
+        scheduler.tick()
+        self.assertEqual(len(validator.polled), 1)
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('feed', 'endpoint', failures=2, cooldown=10, cooldown_max=25)
+
+    def test_opens_after_failures(self):
+        self.assertEqual(self.breaker.allow(0), 0)
+        self.breaker.failed(0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.failed(0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.allow(4), 6)
+        self.assertEqual(self.breaker.remaining(4), 6)
+
+    def test_success_resets_count(self):
+        self.breaker.failed(0)
+        self.breaker.succeeded()
+        self.breaker.failed(0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open(self):
+        # Test that after the cool-down a single attempt is let through, closing the breaker if it works.
+        self.breaker.failed(0)
+        self.breaker.failed(0)
+        self.assertEqual(self.breaker.allow(10), 0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.breaker.allow(11), 9)
+        self.breaker.succeeded()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.allow(11), 0)
+
+    def test_exponential_cooldown(self):
+        # Test that each failed attempt while half-open doubles the cool-down, up to the maximum.
+        self.breaker.failed(0)
+        self.breaker.failed(0)
+        retries = []
+        now = 0
+        for i in range(3):
+            now += self.breaker.allow(now)
+            self.breaker.allow(now)
+            self.breaker.failed(now)
+            retries.append(self.breaker.remaining(now))
+        self.assertEqual(retries, [20, 25, 25])
+
+    def test_metrics(self):
+        self.breaker.failed(0)
+        self.breaker.failed(0)
+        self.assertEqual(u'flmx_circuit_state{kind="feed",name="endpoint"} 2' in metrics.render(), True)
+
+    def test_validator_breaker(self):
+        # Test that a validator that can't be reached stops being sent requests.
+        validator = Validator("endpoint", "username", "password", retries=0, breaker=CircuitBreaker('validator', 'endpoint', failures=2))
+        feed = Feed('name', 'http://feed.example.com/FLM/', 'username', 'password', '10m', False, {})
+        feed.validation_start_time = datetime.datetime.now()
+        validator.session = StubSession([requests.exceptions.ConnectionError(), StubResponse(503, ''), StubResponse(200, '')])
+        self.assertRaises(requests.exceptions.ConnectionError, validator.poll_results, feed)
+        self.assertRaises(requests.exceptions.HTTPError, validator.poll_results, feed)
+        self.assertRaises(CircuitOpenError, validator.poll_results, feed)
+        self.assertEqual(len(validator.session.calls), 2)
+
+    def test_scheduler_feed_breaker(self):
+        # Test that a feed whose results keep failing is left alone until its breaker lets it through again.
+        validator = StubValidator()
+        def poll_results(feed):
+            validator.polled.append(feed)
+            raise ValueError("Bad results")
+        validator.poll_results = poll_results
+        scheduler = Scheduler(validator, StubEmailer(), make_feeds(1), poll_interval=0,
+            breakers=CircuitBreakers('feed', failures=2, cooldown=60))
+        for i in range(4):
+            scheduler.tick()
+        self.assertEqual(len(validator.polled), 2)
+        self.assertEqual(scheduler.breakers.get('endpoint0').state, CircuitBreaker.OPEN)
+        self.assertEqual(scheduler.pop_due(datetime.datetime.now()), [])
+
+    def test_scheduler_gives_up_failing_polls(self):
+        # Test that a validation whose polls keep failing is given up on once its breaker opens, freeing its place
+        # for the other feeds, and started again later.
+        clock = VirtualClock(datetime.datetime(2013, 1, 1))
+        validator = StubValidator()
+        poll_results = validator.poll_results
+        def failing_poll_results(feed):
+            if feed.endpoint == 'endpoint0':
+                validator.polled.append(feed)
+                raise requests.exceptions.HTTPError('404 Not Found')
+            return poll_results(feed)
+        validator.poll_results = failing_poll_results
+        validator.start = lambda feed: (validator.started.append(feed), setattr(feed, 'validation_start_time', clock.now()))
+        scheduler = Scheduler(validator, StubEmailer(), make_feeds(3), poll_interval=60, clock=clock,
+            admission=AdmissionController(max_in_flight=1, clock=clock), breakers=CircuitBreakers('feed', clock=clock))
+        for i in range(20):
+            scheduler.tick()
+            clock.advance_to(scheduler.queue[0][0])
+        self.assertEqual(len(validator.polled) > 3, True)
+        self.assertEqual(set(feed.name for feed in validator.started), set(['feed0', 'feed1', 'feed2']))
+        self.assertEqual(len([feed for feed in validator.started if feed.name == 'feed0']) > 1, True)
+
+    def test_breakers_only_while_failing(self):
+        # Test that a breaker is only kept for a feed from when it fails until it works again.
+        breakers = CircuitBreakers('feed', failures=2)
+        self.assertEqual((breakers.allow('endpoint'), breakers.get('endpoint')), (0, None))
+        breakers.failed('endpoint')
+        self.assertEqual(breakers.get('endpoint').failed_count, 1)
+        self.assertEqual(metrics.gauge('flmx_circuit_state').values[(('kind', 'feed'), ('name', 'endpoint'))], 0)
+        breakers.succeeded('endpoint')
+        self.assertEqual(breakers.breakers, {})
+        self.assertEqual((('kind', 'feed'), ('name', 'endpoint')) in metrics.gauge('flmx_circuit_state').values, False)
+
+class StateStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.store = StateStore(':memory:')
+
+    def tearDown(self):
+        self.store.close()
+
+    def make_feed(self):
+        return Feed('name', 'endpoint', 'username', 'password', '10m', False, {"to": "test-email@example.com"})
+
+    def test_checkpoint_restore(self):
+        # Test that a feed's schedule state survives being saved and loaded.
+        feed = self.make_feed()
+        feed.last_validated = datetime.datetime(2013, 1, 1, 12, 30, 15, 500)
+        feed.validation_start_time = datetime.datetime(2013, 1, 2)
+        self.store.checkpoint(feed)
+        restored = self.make_feed()
+        self.assertEqual(self.store.restore([restored, Feed('other', 'other', 'username', 'password', '10m', False, {})]), 1)
+        self.assertEqual(restored.last_validated, feed.last_validated)
+        self.assertEqual(restored.validation_start_time, feed.validation_start_time)
+
+    def test_history(self):
+        # Test that results are kept newest first.
+        feed = self.make_feed()
+        for day, issues in [(1, 0), (2, 3)]:
+            feed.last_validated = datetime.datetime(2013, 1, day)
+            self.store.record(feed, issues == 0, issues, {"test-duration": 10 * day})
+        self.assertEqual(self.store.history('endpoint'), [(datetime.datetime(2013, 1, 2), False, 3, 20), (datetime.datetime(2013, 1, 1), True, 0, 10)])
+
+    def test_scheduler_resumes(self):
+        # Test that a restarted scheduler polls a validation in progress and waits out [next_try] for the rest.
+        running, finished = self.make_feed(), Feed('finished', 'finished', 'username', 'password', '10m', False, {})
+        running.validation_start_time = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        finished.last_validated = datetime.datetime.now()
+        self.store.checkpoint(running)
+        self.store.checkpoint(finished)
+
+        feeds = [self.make_feed(), Feed('finished', 'finished', 'username', 'password', '10m', False, {})]
+        validator = StubValidator()
+        scheduler = Scheduler(validator, StubEmailer(), feeds, poll_interval=0, store=self.store)
+        scheduler.tick()
+        self.assertEqual(validator.started, [])
+        self.assertEqual([f.name for f in validator.polled], ['name'])
+        self.assertEqual(self.store.history('endpoint')[0][3], 5)
+
+class IssueTrackerTests(unittest.TestCase):
+    def setUp(self):
+        self.tracker = IssueTracker()
+        self.feed = Feed('name', 'endpoint', 'username', 'password', '10m', False, {})
+
+    def result(self, errors, warnings=None):
+        return {"validation-results": {"errors": errors, "warnings": warnings or []}}
+
+    def test_first_result(self):
+        changes = self.tracker.compare(self.feed, self.result(["an error"]))
+        self.assertEqual(changes.first, True)
+        self.assertEqual(changes.changed, True)
+
+    def test_unchanged(self):
+        # Test that the same issues in a different order and spacing count as unchanged.
+        self.tracker.compare(self.feed, self.result(["an error", "another  error"], ["a warning"]))
+        changes = self.tracker.compare(self.feed, self.result([" another error", "an error"], ["a warning"]))
+        self.assertEqual(changes.changed, False)
+        self.assertEqual(changes.describe(), u"Still failing with the same 2 errors and 1 warnings as the last validation.")
+
+    def test_new_and_resolved(self):
+        self.tracker.compare(self.feed, self.result(["an error", "an old error"]))
+        changes = self.tracker.compare(self.feed, self.result(["an error", "a new error"], ["a warning"]))
+        self.assertEqual(changes.new_errors, frozenset([u"a new error"]))
+        self.assertEqual(changes.new_warnings, frozenset([u"a warning"]))
+        self.assertEqual(changes.resolved_errors, frozenset([u"an old error"]))
+        self.assertEqual(changes.unchanged, 1)
+        self.assertEqual(changes.describe().split(u"\n")[0], u"2 new, 1 resolved and 1 unchanged issues since the last validation.")
+
+        # Only so many of each change are listed.
+        self.tracker.limit = 1
+        changes = self.tracker.compare(self.feed, self.result(["an error", "a new error", "another new error"], ["a warning"]))
+        self.assertEqual(changes.truncated, False)
+        changes = self.tracker.compare(self.feed, self.result(["a third error", "a fourth error"], ["a warning"]))
+        self.assertEqual(changes.truncated, True)
+        self.assertEqual(changes.describe().split(u"\n")[2:4], [u"New errors (first 1 of 2):", u"- a fourth error"])
+
+    def test_ignore_warnings(self):
+        # Test that warnings don't count as a change for feeds that ignore them.
+        self.feed.ignore_warnings = True
+        self.tracker.compare(self.feed, self.result(["an error"]))
+        self.assertEqual(self.tracker.compare(self.feed, self.result(["an error"], ["a warning"])).changed, False)
+
+    def test_stored(self):
+        # Test that a new tracker picks up the issues saved by the last one.
+        store = StateStore(':memory:')
+        IssueTracker(store).compare(self.feed, self.result(["an error"]))
+        changes = IssueTracker(store).compare(self.feed, self.result(["an error"]))
+        self.assertEqual(changes.first, False)
+        self.assertEqual(changes.changed, False)
+
+        # Including in the index, as soon as the feed is loaded.
+        tracker = IssueTracker(store)
+        tracker.load(self.feed.endpoint)
+        self.assertEqual(tracker.index.affected(u"an error"), frozenset(['endpoint']))
+        store.close()
+
+    def test_index(self):
+        # Test that each issue is indexed against the feeds it currently affects, and ranked by how many.
+        feeds = [Feed('name', 'endpoint{0}'.format(i), 'username', 'password', '10m', False, {}) for i in range(3)]
+        self.tracker.compare(feeds[0], self.result(["shared  error", "an error"], ["a warning"]))
+        self.tracker.compare(feeds[1], self.result(["shared error"]))
+        self.tracker.compare(feeds[2], self.result(["shared error", "an  error"]))
+        index = self.tracker.index
+        self.assertEqual(index.top('error'), [(u"shared error", ['endpoint0', 'endpoint1', 'endpoint2']), (u"an error", ['endpoint0', 'endpoint2'])])
+        self.assertEqual(index.top('warning'), [(u"a warning", ['endpoint0'])])
+
+        # Both feeds hold the same copy of the issue they share.
+        first, second = [[e for e in self.tracker.previous[endpoint][1] if e == u"an error"][0] for endpoint in ('endpoint0', 'endpoint2')]
+        self.assertTrue(first is second)
+
+        # Resolved issues, and removed feeds, drop out.
+        self.tracker.compare(feeds[2], self.result(["shared error"]))
+        self.tracker.forget('endpoint1')
+        self.assertEqual(index.top('error', limit=1), [(u"shared error", ['endpoint0', 'endpoint2'])])
+        self.tracker.compare(feeds[0], self.result([]))
+        report = index.report(examples=1)
+        self.assertEqual(report["errors"], [{"issue": u"shared error", "feeds": 1, "endpoints": ['endpoint2']}])
+        self.assertEqual((report["warnings"], report["distinct_errors"], report["distinct_warnings"]), ([], 1, 0))
+        self.assertEqual(sorted(index.strings), [u"shared error"])
+
+    def test_scheduler_emails_changes(self):
+        # Test that only the first failure email carries the full results.
+        emailer = StubEmailer()
+        scheduler = Scheduler(StubValidator(total_issues=2, duration=0), emailer, [self.feed], poll_interval=0)
+        self.feed.next_try = datetime.timedelta(0)
+        for i in range(4):
+            scheduler.tick()
+        self.assertEqual(len(emailer.sent), 2)
+        self.assertEqual(emailer.sent[0][1].startswith(u"Validation failed"), True)
+        self.assertEqual(emailer.sent[1][1].startswith(u"Validation still failing"), True)
+        self.assertEqual(emailer.sent[1][2].startswith(u"Still failing"), True)
+
+class DispatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.validators = [StubValidator(), StubValidator(), StubValidator()]
+        for i, validator in enumerate(self.validators):
+            validator.endpoint = "validator{0}".format(i)
+            validator.weight = 1
+        self.dispatcher = Dispatcher(self.validators)
+        self.feeds = make_feeds(6)
+
+    def test_least_outstanding(self):
+        # Test that validations are spread evenly over equally weighted validators.
+        for feed in self.feeds:
+            self.dispatcher.start(feed)
+        self.assertEqual([len(v.started) for v in self.validators], [2, 2, 2])
+
+    def test_weights(self):
+        # Test that a validator with twice the weight takes twice the validations.
+        self.validators[0].weight = 2
+        for feed in make_feeds(8):
+            self.dispatcher.start(feed)
+        self.assertEqual([len(v.started) for v in self.validators], [4, 2, 2])
+
+    def test_sticky_polls(self):
+        # Test that each feed is polled on the validator it was started on, freeing it up once finished.
+        for feed in self.feeds:
+            self.dispatcher.start(feed)
+        for feed in self.feeds:
+            self.dispatcher.poll_results(feed)
+        for validator in self.validators:
+            self.assertEqual(validator.started, validator.polled)
+        self.assertEqual(self.dispatcher.outstanding, {"validator0": 0, "validator1": 0, "validator2": 0})
+        self.assertEqual(self.feeds[0].validator_endpoint, None)
+
+    def test_sticky_after_restart(self):
+        # Test that a feed restored mid validation is polled on the validator saved with it.
+        self.feeds[0].validation_start_time = datetime.datetime.now()
+        self.feeds[0].validator_endpoint = "validator2"
+        self.dispatcher.poll_results(self.feeds[0])
+        self.assertEqual(self.validators[2].polled, [self.feeds[0]])
+
+    def test_lost_after_restart(self):
+        # Test that a feed restored mid validation on a validator that has since gone is started again.
+        feed = self.feeds[0]
+        feed.validation_start_time = datetime.datetime.now()
+        feed.validator_endpoint = "validator9"
+        scheduler = Scheduler(self.dispatcher, StubEmailer(), [feed])
+        self.assertEqual(scheduler.process(feed) <= datetime.datetime.now(), True)
+        self.assertEqual(feed.validation_start_time, None)
+        self.assertEqual(feed.validator_endpoint, None)
+        self.assertEqual([v.polled for v in self.validators], [[], [], []])
+
+        scheduler.process(feed)
+        self.assertEqual(sum(len(v.started) for v in self.validators), 1)
+
+    def test_remove_feed(self):
+        # Test that a feed removed mid validation no longer counts against its validator.
+        scheduler = Scheduler(self.dispatcher, StubEmailer(), self.feeds[:1])
+        self.dispatcher.start(self.feeds[0])
+        scheduler.remove_feed(self.feeds[0].endpoint)
+        self.assertEqual(self.dispatcher.assigned, {})
+        self.assertEqual(self.dispatcher.outstanding, {"validator0": 0, "validator1": 0, "validator2": 0})
+
+    def test_validator_max_in_flight(self):
+        # Test that each validator takes no more than its own max_in_flight, the rest waiting for one to finish.
+        for validator in self.validators:
+            validator.max_in_flight = 1
+        admission = AdmissionController()
+        self.assertEqual([admission.admit(feed, 0, self.dispatcher.reserve) for feed in self.feeds[:4]], [(True, None)] * 3 + [(False, None)])
+        for feed in self.feeds[:3]:
+            self.dispatcher.start(feed)
+        self.assertEqual([len(v.started) for v in self.validators], [1, 1, 1])
+
+        self.dispatcher.poll_results(self.feeds[1])
+        admission.release(self.feeds[1])
+        self.assertEqual(admission.admit(self.feeds[3], 1, self.dispatcher.reserve), (True, None))
+        self.dispatcher.start(self.feeds[3])
+        self.assertEqual(self.validators[1].started, [self.feeds[1], self.feeds[3]])
+
+    def test_validator_start_rate(self):
+        # Test that each validator's start_rate holds back only the validations it would take, and not the others'.
+        self.validators[0].start_rate = 0.5
+        self.validators[1].max_in_flight = 0
+        self.validators[2].max_in_flight = 0
+        dispatcher = Dispatcher(self.validators)
+        admission = AdmissionController(start_rate=1, start_burst=2)
+        self.assertEqual(admission.admit(self.feeds[0], 0, dispatcher.reserve), (True, None))
+        self.assertEqual(admission.admit(self.feeds[1], 0, dispatcher.reserve), (False, 2))
+        self.assertEqual(admission.admit(self.feeds[1], 2, dispatcher.reserve), (True, None))
+        self.assertEqual([dispatcher.assigned[feed.endpoint] for feed in self.feeds[:2]], [self.validators[0]] * 2)
+
+    def test_skip_open_validator(self):
+        # Test that a validator whose circuit breaker has opened stops getting new validations.
+        self.dispatcher.start(self.feeds[0])
+        for i in range(3):
+            self.validators[0].breaker.failed()
+        for feed in self.feeds[1:]:
+            self.dispatcher.start(feed)
+        self.assertEqual([len(v.started) for v in self.validators], [1, 3, 2])
+
+        # With every breaker open the validator that comes back soonest gets the validation.
+        for validator in self.validators[1:]:
+            for i in range(3):
+                validator.breaker.failed()
+        self.dispatcher.start(make_feeds(7)[6])
+        self.assertEqual(len(self.validators[0].started), 2)
+
+    def test_settings_list(self):
+        # Test that the settings schema takes either a single validator or a list of them.
+        validator = {"endpoint": "http://flm.foxpico.com/validator", "username": "isdcf", "password": "isdcf"}
+        settings = {"feeds": [], "validator": [validator, dict(validator, weight=2, max_in_flight=5, start_rate=0.5, start_burst=2)], "email": {"host": "localhost", "port": 25, "sender": "flmx-validator@example.com"}}
+        schemas.validate('settings', settings)
+        settings["validator"] = []
+        self.assertRaises(jsonschema.ValidationError, schemas.validate, 'settings', settings)
+
+class ReceiverTests(unittest.TestCase):
+    def setUp(self):
+        self.feed = Feed('name', 'http://redacted/FLM/', 'username', 'password', '10m', False, {"to": "test-email@example.com"})
+        self.emailer = StubEmailer()
+        self.scheduler = Scheduler(Validator("endpoint", "username", "password"), self.emailer, [self.feed], poll_fallback=600)
+        self.result = dict(ValidatorTests.failure_json)
+        self.result["test-time"] = int(time.time())
+
+    def test_receive_completes_validation(self):
+        # Test that pushed results finish the validation, send the email and schedule the next one.
+        self.feed.validation_start_time = datetime.datetime.now() - datetime.timedelta(minutes=10)
+        self.assertEqual(self.scheduler.receive(json.dumps(self.result)), True)
+        self.assertEqual(self.feed.validation_start_time, None)
+        self.assertEqual(len(self.emailer.sent), 1)
+        self.assertEqual(self.scheduler.pop_due(datetime.datetime.now()), [])
+        self.assertEqual(self.scheduler.pop_due(datetime.datetime.now() + datetime.timedelta(minutes=10)), [self.feed])
+
+    def test_receive_not_in_progress(self):
+        # Test that results for a feed that isn't being validated are ignored.
+        self.assertEqual(self.scheduler.receive(json.dumps(self.result)), False)
+        self.assertEqual(self.emailer.sent, [])
+
+    def test_receive_unknown_feed(self):
+        self.result["url"] = "http://unknown/FLM/"
+        self.assertRaises(LookupError, self.scheduler.receive, json.dumps(self.result))
+
+    def test_fallback_poll(self):
+        # Test that the first poll waits for the fallback period when results are pushed to us.
+        validator = StubValidator()
+        scheduler = Scheduler(validator, StubEmailer(), self.scheduler.feeds, poll_interval=0, poll_fallback=600)
+        scheduler.tick()
+        scheduler.tick()
+        self.assertEqual(validator.polled, [])
+
+    def test_http_post(self):
+        # Test results POSTed over http are handed to the scheduler.
+        self.feed.validation_start_time = datetime.datetime.now() - datetime.timedelta(minutes=10)
+        receiver = ResultsReceiver(self.scheduler, port=0)
+        receiver.start()
+        try:
+            url = "http://{0}:{1}/results".format(*receiver.server_address)
+            self.assertEqual(requests.post(url, data=json.dumps(self.result)).status_code, 200)
+            self.assertEqual(len(self.emailer.sent), 1)
+            self.assertEqual(requests.post(url, data="not json").status_code, 400)
+        finally:
+            receiver.shutdown()
+            receiver.server_close()
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_counter(self):
+        counter = self.metrics.counter('flmx_test_total', 'A test counter')
+        counter.inc(result='failure')
+        counter.inc(2, result='success')
+        counter.inc(result='success')
+        self.assertEqual(self.metrics.render(), u'# HELP flmx_test_total A test counter\n# TYPE flmx_test_total counter\n'
+            u'flmx_test_total{result="failure"} 1\nflmx_test_total{result="success"} 3\n')
+
+    def test_histogram(self):
+        # Test that observations land in every bucket they fit in.
+        histogram = self.metrics.histogram('flmx_test_seconds', 'A test histogram', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        lines = self.metrics.render().split(u'\n')
+        self.assertEqual(lines[2:7], [u'flmx_test_seconds_bucket{le="0.1"} 1', u'flmx_test_seconds_bucket{le="1"} 2',
+            u'flmx_test_seconds_bucket{le="+Inf"} 2', u'flmx_test_seconds_sum 0.55', u'flmx_test_seconds_count 2'])
+
+    def test_gauge_function(self):
+        self.metrics.gauge('flmx_test_gauge', 'A test gauge', lambda: 7)
+        self.assertEqual(self.metrics.render().split(u'\n')[2], u'flmx_test_gauge 7')
+
+    def test_label_escaping(self):
+        self.metrics.gauge('flmx_test_gauge').set(1, feed='a "quoted" feed')
+        self.assertEqual(self.metrics.render().split(u'\n')[2], u'flmx_test_gauge{feed="a \\"quoted\\" feed"} 1')
+
+    def test_timer_and_summary(self):
+        with self.metrics.timer('flmx_test_seconds', 'A test timer'):
+            pass
+        self.metrics.counter('flmx_test_total').inc()
+        self.assertEqual(self.metrics.summary().startswith(u'flmx_test_seconds n=1 avg='), True)
+        self.assertEqual(self.metrics.summary().endswith(u', flmx_test_total=1'), True)
+
+    def test_scheduler_metrics(self):
+        # Test that the scheduler counts the validations it starts and how far behind it picks feeds up.
+        started = metrics.counter('flmx_validations_started_total').total()
+        scheduler = Scheduler(StubValidator(), StubEmailer(), make_feeds(3))
+        scheduler.tick()
+        self.assertEqual(metrics.counter('flmx_validations_started_total').total() - started, 3)
+        self.assertEqual(metrics.gauge('flmx_validations_in_flight').total(), 3)
+        self.assertEqual(u'flmx_feed_schedule_lag_seconds{feed="endpoint2"}' in metrics.render(), True)
+
+        # A feed that has gone stops being reported.
+        scheduler.remove_feed('endpoint2')
+        self.assertEqual(u'flmx_feed_schedule_lag_seconds{feed="endpoint2"}' in metrics.render(), False)
+
+    def test_http(self):
+        self.metrics.counter('flmx_test_total', 'A test counter').inc()
+        server = MetricsServer(self.metrics, port=0)
+        server.start()
+        try:
+            response = requests.get("http://{0}:{1}/metrics".format(*server.server_address))
+            self.assertEqual(response.text, self.metrics.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_server_reports(self):
+        server = MetricsServer(self.metrics, port=0, reports={'/issues': lambda: {"errors": []}})
+        server.start()
+        try:
+            response = requests.get("http://{0}:{1}/issues".format(*server.server_address))
+            self.assertEqual(response.json(), {"errors": []})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class LogPipelineTests(unittest.TestCase):
+    log_file_path = 'test_pipeline.log'
+
+    def setUp(self):
+        self.pipeline = LogPipeline(self.log_file_path, 'flmx-test-logger')
+        self.feed = Feed('name', 'endpoint', 'username', 'password', '10m', False, {})
+
+    def tearDown(self):
+        os.remove(self.log_file_path)
+
+    def read(self):
+        self.pipeline.stop()
+        with open(self.log_file_path) as log_file:
+            return log_file.read().splitlines()
+
+    def test_text(self):
+        # Test that records are written out in the usual format once the queue is drained.
+        self.pipeline.logger.info("A message")
+        lines = self.read()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0].endswith(" - INFO - A message"), True)
+
+    def test_json_lines(self):
+        self.pipeline.configure(json_lines=True)
+        self.pipeline.logger.info("A message about a feed", extra=feed_extra(self.feed))
+        self.pipeline.logger.info("Another message")
+        lines = [json.loads(line) for line in self.read()]
+        self.assertEqual((lines[0]["feed"], lines[0]["endpoint"], lines[0]["message"]), ("name", "endpoint", "A message about a feed"))
+        self.assertEqual("feed" in lines[1], False)
+
+    def test_rate_limit(self):
+        # Test that repetitive messages are held back and the next one let through says how many were.
+        self.pipeline.configure(rate_limit_period=60, rate_limit_burst=2)
+        other = Feed('other', 'other endpoint', 'username', 'password', '10m', False, {"to": "test-email@example.com"})
+        for i in range(5):
+            self.pipeline.logger.info("Polling %s", i, extra=feed_extra(self.feed, 'poll'))
+        self.pipeline.logger.info("Polling %s", other.name, extra=feed_extra(other, 'poll'))
+        self.pipeline.logger.info("Not rate limited")
+        self.pipeline.rate_limit.windows[('poll', 'endpoint')][0] -= 60
+        self.pipeline.logger.info("Polling again", extra=feed_extra(self.feed, 'poll'))
+        lines = [line.split(" - ")[-1] for line in self.read()]
+        self.assertEqual(lines, ["Polling 0", "Polling 1", "Polling other", "Not rate limited", "Polling again (3 similar messages suppressed)"])
+
+class BatchTests(unittest.TestCase):
+    def test_results(self):
+        # Test that every feed is validated once, with passes and failures reported for each.
+        validator = StubValidator(duration=0)
+        poll_results = validator.poll_results
+        def failing_poll_results(feed):
+            completed, success, total_issues, response_json = poll_results(feed)
+            if feed.name == 'feed1':
+                return completed, False, 2, {"test-duration": 0, "validation-results": {"errors": ["b", "a"], "warnings": []}}
+            return completed, success, total_issues, response_json
+        validator.poll_results = failing_poll_results
+        results = BatchScheduler(validator, None, make_feeds(3), poll_interval=0).run(5)
+        self.assertEqual([(r["name"], r["result"], r["total_issues"]) for r in results], [("feed0", "passed", 0), ("feed1", "failed", 2), ("feed2", "passed", 0)])
+        self.assertEqual(results[1]["errors"], ["a", "b"])
+        self.assertEqual(len(validator.started), 3)
+
+    def test_gives_up(self):
+        # Test that a feed that keeps failing is reported as an error once its breaker opens, and one that never
+        # finishes as timed out.
+        validator = StubValidator()
+        def start(feed):
+            if feed.name == 'feed0':
+                raise ValueError("Not a feed")
+            feed.validation_start_time = datetime.datetime.now()
+        validator.start = start
+        scheduler = BatchScheduler(validator, None, make_feeds(2), poll_interval=60, breakers=CircuitBreakers('feed', failures=1))
+        results = scheduler.run(0.5)
+        self.assertEqual([r["result"] for r in results], ["error", "timeout"])
+
+    def test_summary_and_junit(self):
+        results = [
+            {"name": "feed0", "endpoint": "endpoint0", "result": "passed", "total_issues": 0, "errors": [], "warnings": [], "message": None, "seconds": 1.0},
+            {"name": "feed1", "endpoint": "endpoint1", "result": "failed", "total_issues": 1, "errors": ["an error"], "warnings": [], "message": None, "seconds": 2.0},
+            {"name": "feed2", "endpoint": "endpoint2", "result": "timeout", "total_issues": 0, "errors": [], "warnings": [], "message": "Too slow", "seconds": 3.0},
+        ]
+        report = summary(results, 3.04)
+        self.assertEqual((report["total"], report["passed"], report["failed"], report["error"], report["timeout"], report["seconds"]), (3, 1, 1, 0, 1, 3.0))
+
+        suite = ElementTree.fromstring(junit(report))
+        self.assertEqual((suite.get("tests"), suite.get("failures"), suite.get("errors")), ("3", "1", "1"))
+        cases = suite.findall("testcase")
+        self.assertEqual(cases[1].find("failure").text, "Error: an error")
+        self.assertEqual(cases[2].find("error").get("message"), "Too slow")
+
+    def test_options(self):
+        options, args = parse_options(["--once", "--feed", "feed0", "--feed", "endpoint1", "--json", "-", "settings.json"])
+        self.assertEqual((options.once, options.feeds, options.json_path, args), (True, ["feed0", "endpoint1"], "-", ["settings.json"]))
+        options, args = parse_options(["settings.json", "log.out"])
+        self.assertEqual((options.once, args), (False, ["settings.json", "log.out"]))
+        self.assertRaises(SystemExit, parse_options, ["--feed", "feed0", "settings.json"])
+
+    def test_spool_dir_relative_to_settings(self):
+        # Test that a relative spool_dir is found next to the settings rather than wherever we were started from.
+        settings_path = os.path.join(os.sep, 'etc', 'flmx', 'settings.json')
+        self.assertEqual(validator_settings(settings_path, {"endpoint": "endpoint", "spool_dir": "results"})["spool_dir"], os.path.join(os.sep, 'etc', 'flmx', 'results'))
+        self.assertEqual(validator_settings(settings_path, {"endpoint": "endpoint", "spool_dir": os.path.join(os.sep, 'var', 'flmx')})["spool_dir"], os.path.join(os.sep, 'var', 'flmx'))
+        self.assertEqual(validator_settings(settings_path, {"endpoint": "endpoint"}), {"endpoint": "endpoint"})
+
+    def test_state_path_relative_to_settings(self):
+        # Test that the state database is found next to the settings unless given in full.
+        settings_path = os.path.join(os.sep, 'etc', 'flmx', 'settings.json')
+        self.assertEqual(settings_relative(settings_path, 'flmx-validator.db'), os.path.join(os.sep, 'etc', 'flmx', 'flmx-validator.db'))
+        self.assertEqual(settings_relative(settings_path, os.path.join(os.sep, 'var', 'flmx.db')), os.path.join(os.sep, 'var', 'flmx.db'))
+
+    def test_run_once(self):
+        # Test that feeds are validated in parallel against the fake validator, taking about as long as one of them.
+        server = FakeValidator(job_duration=0.5, result_size=0, start_hang=0.5)
+        server.start()
+        try:
+            validator = Validator(server.endpoint, "username", "password", retries=0, start_timeout=0.05)
+            feeds = [Feed('Feed {0}'.format(i), 'http://feed{0}.example.com/FLM/'.format(i), 'username', 'password', '10m', False, {}) for i in range(8)]
+            json_path = 'test_batch.json'
+            started = time.time()
+            self.assertEqual(run_once(validator, feeds, json_path=json_path, timeout=10, workers=8, poll_interval=0.2), 0)
+            self.assertEqual(time.time() - started < 3, True)
+            with open(json_path) as json_file:
+                self.assertEqual(json.load(json_file)["passed"], 8)
+            os.remove(json_path)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class BenchmarkTests(unittest.TestCase):
+    def test_fake_validator(self):
+        # Test that the fake validator behaves the way Validator expects the real one to.
+        server = FakeValidator(job_duration=0.2, result_size=3, start_hang=0.5)
+        server.start()
+        try:
+            validator = Validator(server.endpoint, "username", "password", retries=0, start_timeout=0.05)
+            feed = Feed('name', 'http://feed.example.com/FLM/', 'username', 'password', '10m', False, {})
+            validator.start(feed)
+            self.assertEqual(feed.validation_start_time is not None, True)
+            time.sleep(0.4)
+            completed, success, total_issues, response_json = validator.poll_results(feed)
+            self.assertEqual((completed, success, total_issues), (True, False, 3))
+            self.assertEqual(server.counts, {'starts': 1, 'polls': 1})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_measure_memory(self):
+        options, args = parse_benchmark_options(['--memory'])
+        result = measure_memory(100, options)
+        self.assertEqual(result["feeds"], 100)
+        self.assertTrue(0 < result["bytes_per_feed"] <= result["bytes_per_scheduled_feed"])
+
+    def test_smtp_sink(self):
+        # Test that emails sent to the sink are counted.
+        sink = SmtpSink()
+        sink.start()
+        try:
+            emailer = Emailer({"host": sink.server_address[0], "port": sink.server_address[1], "sender": "flmx-validator@example.com"})
+            emailer.send({"to": "test-email@example.com"}, u"One", u"Body")
+            emailer.send({"to": "test-email@example.com"}, u"Two", u"Body")
+            emailer.close()
+            self.assertEqual(sink.messages, 2)
+        finally:
+            sink.shutdown()
+            sink.server_close()
+
+class ShardTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'shard.db')
+        self.clock = VirtualClock(datetime.datetime(2013, 1, 1))
+        self.endpoints = set('endpoint{0}'.format(i) for i in range(10))
+        self.workers = []
+
+    def tearDown(self):
+        for leases in self.workers:
+            leases.close()
+        shutil.rmtree(self.directory)
+
+    def make_worker(self, worker_id):
+        self.workers.append(LeaseStore(self.path, worker_id, lease=60, clock=self.clock))
+        return self.workers[-1]
+
+    def test_feeds_shared_out(self):
+        # Test that a worker joining takes over half the feeds once the first one hands them over.
+        a, b = self.make_worker('a'), self.make_worker('b')
+        self.assertEqual(len(a.sync(self.endpoints)[0]), 10)
+        self.assertEqual(b.sync(self.endpoints), ([], [], []))
+        claimed, lost, released = a.sync(self.endpoints, busy=['endpoint0'])
+        self.assertEqual((claimed, lost, len(released)), ([], [], 5))
+        self.assertTrue('endpoint0' in a.held)
+        self.assertEqual(sorted(b.sync(self.endpoints)[0]), sorted(released))
+        self.assertEqual(a.held | b.held, self.endpoints)
+        self.assertEqual(a.held & b.held, set())
+
+    def test_dead_worker_taken_over(self):
+        # Test that the feeds of a worker that stops checking in go to the others once its leases run out.
+        a, b = self.make_worker('a'), self.make_worker('b')
+        a.sync(self.endpoints)
+        b.sync(self.endpoints)
+        a.sync(self.endpoints)
+        b.sync(self.endpoints)
+        self.clock.advance(30)
+        self.assertEqual(b.sync(self.endpoints)[0], [])
+        self.clock.advance(31)
+        self.assertEqual(len(b.sync(self.endpoints)[0]), 5)
+        self.assertEqual(b.held, self.endpoints)
+
+        # Should it come back it finds they have gone.
+        claimed, lost, released = a.sync(self.endpoints)
+        self.assertEqual((claimed, len(lost)), ([], 5))
+
+    def test_status(self):
+        a, b = self.make_worker('a'), self.make_worker('b')
+        a.sync(self.endpoints, status={"feeds": 10, "in_flight": 2, "validations": 7, "failures": 1})
+        b.sync(self.endpoints, status={"feeds": 0, "in_flight": 1, "validations": 3, "failures": 0})
+        self.clock.advance(61)
+        a.sync(self.endpoints, status={"feeds": 10, "in_flight": 2, "validations": 8, "failures": 1})
+        status = a.status()
+        self.assertEqual([(w["worker_id"], w["alive"]) for w in status["workers"]], [("a", True), ("b", False)])
+        self.assertEqual((status["alive"], status["feeds"], status["unowned"], status["in_flight"], status["validations"]), (1, 10, 0, 2, 11))
+        a.release_all()
+        status = b.status()
+        self.assertEqual((len(status["workers"]), status["unowned"]), (1, 10))
+
+    def test_coordinator(self):
+        # Test that the scheduler is kept to the feeds leased to it, including those added and removed later.
+        feeds = make_feeds(4)
+        scheduler = Scheduler(StubValidator(), StubEmailer(), [], workers=1)
+        coordinator = ShardCoordinator(scheduler, self.make_worker('a'), feeds[:3])
+        coordinator.sync()
+        self.assertEqual(sorted(scheduler.endpoints), ['endpoint0', 'endpoint1', 'endpoint2'])
+        coordinator.add_feed(feeds[3])
+        coordinator.remove_feed('endpoint0')
+        self.assertEqual(coordinator.sync(), (['endpoint3'], []))
+        self.assertEqual(sorted(scheduler.endpoints), ['endpoint1', 'endpoint2', 'endpoint3'])
+
+        # A second worker gets its share once the first hands some over.
+        other = Scheduler(StubValidator(), StubEmailer(), [], workers=1)
+        ShardCoordinator(other, self.make_worker('b'), feeds[1:]).sync()
+        coordinator.sync()
+        self.assertEqual(len(scheduler.endpoints), 2)
+        self.assertEqual(coordinator.status()["feeds"], 2)
+
+class SimulationTests(unittest.TestCase):
+    def test_virtual_clock(self):
+        clock = VirtualClock(datetime.datetime(2013, 1, 1))
+        start = clock.time()
+        clock.advance(90)
+        self.assertEqual(clock.now(), datetime.datetime(2013, 1, 1, 0, 1, 30))
+        clock.advance_to(datetime.datetime(2013, 1, 1))
+        self.assertEqual(clock.now(), datetime.datetime(2013, 1, 1, 0, 1, 30))
+        clock.advance_to(datetime.datetime(2013, 1, 2))
+        self.assertEqual(clock.time() - start, 86400)
+
+    def test_stuck_validation_restarted(self):
+        # Test that a validation that never finishes is started again 6 hours after it was started, not 6 hours
+        # after the feed was last validated.
+        clock = VirtualClock(datetime.datetime(2013, 1, 1))
+        validator = simulate.SimulatedValidator(clock, job_duration=86400 * 10)
+        feed = Feed('name', 'http://feed.example.com/FLM/', 'username', 'password', '1d', False, {})
+        feed.last_validated = clock.now() - datetime.timedelta(days=1)
+        scheduler = Scheduler(validator, StubEmailer(), [feed], workers=1, clock=clock)
+        scheduler.process(feed)
+        clock.advance(3600)
+        scheduler.process(feed)
+        self.assertEqual(validator.starts, 1)
+        clock.advance(6 * 3600)
+        self.assertEqual(scheduler.process(feed), clock.now())
+        self.assertEqual(feed.validation_start_time, None)
+
+    def test_run(self):
+        # Test that a day of 10 hourly feeds runs to completion, and keeps to the admission limit.
+        options, args = simulate.parse_options(['--days', '1', '--job-duration', '600', '--max-in-flight', '3', '--failure-rate', '1'])
+        result = simulate.run(simulate.generate_feeds(10, ['1h']), options)
+        self.assertTrue(150 <= result["validations"] <= 240)
+        self.assertTrue(result["start_requests"] - result["validations"] <= 3)
+        self.assertEqual(result["peak_concurrency"], 3)
+        self.assertTrue(result["lag_max_seconds"] > 0)
+        self.assertTrue(0 < result["emails_sent"] <= result["emails_queued"])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file